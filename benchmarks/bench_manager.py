@@ -0,0 +1,63 @@
+"""
+Cost of the transaction manager operations performed during a request when
+going through the threadlocal ``transaction.manager`` compared with the
+manager bound to the request by ``pyramid_tm.thread_manager``.
+"""
+
+from harness import Suite
+import transaction
+
+import pyramid_tm
+
+suite = Suite('manager')
+
+MANAGERS = {
+    'threadlocal': transaction.manager,
+    'thread': pyramid_tm.thread_manager(None),
+}
+
+
+class DataManager(object):
+    def abort(self, txn):
+        pass
+
+    def tpc_begin(self, txn):
+        pass
+
+    def commit(self, txn):
+        pass
+
+    def tpc_vote(self, txn):
+        pass
+
+    def tpc_finish(self, txn):
+        pass
+
+    def tpc_abort(self, txn):
+        pass
+
+    def sortKey(self):
+        return 'bench:%d' % id(self)
+
+
+def make_cases(manager):
+    def get():
+        manager.get()
+
+    def is_doomed():
+        manager.isDoomed()
+
+    def request_cycle():
+        # the calls made by the tween and a view joining a single resource
+        manager.begin()
+        manager.get().join(DataManager())
+        manager.isDoomed()
+        manager.get()
+        manager.commit()
+
+    return {'get': get, 'is_doomed': is_doomed, 'request_cycle': request_cycle}
+
+
+for manager_name, manager in sorted(MANAGERS.items()):
+    for name, fn in make_cases(manager).items():
+        suite.add(name, fn, manager=manager_name)
@@ -0,0 +1,101 @@
+"""
+Cost of recognizing and tagging retryable errors during a synthetic storm of
+``ConflictError`` exceptions raised from a transaction joined by a data
+manager implementing ``should_retry``.
+
+Every case is measured against creating the exception alone, the difference
+being reported as ``overhead_ns``. The ``classify`` cases are run with a cheap
+``should_retry`` and with an ``expensive`` one, showing when enabling the
+``tm.retryable_cache_size`` cache pays off.
+"""
+
+from harness import Suite
+from pyramid_retry import IRetryableError
+import transaction
+import zope.interface
+
+import pyramid_tm
+
+suite = Suite('retryable')
+
+
+class ConflictError(Exception):
+    pass
+
+
+class DataManager(object):
+    should_retry_cacheable = True
+
+    def abort(self, txn):
+        pass
+
+    def sortKey(self):
+        return 'bench:%d' % id(self)
+
+    def should_retry(self, exc):
+        return isinstance(exc, ConflictError)
+
+
+class ExpensiveDataManager(DataManager):
+    def should_retry(self, exc):
+        # e.g. inspecting the error code of a database driver exception
+        return any(
+            isinstance(exc, cls) for cls in type(exc).__mro__ * 8
+        ) and isinstance(exc, ConflictError)
+
+
+class Request(object):
+    def __init__(self, dm_factory=DataManager):
+        self.tm = transaction.TransactionManager(explicit=True)
+        self.tm.begin().join(dm_factory())
+
+
+def baseline():
+    ConflictError()
+
+
+def also_provides():
+    zope.interface.alsoProvides(ConflictError(), IRetryableError)
+
+
+def tag_error_retryable():
+    pyramid_tm.tag_error_retryable(ConflictError())
+
+
+def make_classify(cache, dm_factory=DataManager):
+    request = Request(dm_factory)
+
+    def classify():
+        exc = ConflictError()
+        pyramid_tm.maybe_tag_retryable(
+            request, (ConflictError, exc, None), cache
+        )
+
+    return classify
+
+
+suite.add('tag', also_provides, baseline=baseline, method='alsoProvides')
+suite.add(
+    'tag', tag_error_retryable, baseline=baseline, method='tag_error_retryable'
+)
+suite.add('classify', make_classify(None), baseline=baseline, cache='none')
+suite.add(
+    'classify',
+    make_classify(pyramid_tm.RetryableCache()),
+    baseline=baseline,
+    cache='retryable_cache',
+)
+suite.add(
+    'classify',
+    make_classify(None, ExpensiveDataManager),
+    baseline=baseline,
+    cache='none',
+    should_retry='expensive',
+)
+suite.add(
+    'classify',
+    make_classify(pyramid_tm.RetryableCache(), ExpensiveDataManager),
+    baseline=baseline,
+    cache='retryable_cache',
+    should_retry='expensive',
+)
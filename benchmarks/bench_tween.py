@@ -0,0 +1,170 @@
+"""
+Per-request overhead of ``tm_tween`` for each of its outcome paths.
+
+Every case is measured against a bare handler invoked with the same request
+scaffolding, the difference being reported as ``overhead_ns``.
+"""
+
+from harness import Suite
+from pyramid.registry import Registry
+import transaction
+
+import pyramid_tm
+
+suite = Suite('tween')
+
+# each manager maps to the settings enabling it and a factory returning the
+# manager for a request, the latter being part of the measured baseline
+MANAGERS = {
+    'threadlocal': ({}, lambda request: transaction.manager),
+    'thread': ({}, pyramid_tm.thread_manager),
+    'explicit': ({}, pyramid_tm.explicit_manager),
+    'pooled': (
+        {'tm.manager_hook': pyramid_tm.pooled_explicit_manager},
+        pyramid_tm.pooled_explicit_manager,
+    ),
+}
+
+
+class Response(object):
+    def __init__(self, status='200 OK'):
+        self.status = status
+        self.headers = {}
+
+
+OK = Response()
+ERROR = Response('500 Internal Server Error')
+
+
+class Request(object):
+    authenticated_userid = None
+    exc_info = None
+    path_info = '/'
+
+    def __init__(self, registry, make_manager):
+        self.environ = {}
+        self.registry = registry
+        self.tm = make_manager(self)
+
+    def invoke_exception_view(self, exc_info):
+        return ERROR
+
+
+class DataManager(object):
+    def __init__(self, fail=False):
+        self.fail = fail
+
+    def abort(self, txn):
+        pass
+
+    def tpc_begin(self, txn):
+        pass
+
+    def commit(self, txn):
+        pass
+
+    def tpc_vote(self, txn):
+        if self.fail:
+            raise ValueError('vote failed')
+
+    def tpc_finish(self, txn):
+        pass
+
+    def tpc_abort(self, txn):
+        pass
+
+    def sortKey(self):
+        return 'bench:%d' % id(self)
+
+
+def commit_view(request):
+    request.tm.get().join(DataManager())
+    return OK
+
+
+def empty_view(request):
+    return OK
+
+
+def doom_view(request):
+    request.tm.doom()
+    return OK
+
+
+def error_view(request):
+    return ERROR
+
+
+def squashed_view(request):
+    try:
+        raise ValueError
+    except ValueError as exc:
+        request.exc_info = (ValueError, exc, None)
+    return ERROR
+
+
+def raise_view(request):
+    raise ValueError
+
+
+def failed_commit_view(request):
+    request.tm.get().join(DataManager(fail=True))
+    return OK
+
+
+def bare_view(request):
+    return OK
+
+
+PATHS = {
+    'commit': (commit_view, {}),
+    'commit_empty': (empty_view, {}),
+    'doom': (doom_view, {}),
+    'veto': (error_view, {'tm.commit_veto': pyramid_tm.default_commit_veto}),
+    'veto_status': (error_view, {'tm.veto_status': '4xx,5xx'}),
+    'squashed_exception': (squashed_view, {}),
+    'exception': (raise_view, {}),
+    'inactive': (empty_view, {'tm.activate_hook': lambda request: False}),
+    'commit_failure': (failed_commit_view, {}),
+}
+
+
+# the tween specialized for the configuration and the generic one
+VARIANTS = {
+    'specialized': {},
+    'generic': {'tm.specialize': False},
+}
+
+
+def make_case(view, settings, manager, variant_settings):
+    manager_settings, make_manager = manager
+    registry = Registry()
+    registry.settings = dict(settings, **manager_settings)
+    registry.settings.update(variant_settings)
+    tween = pyramid_tm.tm_tween_factory(view, registry)
+
+    def run():
+        try:
+            tween(Request(registry, make_manager))
+        except ValueError:
+            pass
+
+    def baseline():
+        bare_view(Request(registry, make_manager))
+
+    return run, baseline
+
+
+for manager_name, manager in sorted(MANAGERS.items()):
+    for variant, variant_settings in sorted(VARIANTS.items()):
+        for path, (view, settings) in PATHS.items():
+            run, baseline = make_case(
+                view, settings, manager, variant_settings
+            )
+            suite.add(
+                path,
+                run,
+                baseline=baseline,
+                manager=manager_name,
+                variant=variant,
+            )
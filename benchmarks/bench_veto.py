@@ -0,0 +1,42 @@
+"""
+Cost of a single commit veto evaluation for realistic webob responses.
+
+``default_commit_veto`` is compared with a ``StatusCommitVeto`` implementing
+the same policy.
+"""
+
+from pyramid.response import Response
+
+from harness import Suite
+import pyramid_tm
+
+suite = Suite('veto')
+
+VETOES = {
+    'default': pyramid_tm.default_commit_veto,
+    'status': pyramid_tm.StatusCommitVeto('4xx,5xx'),
+    'status_no_header': pyramid_tm.StatusCommitVeto('4xx,5xx', header=None),
+}
+
+
+def make_response(status, xtm=None):
+    response = Response(status=status)
+    response.headers['Cache-Control'] = 'no-cache'
+    if xtm is not None:
+        response.headers['X-Tm'] = xtm
+    return response
+
+
+RESPONSES = {
+    '200': make_response(200),
+    '500': make_response(500),
+    '500_x_tm_commit': make_response(500, 'commit'),
+}
+
+for veto_name, veto in sorted(VETOES.items()):
+    for response_name, response in sorted(RESPONSES.items()):
+        suite.add(
+            response_name,
+            lambda veto=veto, response=response: veto(None, response),
+            veto=veto_name,
+        )
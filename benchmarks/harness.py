@@ -0,0 +1,117 @@
+"""
+A small benchmark harness emitting machine-readable JSON results.
+
+Each ``bench_*.py`` module in this directory defines a module-level ``suite``
+(a :class:`Suite`) populated with cases. A case is a zero-argument callable
+which is timed, optionally alongside a ``baseline`` callable such that the
+overhead of the code under test can be reported separately from the cost of
+the scaffolding shared by both.
+"""
+
+import json
+import platform
+import statistics
+import sys
+import time
+import timeit
+
+try:
+    from importlib.metadata import version as _dist_version
+except ImportError:  # pragma: no cover
+    _dist_version = None
+
+
+def _version(dist):
+    try:
+        return _dist_version(dist)
+    except Exception:
+        return None
+
+
+class Case(object):
+    def __init__(self, name, fn, baseline=None, params=None):
+        self.name = name
+        self.fn = fn
+        self.baseline = baseline
+        self.params = params or {}
+
+
+class Suite(object):
+    def __init__(self, name):
+        self.name = name
+        self.cases = []
+
+    def add(self, name, fn, baseline=None, **params):
+        self.cases.append(Case(name, fn, baseline, params))
+
+    def run(self, number, repeat, pattern=None):
+        results = []
+        for case in self.cases:
+            fullname = '%s.%s' % (self.name, case.name)
+            if pattern and pattern not in fullname:
+                continue
+            result = {'suite': self.name, 'name': case.name}
+            result.update(case.params)
+            result.update(measure(case.fn, number, repeat))
+            if case.baseline is not None:
+                baseline = measure(case.baseline, number, repeat)
+                result['baseline_ns'] = baseline['ns']
+                result['overhead_ns'] = round(result['ns'] - baseline['ns'], 1)
+            results.append(result)
+        return results
+
+
+def measure(fn, number, repeat):
+    """
+    Return the minimum and median nanoseconds per call of ``fn`` over
+    ``repeat`` runs of ``number`` calls each.
+    """
+    # warm up any caches before timing
+    for _ in range(min(number, 100)):
+        fn()
+    timings = timeit.Timer(fn).repeat(repeat=repeat, number=number)
+    per_call = [t * 1e9 / number for t in timings]
+    return {
+        'ns': round(min(per_call), 1),
+        'median_ns': round(statistics.median(per_call), 1),
+    }
+
+
+def environment():
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'pyramid_tm': _version('pyramid_tm'),
+        'pyramid': _version('pyramid'),
+        'transaction': _version('transaction'),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+    }
+
+
+def _identity(result):
+    # every non-timing field identifies the case
+    return tuple(
+        sorted((k, str(v)) for k, v in result.items() if 'ns' not in k)
+    )
+
+
+def compare(previous, current, out=sys.stderr):
+    """Print the relative change of every case present in both reports."""
+    old = {_identity(r): r for r in previous['results']}
+    for result in current['results']:
+        before = old.get(_identity(result))
+        if before is None or not before['ns']:
+            continue
+        change = (result['ns'] - before['ns']) / before['ns'] * 100
+        label = ' '.join(v for k, v in _identity(result))
+        out.write('%-60s %+7.1f%%\n' % (label, change))
+
+
+def dump(report, path=None):
+    data = json.dumps(report, indent=2, sort_keys=True)
+    if path is None:
+        sys.stdout.write(data + '\n')
+    else:
+        with open(path, 'w') as fp:
+            fp.write(data + '\n')
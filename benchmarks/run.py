@@ -0,0 +1,57 @@
+"""
+Run the pyramid_tm benchmarks and emit the results as JSON.
+
+Usage::
+
+    python benchmarks/run.py [--output FILE] [--compare FILE]
+                             [--number N] [--repeat N] [--filter TEXT]
+
+Or via tox::
+
+    tox -e bench -- --output bench.json
+"""
+
+import argparse
+import glob
+import harness
+import importlib
+import json
+import os
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def load_suites():
+    suites = []
+    for path in sorted(glob.glob(os.path.join(HERE, 'bench_*.py'))):
+        name = os.path.splitext(os.path.basename(path))[0]
+        module = importlib.import_module(name)
+        suites.append(module.suite)
+    return suites
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--output', help='write the JSON report to a file')
+    parser.add_argument(
+        '--compare', help='a previous JSON report to compare against'
+    )
+    parser.add_argument('--number', type=int, default=2000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--filter', help='only run cases matching this text')
+    args = parser.parse_args(argv)
+
+    results = []
+    for suite in load_suites():
+        results.extend(suite.run(args.number, args.repeat, args.filter))
+    report = {'environment': harness.environment(), 'results': results}
+    harness.dump(report, args.output)
+
+    if args.compare:
+        with open(args.compare) as fp:
+            harness.compare(json.load(fp), report)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
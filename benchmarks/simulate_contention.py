@@ -0,0 +1,150 @@
+"""
+Simulate the throughput of workers contending on a hot key with and without
+the backoff hints of ``pyramid_tm.ContentionBackoff`` and emit the results as
+JSON.
+
+Usage::
+
+    python benchmarks/simulate_contention.py [--output FILE]
+                                             [--workers N] [--duration S]
+
+Each simulated worker serves requests in a loop. A request takes ``service``
+seconds, slowed down by ``load`` times the number of other requests writing
+the hot key at the same time to account for the contention of the database.
+It writes the hot key with probability ``hot``, such that it conflicts if
+another request committed the hot key since it began, like an optimistic
+data manager would. A conflicting request is retried up to ``attempts``
+times, immediately or after its backoff hint, and fails afterwards. The
+simulation runs on a virtual clock and is deterministic for a given
+``--seed``.
+"""
+
+import argparse
+import harness
+import heapq
+import random
+import sys
+import transaction
+
+import pyramid_tm
+
+
+class Route(object):
+    name = 'hot'
+
+
+class Request(object):
+    matched_route = Route()
+    tm = transaction.TransactionManager(explicit=True)
+
+
+class Conflict(Exception):
+    pass
+
+
+def simulate(
+    hints, workers, duration, service, load, hot, attempts, seed, base, cap
+):
+    rng = random.Random(seed)
+    clock = [0.0]
+    backoff = pyramid_tm.ContentionBackoff(
+        base=base,
+        cap=cap,
+        random=rng.random,
+        clock=lambda: clock[0],
+    )
+    request = Request()
+    last_commit = -1.0
+    writers = [0]
+    counts = dict.fromkeys(
+        ('commits', 'conflicts', 'failures', 'wasted_s', 'delay_s'), 0
+    )
+
+    def start(worker, now, attempt):
+        writes = rng.random() < hot
+        elapsed = service * (0.5 + rng.random())
+        if writes:
+            elapsed *= 1 + load * writers[0]
+            writers[0] += 1
+        heapq.heappush(events, (now + elapsed, worker, now, attempt, writes))
+
+    events = []
+    for worker in range(workers):
+        start(worker, 0.0, 0)
+    while events:
+        now, worker, began, attempt, writes = heapq.heappop(events)
+        if now > duration:
+            break
+        clock[0] = now
+        if writes:
+            writers[0] -= 1
+        if writes and last_commit > began:
+            counts['conflicts'] += 1
+            counts['wasted_s'] += now - began
+            if attempt + 1 >= attempts:
+                counts['failures'] += 1
+                start(worker, now, 0)
+                continue
+            delay = backoff.hint(request, Conflict()) if hints else 0.0
+            counts['delay_s'] += delay
+            start(worker, now + delay, attempt + 1)
+            continue
+        if writes:
+            last_commit = now
+        counts['commits'] += 1
+        start(worker, now, 0)
+
+    requests = counts['commits'] + counts['failures']
+    return {
+        'suite': 'contention',
+        'name': 'hints' if hints else 'immediate',
+        'workers': workers,
+        'hot': hot,
+        'attempts': attempts,
+        'commits_per_s': round(counts['commits'] / duration, 1),
+        'conflicts_per_s': round(counts['conflicts'] / duration, 1),
+        'failures': counts['failures'],
+        'failure_rate': round(counts['failures'] / max(requests, 1), 4),
+        'wasted_s': round(counts['wasted_s'], 3),
+        'delay_s': round(counts['delay_s'], 3),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--output', help='write the JSON report to a file')
+    parser.add_argument('--workers', type=int, nargs='+', default=[4, 16, 64])
+    parser.add_argument('--duration', type=float, default=60.0)
+    parser.add_argument('--service', type=float, default=0.01)
+    parser.add_argument('--load', type=float, default=0.1)
+    parser.add_argument('--hot', type=float, nargs='+', default=[0.5, 1.0])
+    parser.add_argument('--attempts', type=int, default=3)
+    parser.add_argument('--base', type=float, default=0.005)
+    parser.add_argument('--cap', type=float, default=0.1)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    results = []
+    for workers in args.workers:
+        for hot in args.hot:
+            for hints in (False, True):
+                results.append(
+                    simulate(
+                        hints,
+                        workers,
+                        args.duration,
+                        args.service,
+                        args.load,
+                        hot,
+                        args.attempts,
+                        args.seed,
+                        args.base,
+                        args.cap,
+                    )
+                )
+    report = {'environment': harness.environment(), 'results': results}
+    harness.dump(report, args.output)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,11 +1,48 @@
+import collections
+import functools
+import operator
+import os
 from pyramid.exceptions import ConfigurationError, NotFound
-from pyramid.settings import asbool
+from pyramid.interfaces import IRoutesMapper
+from pyramid.settings import aslist, falsey, truthy
 from pyramid.tweens import EXCVIEW
 from pyramid.util import DottedNameResolver
 import sys
+import threading
+from time import monotonic
 import transaction
+from transaction.interfaces import NoTransaction
 import warnings
 import zope.interface
+from zope.interface.declarations import Provides
+
+from pyramid_tm.backoff import (  # noqa: F401
+    ContentionBackoff,
+    get_backoff_hint,
+    sleep_before_retry,
+)
+from pyramid_tm.contention import (  # noqa: F401
+    ContentionTracker,
+    contention_report_view,
+    get_contention_report,
+)
+from pyramid_tm.hooks import (  # noqa: F401
+    AfterCommitExecutor,
+    add_async_after_commit_hook,
+    get_after_commit_stats,
+    shutdown_after_commit_hooks,
+)
+from pyramid_tm.pool import ManagerPool, pooled_explicit_manager  # noqa: F401
+from pyramid_tm.profile import Profiler
+from pyramid_tm.readonly import (  # noqa: F401
+    ReadOnlyRoutes,
+    dump_readonly_routes,
+    get_readonly_routes,
+    is_tm_readonly,
+    tm_readonly_view,
+)
+from pyramid_tm.slowlog import SlowLog, log_slow_transaction
+from pyramid_tm.stats import Stats, format_stats, get_stats  # noqa: F401
 
 try:
     from pyramid_retry import IRetryableError
@@ -17,6 +54,28 @@ try:
 except ImportError:  # pragma: no cover
     mark_error_retryable = lambda error: None
 
+try:
+    from pyramid_retry import is_last_attempt
+except ImportError:  # pragma: no cover
+    is_last_attempt = lambda request: True
+
+try:
+    from pyramid_retry import IBeforeRetry
+except ImportError:  # pragma: no cover
+    IBeforeRetry = None
+
+try:
+    from transaction._transaction import Status
+except ImportError:  # pragma: no cover
+    Status = None
+
+# the fast commit relies on the internals of transaction.Transaction, use
+# the regular commit with a version which does not provide them
+_fast_commit_supported = Status is not None and all(
+    hasattr(transaction.Transaction, name)
+    for name in ('_callBeforeCommitHooks', '_callAfterCommitHooks', '_free')
+)
+
 mark_error_retryable(transaction.interfaces.TransientError)
 
 resolver = DottedNameResolver(None)
@@ -40,6 +99,111 @@ def default_commit_veto(request, response):
     return response.status.startswith(('4', '5'))
 
 
+def annotate_user(request, txn):
+    """
+    A transaction annotator which sets ``txn.user`` to the
+    ``request.authenticated_userid``, if there is one.
+    """
+    userid = request.authenticated_userid
+    if userid:
+        txn.user = str(userid)
+
+
+def annotate_path(request, txn):
+    """
+    A transaction annotator which adds the ``request.path_info`` to the
+    transaction's note.
+    """
+    try:
+        txn.note(request.path_info)
+    except UnicodeDecodeError:
+        txn.note("Unable to decode path as unicode")
+
+
+def _parse_statuses(spec):
+    included = set()
+    excluded = set()
+    for token in spec.replace(',', ' ').split():
+        codes = excluded if token.startswith('!') else included
+        value = token.lstrip('!').lower()
+        try:
+            if len(value) == 3 and value.endswith('xx'):
+                start = int(value[0]) * 100
+                end = start + 99
+            elif '-' in value:
+                start, end = (int(x) for x in value.split('-', 1))
+            else:
+                start = end = int(value)
+        except ValueError:
+            start = end = 0
+        if not 100 <= start <= end <= 599:
+            raise ConfigurationError(
+                'Invalid status "%s" in commit veto status specification '
+                '"%s".' % (token, spec)
+            )
+        codes.update(range(start, end + 1))
+    return included - excluded
+
+
+class StatusCommitVeto(object):
+    """
+    A commit veto compiled from a declarative specification of the response
+    status codes that should abort the transaction.
+
+    ``statuses`` is a string of comma or whitespace separated tokens. A
+    token is a single status code such as ``409``, a class of status codes
+    such as ``5xx``, or a range such as ``400-403``. Prefixing a token with
+    ``!`` excludes it, for example ``4xx,5xx,!409``.
+
+    If ``header`` is not ``None`` then, just like
+    :func:`pyramid_tm.default_commit_veto`, a response header by that name
+    takes precedence over the status: the transaction is committed if its
+    value is ``commit`` and aborted otherwise.
+
+    The statuses are compiled into a set of status code prefixes up front,
+    so the veto is a single lookup on ``response.status`` per request.
+    """
+
+    def __init__(self, statuses, header='x-tm'):
+        self.codes = frozenset(str(code) for code in _parse_statuses(statuses))
+        self.header = header.lower() if header else None
+
+    def _get_header(self, response):
+        header = self.header
+        headerlist = getattr(response, 'headerlist', None)
+        if headerlist is None:
+            return response.headers.get(header)
+        # avoid the case-insensitive multidict wrapper of webob responses
+        size = len(header)
+        for name, value in headerlist:
+            if len(name) == size and name.lower() == header:
+                return value
+
+    def __call__(self, request, response):
+        if self.header is not None:
+            xtm = self._get_header(response)
+            if xtm is not None:
+                return xtm != 'commit'
+        return response.status[:3] in self.codes
+
+
+class TransactionTimeout(Exception):
+    """
+    Raised by the ``pyramid_tm`` tween when the handler returned after the
+    deadline set by the ``tm.timeout`` setting, once the transaction has been
+    aborted. The ``timeout`` attribute is the exceeded timeout in seconds.
+
+    It is rendered by an exception view registered for it if there is one,
+    and is retryable if the ``tm.timeout_retryable`` setting is enabled.
+    """
+
+    def __init__(self, timeout):
+        super(TransactionTimeout, self).__init__(
+            'The transaction exceeded its timeout of %gs.' % (timeout,)
+        )
+        self.timeout = timeout
+
+
 class AbortWithResponse(Exception):
     """Abort the transaction but return a pre-baked response."""
 
@@ -47,15 +211,441 @@ class AbortWithResponse(Exception):
         self.response = response
 
 
-def tm_tween_factory(handler, registry):
-    settings = registry.settings
+class LazyTransactionManager(object):
+    """
+    A proxy around a transaction manager which defers ``begin()`` until the
+    transaction is actually needed.
+
+    The proxy behaves as if ``begin()`` had already been called on the
+    wrapped ``manager``. The real transaction is only started the first time
+    it is requested via ``get()`` (which is how data managers join the
+    transaction), ``doom()`` or ``savepoint()``. If the transaction is
+    completed via ``commit()`` or ``abort()`` before it was ever started then
+    there is nothing to do and the call is a no-op.
+
+    A transaction begun on the wrapped ``manager`` directly, for example
+    implicitly by a resource joining through the global ``transaction.get()``
+    of the threadlocal manager, is adopted by the proxy as if it had been
+    begun by it, such that it is completed along with any resource joining
+    via the proxy. A transaction left over on a non-explicit ``manager`` when
+    the proxy is created is aborted, like ``begin()`` would, and is never
+    adopted.
+
+    This is the manager bound to ``request.tm`` when the ``tm.lazy_begin``
+    setting is enabled.
+    """
+
+    def __init__(self, manager):
+        self.manager = manager
+        self._pending = True
+        self._stale = _current_transaction(manager)
+        if self._stale is not None and not manager.explicit:
+            # discard the leftovers of an unmanaged request, like begin()
+            self._stale.abort()
+            self._stale = None
+
+    @property
+    def pending(self):
+        if self._pending:
+            txn = _current_transaction(self.manager)
+            if txn is not None and txn is not self._stale:
+                # adopt the transaction begun behind the back of the proxy
+                self._pending = False
+        return self._pending
+
+    def begin(self):
+        if self._pending:
+            self._pending = False
+            txn = _current_transaction(self.manager)
+            if txn is not None and txn is not self._stale:
+                return txn
+        # an explicit manager refuses to begin over a stale transaction
+        return self.manager.begin()
+
+    def get(self):
+        if self.pending:
+            return self.begin()
+        return self.manager.get()
+
+    def isDoomed(self):
+        if self.pending:
+            return False
+        return self.manager.isDoomed()
+
+    def doom(self):
+        return self.get().doom()
+
+    def savepoint(self, optimistic=False):
+        return self.get().savepoint(optimistic)
+
+    def commit(self):
+        if self.pending:
+            self._pending = False
+            return
+        return self.manager.commit()
+
+    def abort(self):
+        if self.pending:
+            self._pending = False
+            return
+        return self.manager.abort()
+
+    def __getattr__(self, name):
+        return getattr(self.manager, name)
+
+
+class Counters(object):
+    """
+    A thread-safe set of named event counters kept per registry. See
+    :func:`pyramid_tm.get_counters`.
+
+    Every thread counts into its own shard so that counting never contends
+    on a lock, like :class:`pyramid_tm.stats.Stats`.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._shards = []
+
+    def _shard(self):
+        try:
+            return self._local.values
+        except AttributeError:
+            values = self._local.values = collections.Counter()
+            with self._lock:
+                self._shards.append(values)
+            return values
+
+    def incr(self, name):
+        self._shard()[name] += 1
+
+    def snapshot(self):
+        with self._lock:
+            shards = list(self._shards)
+        values = collections.Counter()
+        for shard in shards:
+            values.update(dict(list(shard.items())))
+        return dict(values)
+
+
+class RetryableCache(object):
+    """
+    A bounded cache of retryable exception classifications, keyed by the
+    type of the exception and the types of the resources joined to the
+    transaction, in order. Once ``maxsize`` entries are stored the oldest
+    one is evicted.
+
+    A data manager implementing ``should_retry`` must opt into caching by
+    setting ``should_retry_cacheable = True`` on its class, declaring that
+    its answer only depends on the type of the exception. Transactions
+    joined by any other data manager implementing ``should_retry`` are
+    always classified by ``txn.isRetryableError``.
+    """
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def classify(self, txn, exc):
+        resources = txn._resources
+        key = (type(exc),) + tuple(map(type, resources))
+        result = self._values.get(key)
+        if result is not None:
+            return result
+
+        result = bool(txn.isRetryableError(exc))
+        for dm in resources:
+            if hasattr(dm, 'should_retry') and not getattr(
+                dm, 'should_retry_cacheable', False
+            ):
+                return result
+        with self._lock:
+            if len(self._values) >= self.maxsize:
+                del self._values[next(iter(self._values))]
+            self._values[key] = result
+        return result
+
+
+def get_counters(registry):
+    """
+    Return a ``dict`` of the event counters recorded by the ``pyramid_tm``
+    tween for the application using ``registry``.
+
+    - ``fast_commit``: the number of commits which completed without a
+      two-phase commit because no resources had joined the transaction.
+
+    - ``timeout``: the number of transactions which were aborted because the
+      handler returned after their deadline.
+
+    - ``subrequest_rollback``: the number of subrequests whose savepoint was
+      rolled back, see ``tm.savepoint_subrequests``.
+
+    - ``subrequest_shared``: the number of subrequests which shared the
+      transaction without a savepoint because a joined resource does not
+      support savepoints.
+    """
+    counters = registry.get('pyramid_tm.counters')
+    if counters is None:
+        return {}
+    return counters.snapshot()
+
+
+def _fast_commit(txn):
+    """
+    Commit ``txn`` without running the two-phase commit if no resources have
+    joined it. Any registered before-commit and after-commit hooks are still
+    invoked. Returns ``True`` if the transaction was completed, or ``False``
+    if it must be committed normally.
+    """
+    if (
+        not _fast_commit_supported
+        or not isinstance(txn, transaction.Transaction)
+        or getattr(txn, 'status', None) is not Status.ACTIVE
+        # a missing attribute is treated as in use
+        or getattr(txn, '_resources', True)
+        or getattr(txn, '_synchronizers', True)
+        or getattr(txn, '_savepoint2index', True)
+    ):
+        return False
+
+    # a before-commit hook may still cause a resource to join
+    txn._callBeforeCommitHooks()
+    if txn._resources:
+        return False
+
+    txn.status = Status.COMMITTED
+    txn._callAfterCommitHooks(status=True)
+    txn._free()
+    return True
+
+
+_Policy = collections.namedtuple(
+    '_Policy',
+    ['activate', 'commit_veto', 'annotators', 'stream', 'lazy', 'timeout'],
+)
+
+
+class _TransactionAppIter(object):
+    """
+    Wraps the ``app_iter`` of a streamed response such that the transaction
+    is completed only after the body has been produced.
+
+    ``complete`` is invoked exactly once with ``failed=False`` when the body
+    was exhausted, or with ``failed=True`` if producing the body raised an
+    exception or the server closed the iterator before it was exhausted.
+    """
+
+    def __init__(self, app_iter, complete):
+        self.app_iter = app_iter
+        self.complete = complete
+
+    def _complete(self, failed):
+        complete, self.complete = self.complete, None
+        if complete is not None:
+            complete(failed)
+
+    def __iter__(self):
+        try:
+            for chunk in self.app_iter:
+                yield chunk
+        except Exception:
+            self._complete(True)
+            raise
+        self._complete(False)
+
+    def close(self):
+        try:
+            close = getattr(self.app_iter, 'close', None)
+            if close is not None:
+                close()
+        finally:
+            self._complete(True)
+
+
+def _parse_timeout(value, name):
+    if value in (None, ''):
+        return None
+    try:
+        timeout = float(value)
+    except (TypeError, ValueError):
+        timeout = -1
+    if isinstance(value, bool) or timeout < 0:
+        raise ConfigurationError(
+            'The %s value must be a number of seconds, not %r.' % (name, value)
+        )
+    return timeout or None
+
+
+def set_tm_policy(
+    config,
+    route_name,
+    activate=None,
+    commit_veto=None,
+    annotators=None,
+    stream=None,
+    timeout=None,
+):
+    """
+    A :term:`configuration directive` registered as ``set_tm_policy`` which
+    overrides how ``pyramid_tm`` manages requests matching the route named
+    ``route_name``. Any argument left as ``None`` falls back to the global
+    setting.
+
+    - ``activate`` is ``True`` or ``False`` and replaces the
+      ``tm.activate_hook`` for the route.
+
+    - ``commit_veto`` is a callable or :term:`dotted Python name` which
+      replaces the ``tm.commit_veto`` for the route.
+
+    - ``annotators`` is a list of callables or :term:`dotted Python name`
+      values which replaces the ``tm.annotators`` for the route.
+
+    - ``stream`` is ``True`` or ``False`` and replaces the ``tm.stream``
+      setting for the route.
+
+    - ``timeout`` is a number of seconds which replaces the ``tm.timeout``
+      setting for the route, ``0`` disables the deadline.
+
+    Policies are compiled into a table keyed by route name when the tween is
+    created, so finding the policy for a request costs a single lookup.
+
+    .. note::
+
+       The route is matched by the router *after* the tween has started.
+       If any policy sets ``activate`` or ``timeout`` then the tween will
+       match the request against the routes itself before calling the
+       handler.
+    """
+    overrides = {}
+    for name, value in (('activate', activate), ('stream', stream)):
+        if value is not None:
+            if not isinstance(value, bool):
+                raise ConfigurationError(
+                    'The "%s" tm policy value must be True, False or None.'
+                    % name
+                )
+            overrides[name] = value
+    if timeout is not None:
+        overrides['timeout'] = _parse_timeout(timeout, 'timeout tm policy')
+    if commit_veto is not None:
+        overrides['commit_veto'] = config.maybe_dotted(commit_veto)
+    if annotators is not None:
+        if isinstance(annotators, str):
+            annotators = aslist(annotators)
+        overrides['annotators'] = [config.maybe_dotted(x) for x in annotators]
+
+    def register():
+        policies = config.registry.setdefault('pyramid_tm.policies', {})
+        policies[route_name] = overrides
+
+    config.action(('pyramid_tm.policy', route_name), register)
+
+
+_Settings = collections.namedtuple(
+    '_Settings',
+    [
+        'commit_veto',
+        'activate_hook',
+        'annotators',
+        'lazy_begin',
+        'stream',
+        'timeout',
+        'timeout_retryable',
+        'savepoint_subrequests',
+        'readonly_warn_joins',
+        'readonly_routes',
+        'readonly_window',
+        'readonly_table',
+        'stats',
+        'slow_threshold',
+        'slow_sink',
+        'profile_dir',
+        'profile_rate',
+        'profile_routes',
+        'profile_keep',
+        'retryable_cache_size',
+        'backoff',
+        'backoff_window',
+        'backoff_base',
+        'backoff_max',
+        'backoff_size',
+        'backoff_sleep',
+        'contention',
+        'contention_size',
+        'manager_hook',
+        'pool_size',
+        'pool_debug',
+        'after_commit_workers',
+        'after_commit_queue',
+        'after_commit_drain_timeout',
+        'specialize',
+    ],
+)
+
+
+def _convert(settings, name, convert, default):
+    value = settings.get(name)
+    if value is None or value == '':
+        return default
+    try:
+        return convert(value)
+    except (TypeError, ValueError):
+        raise ConfigurationError(
+            'The "%s" setting is invalid: %r.' % (name, value)
+        )
+
+
+def _asbool(value):
+    # unlike pyramid.settings.asbool, an unrecognized string is an error
+    # rather than False such that a typo does not silently disable a setting
+    if isinstance(value, bool):
+        return value
+    value = str(value).strip().lower()
+    if value in truthy:
+        return True
+    if value in falsey:
+        return False
+    raise ValueError(value)
+
+
+def _parse_settings(settings):
+    """
+    Validate the ``tm.*`` settings and resolve their dotted names into an
+    immutable ``_Settings``, such that configuration errors are reported
+    when the application starts and requests do not parse anything.
+    """
     maybe_resolve = lambda val: resolver.maybe_resolve(val) if val else None
     old_commit_veto = settings.get('pyramid_tm.commit_veto', None)
-    commit_veto = settings.get('tm.commit_veto', old_commit_veto)
-    activate_hook = settings.get('tm.activate_hook')
-    commit_veto = maybe_resolve(commit_veto)
-    activate_hook = maybe_resolve(activate_hook)
-    annotate_user = asbool(settings.get('tm.annotate_user', True))
+    commit_veto = maybe_resolve(
+        settings.get('tm.commit_veto', old_commit_veto)
+    )
+    veto_status = settings.get('tm.veto_status')
+    if veto_status:
+        if commit_veto is not None:
+            raise ConfigurationError(
+                'The "tm.veto_status" and "tm.commit_veto" settings '
+                'cannot be used together.'
+            )
+        commit_veto = StatusCommitVeto(
+            veto_status, settings.get('tm.veto_header', 'x-tm')
+        )
+    annotators = settings.get('tm.annotators')
+    if annotators is None:
+        annotators = (annotate_path,)
+        if _convert(settings, 'tm.annotate_user', _asbool, True):
+            annotators = (annotate_user,) + annotators
+    else:
+        if isinstance(annotators, str):
+            annotators = aslist(annotators)
+        annotators = tuple(resolver.maybe_resolve(x) for x in annotators)
+    readonly_routes = settings.get('tm.readonly_routes') or None
+    if readonly_routes not in (None, 'observe', 'adaptive'):
+        raise ConfigurationError(
+            'The "tm.readonly_routes" setting must be "observe" or '
+            '"adaptive", not "%s".' % (readonly_routes,)
+        )
 
     if 'tm.attempts' in settings:  # pragma: no cover
         warnings.warn(
@@ -64,12 +654,167 @@ def tm_tween_factory(handler, registry):
             'add pyramid_retry to your application.'
         )
 
+    return _Settings(
+        commit_veto=commit_veto,
+        activate_hook=maybe_resolve(settings.get('tm.activate_hook')),
+        annotators=annotators,
+        lazy_begin=_convert(settings, 'tm.lazy_begin', _asbool, False),
+        stream=_convert(settings, 'tm.stream', _asbool, False),
+        timeout=_parse_timeout(settings.get('tm.timeout'), '"tm.timeout"'),
+        timeout_retryable=_convert(
+            settings, 'tm.timeout_retryable', _asbool, False
+        ),
+        savepoint_subrequests=_convert(
+            settings, 'tm.savepoint_subrequests', _asbool, False
+        ),
+        readonly_warn_joins=_convert(
+            settings, 'tm.readonly_warn_joins', _asbool, False
+        ),
+        readonly_routes=readonly_routes,
+        readonly_window=_convert(settings, 'tm.readonly_window', int, 100),
+        readonly_table=settings.get('tm.readonly_table') or None,
+        stats=_convert(settings, 'tm.stats', _asbool, False),
+        slow_threshold=_convert(
+            settings, 'tm.slow_threshold_ms', lambda x: float(x) / 1000, None
+        ),
+        slow_sink=maybe_resolve(settings.get('tm.slow_sink'))
+        or log_slow_transaction,
+        profile_dir=settings.get('tm.profile_dir') or None,
+        profile_rate=_convert(settings, 'tm.profile_rate', float, 0.0),
+        profile_routes=tuple(aslist(settings.get('tm.profile_routes', ''))),
+        profile_keep=_convert(settings, 'tm.profile_keep', int, 100),
+        retryable_cache_size=_convert(
+            settings, 'tm.retryable_cache_size', int, 0
+        ),
+        backoff=_convert(settings, 'tm.backoff', _asbool, False),
+        backoff_window=_convert(settings, 'tm.backoff_window', float, 1.0),
+        backoff_base=_convert(settings, 'tm.backoff_base', float, 0.005),
+        backoff_max=_convert(settings, 'tm.backoff_max', float, 0.1),
+        backoff_size=_convert(settings, 'tm.backoff_size', int, 256),
+        backoff_sleep=_convert(settings, 'tm.backoff_sleep', _asbool, False),
+        contention=_convert(settings, 'tm.contention', _asbool, False),
+        contention_size=_convert(settings, 'tm.contention_size', int, 1000),
+        manager_hook=maybe_resolve(settings.get('tm.manager_hook')),
+        pool_size=_convert(settings, 'tm.pool_size', int, 8),
+        pool_debug=_convert(settings, 'tm.pool_debug', _asbool, False),
+        after_commit_workers=_convert(
+            settings, 'tm.after_commit_workers', int, 0
+        ),
+        after_commit_queue=_convert(
+            settings, 'tm.after_commit_queue', int, 100
+        ),
+        after_commit_drain_timeout=_convert(
+            settings, 'tm.after_commit_drain_timeout', float, 10.0
+        ),
+        specialize=_convert(settings, 'tm.specialize', _asbool, True),
+    )
+
+
+def tm_tween_factory(handler, registry):
+    tm_settings = registry.get('pyramid_tm.settings')
+    if tm_settings is None:
+        # pyramid_tm was not included, see includeme
+        tm_settings = _parse_settings(registry.settings)
+    activate_hook = tm_settings.activate_hook
+    lazy_begin = tm_settings.lazy_begin
+    timeout_retryable = tm_settings.timeout_retryable
+    savepoint_subrequests = tm_settings.savepoint_subrequests
+
+    default_policy = _Policy(
+        None,
+        tm_settings.commit_veto,
+        tm_settings.annotators,
+        tm_settings.stream,
+        lazy_begin,
+        tm_settings.timeout,
+    )
+    route_policies = {
+        name: default_policy._replace(**overrides)
+        for name, overrides in registry.get('pyramid_tm.policies', {}).items()
+    }
+    readonly_routes = None
+    if tm_settings.readonly_routes:
+        readonly_routes = registry.setdefault(
+            'pyramid_tm.readonly_routes',
+            ReadOnlyRoutes(
+                tm_settings.readonly_window,
+                tm_settings.readonly_routes == 'adaptive',
+            ),
+        )
+        readonly_table = tm_settings.readonly_table
+        if readonly_table and os.path.exists(readonly_table):
+            with open(readonly_table) as fp:
+                readonly_routes.load(fp)
+    adaptive = readonly_routes is not None and readonly_routes.adaptive
+    lazy_policies = {}
+    routes_mapper = registry.queryUtility(IRoutesMapper)
+    # policies which must be known before the handler runs
+    match_routes = routes_mapper is not None and (
+        adaptive
+        or any(
+            'activate' in overrides or 'timeout' in overrides
+            for overrides in registry.get('pyramid_tm.policies', {}).values()
+        )
+    )
+    counters = registry.setdefault('pyramid_tm.counters', Counters())
+    stats = None
+    if tm_settings.stats:
+        stats = registry.setdefault('pyramid_tm.stats', Stats())
+    slow_log = None
+    if tm_settings.slow_threshold is not None:
+        slow_log = SlowLog(tm_settings.slow_threshold, tm_settings.slow_sink)
+    profiler = None
+    if tm_settings.profile_dir:
+        profiler = Profiler(
+            tm_settings.profile_dir,
+            tm_settings.profile_rate,
+            list(tm_settings.profile_routes),
+            tm_settings.profile_keep,
+            routes_mapper,
+        )
+    retryable_cache = None
+    if tm_settings.retryable_cache_size > 0:
+        retryable_cache = RetryableCache(tm_settings.retryable_cache_size)
+    backoff = None
+    if tm_settings.backoff:
+        backoff = registry.setdefault(
+            'pyramid_tm.backoff',
+            ContentionBackoff(
+                tm_settings.backoff_window,
+                tm_settings.backoff_base,
+                tm_settings.backoff_max,
+                tm_settings.backoff_size,
+                tm_settings.backoff_sleep,
+            ),
+        )
+    contention = None
+    if tm_settings.contention:
+        contention = registry.setdefault(
+            'pyramid_tm.contention',
+            ContentionTracker(tm_settings.contention_size),
+        )
+    pool = None
+    if tm_settings.manager_hook is pooled_explicit_manager:
+        pool = registry.setdefault(
+            'pyramid_tm.manager_pool',
+            ManagerPool(tm_settings.pool_size, tm_settings.pool_debug),
+        )
+    if tm_settings.after_commit_workers > 0:
+        registry.setdefault(
+            'pyramid_tm.after_commit_executor',
+            AfterCommitExecutor(
+                tm_settings.after_commit_workers,
+                tm_settings.after_commit_queue,
+                tm_settings.after_commit_drain_timeout,
+            ),
+        )
+
     # define a finish function that we'll call from every branch to
     # commit or abort the transaction - this can't be in a finally because
     # we only want the finisher to wrap commit/abort which occur in several
     # disparate branches below and we want to avoid catching errors from
     # non commit/abort related operations
-    def _finish(request, finisher, response=None):
+    def _deactivate(request):
         # ensure the manager is inactive prior to invoking the finisher
         # such that when we handle any possible exceptions it is ready
         environ = request.environ
@@ -78,6 +823,15 @@ def tm_tween_factory(handler, registry):
         if 'tm.manager' in environ:
             del environ['tm.manager']
 
+        # unbind the lazy proxy such that the request is left with the
+        # real manager just like in the non-lazy case
+        manager = request.tm
+        if isinstance(manager, LazyTransactionManager):
+            request.tm = manager.manager
+
+    def _finish(request, finisher, response=None):
+        _deactivate(request)
+
         try:
             finisher()
 
@@ -86,26 +840,241 @@ def tm_tween_factory(handler, registry):
         except Exception:
             exc_info = sys.exc_info()
             try:
-                if hasattr(request, 'invoke_exception_view'):  # pyramid >= 1.7
-                    response = request.invoke_exception_view(exc_info)
-
-                else:  # pragma: no cover
-                    raise NotFound
-
-            except NotFound:
-                # since commit/abort has already been executed it's highly
-                # likely we will not detect any backend-specific retryable
-                # issues here unless they directly subclass TransientError
-                # since the manager has cleared its list of data mangers at
-                # this point
-                maybe_tag_retryable(request, exc_info)
-                raise exc_info[1] from None
+                # an error response would be discarded if the request is
+                # going to be retried so avoid rendering it
+                if will_retry(request, exc_info):
+                    raise exc_info[1] from None
+
+                response = _invoke_exception_view(request, exc_info)
+                if response is None:
+                    # since commit/abort has already been executed it's
+                    # highly likely we will not detect any backend-specific
+                    # retryable issues here unless they directly subclass
+                    # TransientError since the manager has cleared its list
+                    # of data mangers at this point
+                    tag_retryable(request, exc_info)
+                    raise exc_info[1] from None
 
             finally:
                 del exc_info  # avoid leak
+                _abort_failed_commit(request.tm)
 
+        if pool is not None:
+            pool.release(request.tm)
         return response
 
+    def will_retry(request, exc_info):
+        if is_last_attempt(request):
+            return False
+        tag_retryable(request, exc_info)
+        return IRetryableError.providedBy(exc_info[1])
+
+    def should_abort(request, manager, commit_veto, response):
+        if is_doomed(manager):
+            return True
+
+        if commit_veto is not None:
+            if commit_veto(request, response):
+                return True
+
+        # check for a squashed exception and handle it
+        # this would happen if an exception view was invoked and
+        # rendered an error response
+        exc_info = getattr(request, 'exc_info', None)
+        if exc_info is not None:
+            tag_retryable(request, exc_info)
+            if commit_veto is None:
+                return True
+
+        return False
+
+    def complete_stream(request, manager, policy, response, failed):
+        # the response has already been started so it is too late to render
+        # an exception view, errors are propagated to the server instead
+        finisher = functools.partial(abort, request, manager)
+        try:
+            if not failed and not should_abort(
+                request, manager, policy.commit_veto, response
+            ):
+                finisher = functools.partial(
+                    commit, request, manager, policy.annotators
+                )
+        finally:
+            _deactivate(request)
+            try:
+                finisher()
+            except Exception:
+                _abort_failed_commit(request.tm)
+                raise
+            if pool is not None:
+                pool.release(request.tm)
+
+    def commit(request, manager, annotators):
+        if not (
+            isinstance(manager, LazyTransactionManager) and manager.pending
+        ):
+            txn = manager.get()
+            # skip the two-phase commit entirely if nothing joined the
+            # transaction, which is the common case for read-only requests
+            if _fast_commit(txn):
+                counters.incr('fast_commit')
+                return
+            if annotators:
+                txn.addBeforeCommitHook(annotate, (request, txn, annotators))
+        manager.commit()
+
+    def abort(request, manager):
+        manager.abort()
+
+    def expire(request, manager, timeout):
+        abort(request, manager)
+        counters.incr('timeout')
+        exc = TransactionTimeout(timeout)
+        if timeout_retryable:
+            tag_error_retryable(exc)
+        raise exc
+
+    def run_nested(request):
+        # a subrequest of a managed request runs in a savepoint of the outer
+        # transaction such that a failure only rolls back its own changes
+        manager = request.tm
+        request.invoke_subrequest = functools.partial(
+            _invoke_nested_subrequest, request.invoke_subrequest, manager
+        )
+        savepoint = _savepoint(manager)
+        if savepoint is None:
+            counters.incr('subrequest_shared')
+        try:
+            response = handler(request)
+        except Exception:
+            tag_retryable(request, sys.exc_info())
+            rollback(savepoint)
+            raise
+
+        # the changes of a read-only view are discarded, see mark_tm_readonly
+        if request.environ.get('tm.readonly'):
+            rollback(savepoint)
+            return response
+        policy = default_policy
+        if route_policies:
+            route = getattr(request, 'matched_route', None)
+            if route is not None:
+                policy = route_policies.get(route.name, default_policy)
+        if should_abort(request, manager, policy.commit_veto, response):
+            rollback(savepoint)
+        return response
+
+    def rollback(savepoint):
+        if savepoint is None:
+            # the subrequest shares the transaction, nothing to roll back
+            return
+        savepoint.rollback()
+        counters.incr('subrequest_rollback')
+
+    def annotate(request, txn, annotators):
+        # annotations are only useful on a transaction that will actually
+        # record something, avoid addressing the authentication policy and
+        # other potentially expensive lookups otherwise
+        if isinstance(txn, transaction.Transaction) and not txn._resources:
+            return
+        for annotator in annotators:
+            annotator(request, txn)
+
+    def match_policy(request):
+        # routes are only matched by the router below the tweens so match
+        # them here if a policy needs to be known before the handler runs
+        route = routes_mapper(request)['route']
+        if route is None:
+            return default_policy
+        policy = route_policies.get(route.name, default_policy)
+        if adaptive and readonly_routes.is_readonly(route.name):
+            # begin lazily such that nothing is done unless a resource joins
+            lazy_policy = lazy_policies.get(route.name)
+            if lazy_policy is None:
+                lazy_policy = lazy_policies[route.name] = policy._replace(
+                    lazy=True
+                )
+            return lazy_policy
+        return policy
+
+    # the individual operations performed by the tween are swapped for
+    # instrumented versions when statistics are enabled, such that they do
+    # not cost anything otherwise
+    begin = operator.methodcaller('begin')
+    is_doomed = operator.methodcaller('isDoomed')
+    tag_retryable = functools.partial(
+        maybe_tag_retryable, cache=retryable_cache
+    )
+    # the handler of the requests whose transaction is managed by the tween,
+    # the others are passed through to the plain handler
+    managed_handler = handler
+
+    if stats is not None:
+
+        def instrument_policy(policy):
+            if policy.commit_veto is None:
+                return policy
+            commit_veto = stats.instrument(
+                policy.commit_veto, 'veto', on_true='veto'
+            )
+            return policy._replace(commit_veto=commit_veto)
+
+        def tag_retryable(request, exc_info):
+            maybe_tag_retryable(request, exc_info, retryable_cache)
+            if IRetryableError.providedBy(exc_info[1]):
+                stats.incr('retryable')
+
+        managed_handler = stats.instrument(
+            managed_handler, 'handler', on_error='exception'
+        )
+        begin = stats.instrument(begin, 'begin')
+        is_doomed = stats.instrument(is_doomed, on_true='doom')
+        commit = stats.instrument(commit, 'commit', on_success='commit')
+        abort = stats.instrument(abort, 'abort', on_success='abort')
+        default_policy = instrument_policy(default_policy)
+        route_policies = {
+            name: instrument_policy(policy)
+            for name, policy in route_policies.items()
+        }
+
+    if backoff is not None:
+        tag_retryable_without_hint = tag_retryable
+
+        def tag_retryable(request, exc_info):
+            tag_retryable_without_hint(request, exc_info)
+            if IRetryableError.providedBy(exc_info[1]):
+                backoff.hint(request, exc_info[1])
+
+    if contention is not None:
+        tag_retryable_untracked = tag_retryable
+
+        def tag_retryable(request, exc_info):
+            tag_retryable_untracked(request, exc_info)
+            if IRetryableError.providedBy(exc_info[1]):
+                contention.record(request, exc_info[1])
+
+        def will_retry(request, exc_info):
+            # classify commit failures on the last attempt as well such
+            # that the conflicts rendered by an exception view are recorded
+            tag_retryable(request, exc_info)
+            if is_last_attempt(request):
+                return False
+            return IRetryableError.providedBy(exc_info[1])
+
+    if profiler is not None:
+        managed_handler = profiler.profile_handler(managed_handler)
+        commit = profiler.profile_completion(commit, 'commit')
+        abort = profiler.profile_completion(abort, 'abort')
+
+    if readonly_routes is not None:
+        commit = readonly_routes.observe_completion(commit)
+        abort = readonly_routes.observe_completion(abort)
+
+    if slow_log is not None:
+        managed_handler = slow_log.time_handler(managed_handler)
+        commit = slow_log.time_completion(commit, 'commit')
+        abort = slow_log.time_completion(abort, 'abort')
+
     def tm_tween(request):
         environ = request.environ
         if (
@@ -114,70 +1083,165 @@ def tm_tween_factory(handler, registry):
             or
             # pyramid_tm should only be active once
             'tm.active' in environ
-            or
-            # check activation hooks
-            activate_hook is not None
-            and not activate_hook(request)
         ):
+            if 'tm.nested' in environ:
+                return run_nested(request)
+            return handler(request)
+
+        policy = match_policy(request) if match_routes else default_policy
+        activate = policy.activate
+        if activate is None:
+            # check activation hooks
+            activate = activate_hook is None or activate_hook(request)
+        if not activate:
             return handler(request)
 
         # grab a reference to the manager
         manager = request.tm
+        if policy.lazy:
+            manager = request.tm = LazyTransactionManager(manager)
 
         # mark the environ as being managed by pyramid_tm
         environ['tm.active'] = True
         environ['tm.manager'] = manager
 
-        t = manager.begin()
-
-        try:
-            # do not address the authentication policy until we are within
-            # the transaction boundaries
-            if annotate_user:
-                userid = request.authenticated_userid
-                if userid:
-                    t.user = str(userid)
-            try:
-                t.note(request.path_info)
-            except UnicodeDecodeError:
-                t.note("Unable to decode path as unicode")
+        if savepoint_subrequests:
+            request.invoke_subrequest = functools.partial(
+                _invoke_nested_subrequest, request.invoke_subrequest, manager
+            )
 
-            response = handler(request)
-            if manager.isDoomed():
-                raise AbortWithResponse(response)
+        deadline = None
+        if policy.timeout is not None:
+            deadline = environ['tm.deadline'] = monotonic() + policy.timeout
 
-            if commit_veto is not None:
-                if commit_veto(request, response):
-                    raise AbortWithResponse(response)
+        if slow_log is not None:
+            slow_log.start(request)
+        if not policy.lazy:
+            txn = begin(manager)
+            if deadline is not None:
+                txn.extension['pyramid_tm.deadline'] = deadline
 
-            # check for a squashed exception and handle it
-            # this would happen if an exception view was invoked and
-            # rendered an error response
-            exc_info = getattr(request, 'exc_info', None)
-            if exc_info is not None:
-                maybe_tag_retryable(request, exc_info)
-                if commit_veto is None:
-                    raise AbortWithResponse(response)
+        try:
+            response = managed_handler(request)
+            if deadline is not None and monotonic() > deadline:
+                return _finish(
+                    request,
+                    functools.partial(
+                        expire, request, manager, policy.timeout
+                    ),
+                )
+
+            if route_policies and not match_routes:
+                route = getattr(request, 'matched_route', None)
+                if route is not None:
+                    policy = route_policies.get(route.name, default_policy)
+
+            # defer completing the transaction until a streamed body has
+            # been produced, which happens after the tween returns
+            if policy.stream:
+                app_iter = getattr(response, 'app_iter', None)
+                if app_iter is not None and not isinstance(
+                    app_iter, (list, tuple)
+                ):
+                    response.app_iter = _TransactionAppIter(
+                        app_iter,
+                        functools.partial(
+                            complete_stream, request, manager, policy, response
+                        ),
+                    )
+                    return response
+
+            if should_abort(request, manager, policy.commit_veto, response):
+                raise AbortWithResponse(response)
 
-            return _finish(request, manager.commit, response)
+            return _finish(
+                request,
+                functools.partial(commit, request, manager, policy.annotators),
+                response,
+            )
 
         except AbortWithResponse as e:
-            return _finish(request, manager.abort, e.response)
+            return _finish(
+                request, functools.partial(abort, request, manager), e.response
+            )
 
         # an unhandled exception was propagated - we should abort the
         # transaction and re-raise the original exception
         except Exception as exc:
+            if 'tm.active' not in environ:
+                # the error was raised while completing the transaction
+                # and was already handled by _finish
+                raise
+
             # try to tag the original exception as retryable before
             # aborting the transaction because after abort it may not
             # be possible to determine if the exception is retryable
             # because the bound data managers are cleared
-            maybe_tag_retryable(request, sys.exc_info())
+            tag_retryable(request, sys.exc_info())
 
-            exc_response = _finish(request, manager.abort)
+            exc_response = _finish(
+                request, functools.partial(abort, request, manager)
+            )
             if exc_response is not None:
                 return exc_response
             raise exc from None
 
+    # a variant of the tween for the common configuration without route
+    # policies, streaming or lazy transactions, where the policy is fixed and
+    # a vetoed transaction is aborted without raising AbortWithResponse
+    commit_veto = default_policy.commit_veto
+    annotators = default_policy.annotators
+
+    def simple_tm_tween(request):
+        environ = request.environ
+        if 'repoze.tm.active' in environ or 'tm.active' in environ:
+            return handler(request)
+
+        if activate_hook is not None and not activate_hook(request):
+            return handler(request)
+
+        manager = request.tm
+        environ['tm.active'] = True
+        environ['tm.manager'] = manager
+        if slow_log is not None:
+            slow_log.start(request)
+        begin(manager)
+
+        try:
+            response = managed_handler(request)
+            if not should_abort(request, manager, commit_veto, response):
+                return _finish(
+                    request,
+                    functools.partial(commit, request, manager, annotators),
+                    response,
+                )
+
+        except Exception as exc:
+            if 'tm.active' not in environ:
+                raise
+
+            tag_retryable(request, sys.exc_info())
+
+            exc_response = _finish(
+                request, functools.partial(abort, request, manager)
+            )
+            if exc_response is not None:
+                return exc_response
+            raise exc from None
+
+        return _finish(
+            request, functools.partial(abort, request, manager), response
+        )
+
+    if tm_settings.specialize and not (
+        route_policies
+        or lazy_begin
+        or default_policy.stream
+        or default_policy.timeout
+        or adaptive
+        or savepoint_subrequests
+    ):
+        return simple_tm_tween
     return tm_tween
 
 
@@ -193,17 +1257,134 @@ def explicit_manager(request):
     return transaction.TransactionManager(explicit=True)
 
 
-def maybe_tag_retryable(request, exc_info):
+def thread_manager(request):
+    """
+    Return the ``transaction.TransactionManager`` which backs the threadlocal
+    ``transaction.manager`` in the current thread.
+
+    The manager is resolved once when ``request.tm`` is first accessed such
+    that the tween and any code using ``request.tm`` avoid the threadlocal
+    lookup performed by every call on ``transaction.manager``. Code using the
+    global ``transaction`` API keeps operating on the same manager, as long
+    as the request is served by a single thread.
+
+    """
+    return transaction.manager.manager
+
+
+# the declarations of IRetryableError shared by every instance of a type
+_retryable_specs = {}
+_retryable_specs_size = 256
+
+
+def tag_error_retryable(exc):
+    """
+    Mark the exception instance ``exc`` as retryable such that
+    ``IRetryableError.providedBy(exc)`` is ``True``.
+
+    This is equivalent to ``zope.interface.alsoProvides(exc,
+    IRetryableError)`` but reuses a single declaration per exception type
+    instead of computing a new one for every instance, unless the instance
+    already directly provides other interfaces.
+    """
+    if '__provides__' in exc.__dict__:
+        zope.interface.alsoProvides(exc, IRetryableError)
+        return
+    cls = type(exc)
+    spec = _retryable_specs.get(cls)
+    if spec is None:
+        spec = Provides(cls, IRetryableError)
+        if len(_retryable_specs) < _retryable_specs_size:
+            _retryable_specs[cls] = spec
+    exc.__provides__ = spec
+
+
+def _invoke_nested_subrequest(
+    invoke_subrequest, manager, request, use_tweens=False
+):
+    # share the manager of the outer request with the subrequest and let the
+    # tween run it in a savepoint, see ``tm.savepoint_subrequests``
+    environ = request.environ
+    environ['tm.active'] = True
+    environ['tm.manager'] = manager
+    environ['tm.nested'] = True
+    return invoke_subrequest(request, use_tweens)
+
+
+def _savepoint(manager):
+    # a savepoint of the current transaction, or None if a joined resource
+    # does not support savepoints, since requesting one would then fail the
+    # whole transaction
+    txn = manager.get()
+    for resource in txn._resources:
+        if getattr(resource, 'savepoint', None) is None:
+            return None
+    return txn.savepoint()
+
+
+def _invoke_exception_view(request, exc_info):
+    # the exception raised when no exception view matches is not propagated
+    # such that it does not become the context of the original exception,
+    # its traceback would reference ``exc_info`` and form a reference cycle
+    if not hasattr(request, 'invoke_exception_view'):  # pragma: no cover
+        return None  # pyramid < 1.7
+    try:
+        return request.invoke_exception_view(exc_info)
+    except NotFound:
+        return None
+
+
+def _current_transaction(manager):
+    # the current transaction of ``manager`` if any, without beginning one
+    # implicitly like ``manager.get()`` does in non-explicit mode
+    while hasattr(manager, 'manager'):
+        # LazyTransactionManager, ThreadTransactionManager
+        manager = manager.manager
+    return getattr(manager, '_txn', None)
+
+
+def _abort_failed_commit(manager):
+    # a failed commit leaves its transaction current on the manager and the
+    # two reference each other, abort it such that both are released without
+    # the cyclic gc and the manager may be reused
+    txn = _current_transaction(manager)
+    if txn is None or Status is None or txn.status is not Status.COMMITFAILED:
+        return
+    try:
+        txn.abort()
+    except Exception:
+        # failures of the data managers are logged by the transaction
+        pass
+
+
+def maybe_tag_retryable(request, exc_info, cache=None):
     exc = exc_info[1]
-    txn = request.tm.get()
-    if hasattr(txn, 'isRetryableError'):
+    if IRetryableError.providedBy(exc):
+        # already tagged, for example as a squashed exception
+        return
+    if isinstance(request.tm, LazyTransactionManager) and request.tm.pending:
+        # no resources have joined so only a TransientError could be
+        # retryable and those are already marked as such globally
+        return
+    # not request.tm.get() which would begin a new transaction on a
+    # non-explicit manager if the transaction was already completed
+    txn = _current_transaction(request.tm)
+    if txn is None:
+        # the transaction was already completed so only a TransientError
+        # could be retryable
+        return
+    if cache is not None and isinstance(txn, transaction.Transaction):
+        if cache.classify(txn, exc):
+            tag_error_retryable(exc)
+
+    elif hasattr(txn, 'isRetryableError'):
         if txn.isRetryableError(exc):
-            zope.interface.alsoProvides(exc, IRetryableError)
+            tag_error_retryable(exc)
 
     # bw-compat transaction < 2.4
     elif hasattr(request.tm, '_retryable'):  # pragma: no cover
         if request.tm._retryable(*exc_info[:-1]):
-            zope.interface.alsoProvides(exc, IRetryableError)
+            tag_error_retryable(exc)
 
 
 def create_tm(request):
@@ -211,14 +1392,37 @@ def create_tm(request):
     if manager:
         return manager
 
-    manager_hook = request.registry.settings.get('tm.manager_hook')
+    tm_settings = request.registry.get('pyramid_tm.settings')
+    if tm_settings is not None:
+        manager_hook = tm_settings.manager_hook
+    else:
+        # pyramid_tm was not included, see includeme
+        manager_hook = request.registry.settings.get('tm.manager_hook')
+        if manager_hook:
+            manager_hook = resolver.maybe_resolve(manager_hook)
     if manager_hook:
-        manager_hook = resolver.maybe_resolve(manager_hook)
         return manager_hook(request)
 
     return transaction.manager
 
 
+def tm_time_remaining(request):
+    """
+    Return the number of seconds left before the deadline of the transaction
+    of the ``request`` set by the ``tm.timeout`` setting, which is negative
+    once it has passed, or ``None`` if the transaction has no deadline.
+
+    Data managers may use it to bound the duration of their statements. The
+    deadline is also available as a ``time.monotonic()`` value via
+    ``request.environ['tm.deadline']`` and, unless the transaction is begun
+    lazily, ``txn.extension['pyramid_tm.deadline']``.
+    """
+    deadline = request.environ.get('tm.deadline')
+    if deadline is None:
+        return None
+    return deadline - monotonic()
+
+
 def is_tm_active(request):
     """
     Return ``True`` if the ``request`` is currently being managed by
@@ -295,11 +1499,19 @@ def includeme(config):
     config.add_tween('pyramid_tm.tm_tween_factory', over=EXCVIEW)
     config.add_request_method(create_tm, name='tm', reify=True)
     config.add_view_predicate('tm_active', TMActivePredicate)
-
-    def ensure():
-        manager_hook = config.registry.settings.get("tm.manager_hook")
-        if manager_hook is not None:
-            manager_hook = resolver.maybe_resolve(manager_hook)
-            config.registry.settings["tm.manager_hook"] = manager_hook
-
-    config.action(None, ensure, order=10)
+    config.add_directive('set_tm_policy', set_tm_policy)
+    if hasattr(config, 'add_view_deriver'):  # pyramid >= 1.7
+        config.add_view_deriver(tm_readonly_view)
+    if IBeforeRetry is not None:
+        config.add_subscriber(sleep_before_retry, IBeforeRetry)
+
+    def freeze():
+        # resolve every setting once the configuration is complete such that
+        # errors are reported at startup rather than by the first request
+        registry = config.registry
+        tm_settings = _parse_settings(registry.settings)
+        registry['pyramid_tm.settings'] = tm_settings
+        if registry.settings.get('tm.manager_hook') is not None:
+            registry.settings['tm.manager_hook'] = tm_settings.manager_hook
+
+    config.action(None, freeze, order=10)
@@ -0,0 +1,141 @@
+import collections
+import math
+import random
+import threading
+import time
+
+
+def resource_types(manager):
+    """
+    Return the sorted names of the classes of the resources joined to the
+    current transaction of ``manager``, or an empty tuple if there is none.
+    """
+    if getattr(manager, 'pending', False):
+        return ()
+    try:
+        txn = manager.get()
+    except Exception:
+        return ()
+    resources = getattr(txn, '_resources', None) or ()
+    return tuple(sorted({type(dm).__name__ for dm in resources}))
+
+
+class ContentionBackoff(object):
+    """
+    Track the retryable errors raised by the transactions of each route and
+    set of joined resource types over a sliding ``window`` of seconds, and
+    attach a backoff hint to each new retryable error such that the requests
+    conflicting on the same data do not all retry at once.
+
+    The hint is drawn uniformly between zero and ``base`` seconds times the
+    number of conflicts of the same route and resources within the window,
+    capped at ``cap`` seconds. It is available via
+    :func:`pyramid_tm.get_backoff_hint`. If ``sleep`` is ``True`` the retry
+    is also delayed by the hint, see
+    :func:`pyramid_tm.backoff.sleep_before_retry`.
+
+    At most ``maxsize`` keys are tracked, the least recently conflicting one
+    is forgotten first.
+    """
+
+    def __init__(
+        self,
+        window=1.0,
+        base=0.005,
+        cap=0.1,
+        maxsize=256,
+        sleep=False,
+        random=random.random,
+        clock=time.monotonic,
+    ):
+        self.window = window
+        self.base = base
+        self.cap = cap
+        self.maxsize = maxsize
+        self.sleep = sleep
+        self._random = random
+        self._clock = clock
+        # conflicts beyond this many do not increase the hint any further
+        self._maxlen = max(1, int(math.ceil(cap / base))) if base > 0 else 1
+        self._lock = threading.Lock()
+        self._keys = collections.OrderedDict()
+
+    def _key(self, request):
+        route = getattr(request, 'matched_route', None)
+        return (
+            route.name if route is not None else None,
+            resource_types(request.tm),
+        )
+
+    def record(self, key):
+        """
+        Record a conflict of ``key`` and return the number of conflicts of
+        ``key`` within the window, including this one.
+        """
+        now = self._clock()
+        with self._lock:
+            times = self._keys.get(key)
+            if times is None:
+                if len(self._keys) >= self.maxsize:
+                    self._keys.popitem(last=False)
+                times = self._keys[key] = collections.deque(
+                    maxlen=self._maxlen
+                )
+            else:
+                self._keys.move_to_end(key)
+            times.append(now)
+            while times[0] < now - self.window:
+                times.popleft()
+            return len(times)
+
+    def hint(self, request, exc):
+        """
+        Record the retryable error ``exc`` raised by the transaction of the
+        ``request`` and attach a backoff hint to it, unless it already has
+        one. Returns the hint in seconds.
+        """
+        hint = get_backoff_hint(exc)
+        if hint is None:
+            conflicts = self.record(self._key(request))
+            hint = self._random() * min(self.cap, self.base * conflicts)
+            exc._pyramid_tm_backoff = hint
+        return hint
+
+    def snapshot(self):
+        """
+        Return a ``dict`` mapping each tracked ``(route name, resource
+        types)`` key to its number of conflicts within the window, counting
+        at most as many as needed to reach the cap.
+        """
+        now = self._clock()
+        with self._lock:
+            return {
+                key: sum(1 for t in times if t >= now - self.window)
+                for key, times in self._keys.items()
+            }
+
+
+def get_backoff_hint(exc):
+    """
+    Return the number of seconds a retry of the request which raised the
+    retryable error ``exc`` should be delayed by, or ``None`` if the error
+    has no hint. Hints are only attached when the ``tm.backoff`` setting is
+    enabled.
+    """
+    return getattr(exc, '_pyramid_tm_backoff', None)
+
+
+def sleep_before_retry(event):
+    """
+    A subscriber of the ``pyramid_retry.IBeforeRetry`` event delaying the
+    next attempt by the backoff hint of the retryable error if
+    ``tm.backoff_sleep`` is enabled. The event is emitted once the
+    transaction of the failed attempt was aborted, such that no locks are
+    held while sleeping.
+    """
+    backoff = event.request.registry.get('pyramid_tm.backoff')
+    if backoff is None or not backoff.sleep:
+        return
+    hint = get_backoff_hint(getattr(event, 'exception', None))
+    if hint:
+        time.sleep(hint)
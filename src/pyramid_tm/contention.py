@@ -0,0 +1,120 @@
+import collections
+from pyramid.httpexceptions import HTTPBadRequest
+import threading
+import time
+
+from pyramid_tm.backoff import resource_types
+
+
+def _class_name(cls):
+    return '%s.%s' % (cls.__module__, cls.__qualname__)
+
+
+class ContentionTracker(object):
+    """
+    Aggregate the retryable errors raised by the transactions of the
+    application by route name, exception class and the classes of the
+    resources joined to the transaction, such that the hot spots causing
+    conflicts can be found in production.
+
+    At most ``maxsize`` combinations are tracked, the least recently seen
+    one is forgotten first, such that the memory used is bounded.
+    """
+
+    def __init__(self, maxsize=1000, clock=time.time):
+        self.maxsize = maxsize
+        self._clock = clock
+        self._lock = threading.Lock()
+        # key -> [count, first seen, last seen]
+        self._entries = collections.OrderedDict()
+
+    def record(self, request, exc):
+        """
+        Record the retryable error ``exc`` raised by the transaction of the
+        ``request``, unless it was already recorded.
+        """
+        if getattr(exc, '_pyramid_tm_contention', False):
+            return
+        exc._pyramid_tm_contention = True
+        route = getattr(request, 'matched_route', None)
+        key = (
+            route.name if route is not None else None,
+            _class_name(type(exc)),
+            resource_types(request.tm),
+        )
+        now = self._clock()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                if len(self._entries) >= self.maxsize:
+                    self._entries.popitem(last=False)
+                self._entries[key] = [1, now, now]
+                return
+            self._entries.move_to_end(key)
+            entry[0] += 1
+            entry[2] = now
+
+    def report(self, limit=10):
+        """
+        Return the ``limit`` most frequent combinations as a list of
+        ``dict`` with the ``route`` name, the ``exception`` class, the
+        ``resources`` classes, the ``count`` of errors, their average
+        ``rate`` per second since the combination was ``first_seen`` and
+        the time it was ``last_seen``, as seconds since the epoch.
+        """
+        now = self._clock()
+        with self._lock:
+            entries = [
+                (key, tuple(entry)) for key, entry in self._entries.items()
+            ]
+        entries.sort(key=lambda item: item[1][0], reverse=True)
+        return [
+            {
+                'route': route,
+                'exception': exception,
+                'resources': list(resources),
+                'count': count,
+                'rate': count / max(now - first_seen, 1.0),
+                'first_seen': first_seen,
+                'last_seen': last_seen,
+            }
+            for (route, exception, resources), (
+                count,
+                first_seen,
+                last_seen,
+            ) in entries[:limit]
+        ]
+
+    def reset(self):
+        """Forget every recorded error."""
+        with self._lock:
+            self._entries.clear()
+
+
+def get_contention_report(registry, limit=10):
+    """
+    Return the ``limit`` hot spots of retryable errors recorded by the
+    ``pyramid_tm`` tween for the application using ``registry``, see
+    :meth:`pyramid_tm.contention.ContentionTracker.report`. This is an
+    empty list unless ``tm.contention`` is enabled.
+    """
+    tracker = registry.get('pyramid_tm.contention')
+    if tracker is None:
+        return []
+    return tracker.report(limit)
+
+
+def contention_report_view(request):
+    """
+    A view returning the report of :func:`pyramid_tm.get_contention_report`
+    in a ``dict`` suitable for the ``json`` renderer. The number of hot
+    spots is set by the ``limit`` query parameter, which defaults to ``10``.
+
+    The view is not registered by ``pyramid_tm``, it should be added to an
+    application behind a permission restricted to its administrators.
+    """
+    try:
+        limit = int(request.params.get('limit', 10))
+    except ValueError:
+        raise HTTPBadRequest('The "limit" parameter must be an integer.')
+    return {'hot_spots': get_contention_report(request.registry, limit)}
@@ -0,0 +1,221 @@
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+def _remaining(deadline):
+    if deadline is None:
+        return None
+    return max(deadline - time.monotonic(), 0)
+
+
+class AfterCommitExecutor(object):
+    """
+    Run the hooks registered with
+    :func:`pyramid_tm.add_async_after_commit_hook` on ``workers`` background
+    threads once their transaction has committed.
+
+    At most ``queue_size`` hooks wait for a worker. When the queue is full,
+    or once the executor has been shut down, a hook is run synchronously by
+    the thread committing the transaction instead, which slows down the
+    producers until the workers catch up. Errors raised by a hook are
+    logged on the ``pyramid_tm.hooks`` logger and counted.
+
+    The worker threads are started when the first hook is submitted in a
+    process, such that they survive a fork of the application. Pending
+    hooks are drained when the interpreter exits, waiting at most
+    ``drain_timeout`` seconds, see :meth:`shutdown`.
+    """
+
+    def __init__(self, workers=2, queue_size=100, drain_timeout=10.0):
+        self.workers = workers
+        self.drain_timeout = drain_timeout
+        self._queue = queue.Queue(queue_size)
+        self._lock = threading.Lock()
+        self._threads = []
+        self._pid = None
+        self._closed = False
+        self._counts = dict.fromkeys(
+            ('queued', 'inline', 'completed', 'failed'), 0
+        )
+        self._wait = [0.0, 0.0]
+        self._run_time = [0.0, 0.0]
+
+    def _start(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            # threads do not survive a fork so start them in the process
+            # which submits the hooks
+            self._threads = [
+                threading.Thread(
+                    target=self._work,
+                    name='pyramid_tm-after-commit-%d' % index,
+                    daemon=True,
+                )
+                for index in range(self.workers)
+            ]
+            for thread in self._threads:
+                thread.start()
+            if self._pid is None:
+                atexit.register(self.shutdown, self.drain_timeout)
+            self._pid = os.getpid()
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                self._run(*item)
+            finally:
+                self._queue.task_done()
+
+    def _run(self, hook, args, kws, queued):
+        start = time.perf_counter()
+        failed = False
+        try:
+            hook(*args, **kws)
+        except Exception:
+            failed = True
+            log.exception('after-commit hook %r failed', hook)
+        end = time.perf_counter()
+        with self._lock:
+            self._counts['failed' if failed else 'completed'] += 1
+            for totals, seconds in (
+                (self._wait, start - queued),
+                (self._run_time, end - start),
+            ):
+                totals[0] += seconds
+                totals[1] = max(totals[1], seconds)
+
+    def submit(self, hook, args=(), kws=None):
+        """
+        Queue ``hook(*args, **kws)`` to run on a worker thread, or run it
+        immediately if the queue is full or the executor was shut down.
+        """
+        item = (hook, args, kws or {}, time.perf_counter())
+        if not self._closed:
+            if self._pid != os.getpid():
+                self._start()
+            try:
+                self._queue.put_nowait(item)
+            except queue.Full:
+                pass
+            else:
+                with self._lock:
+                    self._counts['queued'] += 1
+                return
+        with self._lock:
+            self._counts['inline'] += 1
+        self._run(*item)
+
+    def shutdown(self, timeout=None):
+        """
+        Stop the worker threads once every queued hook has run, waiting at
+        most ``timeout`` seconds. Hooks submitted afterwards are run
+        synchronously. Returns ``True`` if every queued hook has run.
+        """
+        with self._lock:
+            self._closed = True
+            threads = self._threads if self._pid == os.getpid() else []
+            self._threads = []
+        deadline = None if timeout is None else time.monotonic() + timeout
+        try:
+            for _ in threads:
+                self._queue.put(None, timeout=_remaining(deadline))
+        except queue.Full:
+            return False
+        for thread in threads:
+            thread.join(_remaining(deadline))
+        if any(thread.is_alive() for thread in threads):
+            return False
+        # run the hooks which raced with the shutdown in the caller
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                return True
+            if item is not None:
+                with self._lock:
+                    self._counts['inline'] += 1
+                self._run(*item)
+
+    def snapshot(self):
+        """
+        Return a ``dict`` with the number of hooks that were ``queued`` for
+        a worker or run ``inline`` because of backpressure, the number of
+        hooks which ``completed`` or ``failed``, the number of hooks still
+        ``pending`` in the queue, and the ``sum`` and ``max`` in seconds of
+        the time hooks spent waiting in the queue (``wait``) and running
+        (``run``).
+        """
+        with self._lock:
+            snapshot = dict(self._counts)
+            snapshot['wait'] = {'sum': self._wait[0], 'max': self._wait[1]}
+            snapshot['run'] = {
+                'sum': self._run_time[0],
+                'max': self._run_time[1],
+            }
+        snapshot['pending'] = self._queue.qsize()
+        return snapshot
+
+
+def _submit(status, executor, hook, args, kws):
+    if not status:
+        return
+    if executor is None:
+        hook(*args, **kws)
+    else:
+        executor.submit(hook, args, kws)
+
+
+def add_async_after_commit_hook(request, hook, args=(), kws=None):
+    """
+    Call ``hook(*args, **kws)`` once the transaction of the ``request`` has
+    committed successfully. Unlike hooks added via
+    ``txn.addAfterCommitHook`` the hook is not passed the status of the
+    commit, and is not called at all if the commit failed or the
+    transaction was aborted.
+
+    If the ``tm.after_commit_workers`` setting is enabled the hook runs on a
+    background thread, see :class:`pyramid_tm.hooks.AfterCommitExecutor`,
+    otherwise it runs synchronously as a regular after-commit hook. A hook
+    running in the background must not use the ``request`` or its
+    transaction.
+    """
+    executor = request.registry.get('pyramid_tm.after_commit_executor')
+    request.tm.get().addAfterCommitHook(
+        _submit, (executor, hook, tuple(args), kws or {})
+    )
+
+
+def get_after_commit_stats(registry):
+    """
+    Return a snapshot of the metrics of the background after-commit hooks
+    of the application using ``registry``, or ``None`` if the
+    ``tm.after_commit_workers`` setting is not enabled. See
+    :meth:`pyramid_tm.hooks.AfterCommitExecutor.snapshot` for the format.
+    """
+    executor = registry.get('pyramid_tm.after_commit_executor')
+    if executor is None:
+        return None
+    return executor.snapshot()
+
+
+def shutdown_after_commit_hooks(registry, timeout=None):
+    """
+    Drain the background after-commit hooks of the application using
+    ``registry``, waiting at most ``timeout`` seconds. This should be called
+    by servers shutting down gracefully. Returns ``True`` if every queued
+    hook has run or the ``tm.after_commit_workers`` setting is not enabled.
+    """
+    executor = registry.get('pyramid_tm.after_commit_executor')
+    if executor is None:
+        return True
+    return executor.shutdown(timeout)
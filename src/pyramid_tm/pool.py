@@ -0,0 +1,97 @@
+import threading
+import transaction
+import warnings
+
+
+class TransactionManagerLeak(UserWarning):
+    """
+    Emitted by a :class:`ManagerPool` in debug mode when a transaction
+    manager is released with an open transaction or registered
+    synchronizers.
+    """
+
+
+class ManagerPool(object):
+    """
+    A pool of explicit ``transaction.TransactionManager`` objects.
+
+    Every thread keeps its own free list of at most ``size`` managers so
+    that acquiring and releasing them never contends on a lock. A manager is
+    only put back on the free list if it is in a clean state, meaning that
+    it has no open transaction and no registered synchronizers, otherwise it
+    is discarded. Managers are verified again before being reused, such that
+    a manager used after it was released is discarded as well. If ``debug``
+    is ``True`` a :class:`TransactionManagerLeak` warning is emitted for
+    every manager that is discarded.
+    """
+
+    def __init__(self, size=8, debug=False):
+        self.size = size
+        self.debug = debug
+        self._local = threading.local()
+
+    def _free_list(self):
+        try:
+            return self._local.free
+        except AttributeError:
+            free = self._local.free = []
+            return free
+
+    def _check(self, manager):
+        if manager._txn is not None:
+            return 'an open transaction'
+        if manager.registeredSynchs():
+            return '%d registered synchronizer(s)' % len(manager._synchs)
+
+    def acquire(self):
+        """Return a clean explicit transaction manager."""
+        free = self._free_list()
+        while free:
+            manager = free.pop()
+            if self._check(manager) is None:
+                return manager
+            if self.debug:
+                warnings.warn(
+                    'A pooled transaction manager was modified after it was '
+                    'released.',
+                    TransactionManagerLeak,
+                )
+        return transaction.TransactionManager(explicit=True)
+
+    def release(self, manager):
+        """
+        Return ``manager`` to the pool. Returns ``True`` if it was clean and
+        may be reused, or ``False`` if it was discarded.
+        """
+        problem = self._check(manager)
+        if problem is not None:
+            if self.debug:
+                warnings.warn(
+                    'A pooled transaction manager was released with %s.'
+                    % (problem,),
+                    TransactionManagerLeak,
+                )
+            return False
+        free = self._free_list()
+        if len(free) < self.size:
+            free.append(manager)
+        return True
+
+
+def pooled_explicit_manager(request):
+    """
+    Return an explicit ``transaction.TransactionManager`` from a pool which
+    is reused across requests.
+
+    This behaves like :func:`pyramid_tm.explicit_manager` but avoids
+    creating a new manager for every request. When set as the
+    ``tm.manager_hook``, the ``pyramid_tm`` tween returns the manager to the
+    pool once the transaction has been completed. The size of the per-thread
+    pool is controlled by the ``tm.pool_size`` setting (default ``8``) and
+    ``tm.pool_debug = true`` enables warnings for managers leaking a
+    transaction or synchronizers.
+    """
+    pool = request.registry.get('pyramid_tm.manager_pool')
+    if pool is None:
+        return transaction.TransactionManager(explicit=True)
+    return pool.acquire()
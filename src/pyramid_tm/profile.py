@@ -0,0 +1,102 @@
+import cProfile
+import collections
+import itertools
+import os
+import random
+import re
+import threading
+import time
+
+_unsafe = re.compile(r'[^A-Za-z0-9_.-]+')
+
+
+class Profiler(object):
+    """
+    Run the handler and the commit or abort of sampled requests under
+    ``cProfile`` and write the results to ``directory``.
+
+    A request is sampled with a probability of ``rate``, or always if the
+    name of the route it matches is listed in ``routes``, which requires
+    ``routes_mapper``. The results are written in the ``pstats`` format to
+    files named ``<route>.<outcome>.<timestamp>.<pid>.<n>.pstats``, where
+    the outcome is one of ``commit``, ``abort``, ``commit_failed`` or
+    ``abort_failed``. Once more than ``keep`` files have been written the
+    oldest ones are removed.
+    """
+
+    def __init__(
+        self, directory, rate=0.0, routes=(), keep=100, routes_mapper=None
+    ):
+        self.directory = directory
+        self.rate = rate
+        self.routes = frozenset(routes)
+        self.keep = keep
+        self.routes_mapper = routes_mapper
+        self._lock = threading.Lock()
+        self._files = collections.deque()
+        self._counter = itertools.count()
+        os.makedirs(directory, exist_ok=True)
+
+    def _sample(self, request):
+        if self.routes and self.routes_mapper is not None:
+            route = self.routes_mapper(request)['route']
+            if route is not None and route.name in self.routes:
+                return True
+        return random.random() < self.rate
+
+    def profile_handler(self, handler):
+        def wrapper(request):
+            if not self._sample(request):
+                return handler(request)
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # another profiler is already active in this thread
+                return handler(request)
+            request.environ['pyramid_tm.profile'] = profile
+            try:
+                return handler(request)
+            finally:
+                profile.disable()
+
+        return wrapper
+
+    def profile_completion(self, fn, phase):
+        def wrapper(request, *args):
+            profile = request.environ.pop('pyramid_tm.profile', None)
+            if profile is None:
+                return fn(request, *args)
+            outcome = phase + '_failed'
+            profile.enable()
+            try:
+                result = fn(request, *args)
+                outcome = phase
+                return result
+            finally:
+                profile.disable()
+                self._dump(request, profile, outcome)
+
+        return wrapper
+
+    def _dump(self, request, profile, outcome):
+        route = getattr(request, 'matched_route', None)
+        name = '%s.%s.%d.%d.%d.pstats' % (
+            _unsafe.sub('_', route.name) if route is not None else '_',
+            outcome,
+            time.time() * 1000,
+            os.getpid(),
+            next(self._counter),
+        )
+        path = os.path.join(self.directory, name)
+        profile.dump_stats(path)
+        with self._lock:
+            self._files.append(path)
+            expired = []
+            while len(self._files) > self.keep:
+                expired.append(self._files.popleft())
+        for path in expired:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
@@ -0,0 +1,189 @@
+import json
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+
+
+def _has_resources(manager):
+    if getattr(manager, 'pending', False):
+        return False
+    try:
+        txn = manager.get()
+    except Exception:
+        return False
+    return bool(getattr(txn, '_resources', None))
+
+
+class ReadOnlyRoutes(object):
+    """
+    Learn which routes never write by observing, per route name, whether
+    any resource joined the transaction of each request.
+
+    A route is considered read-only once ``window`` consecutive requests
+    completed without any resource joining their transaction. If
+    ``adaptive`` is ``True`` the ``pyramid_tm`` tween then begins the
+    transactions of that route lazily, as if ``tm.lazy_begin`` was enabled
+    for it, such that no transaction is begun or annotated unless a resource
+    actually joins. A request of that route which does write is committed as
+    usual and resets the count, so the route is no longer considered
+    read-only.
+    """
+
+    def __init__(self, window=100, adaptive=False):
+        self.window = window
+        self.adaptive = adaptive
+        self._lock = threading.Lock()
+        # route name -> [consecutive read-only requests, writing requests]
+        self._routes = {}
+
+    def is_readonly(self, name):
+        counts = self._routes.get(name)
+        return counts is not None and counts[0] >= self.window
+
+    def observe(self, name, joined):
+        with self._lock:
+            counts = self._routes.get(name)
+            if counts is None:
+                counts = self._routes[name] = [0, 0]
+            if joined:
+                counts[0] = 0
+                counts[1] += 1
+            else:
+                counts[0] += 1
+
+    def observe_completion(self, fn):
+        def wrapper(request, manager, *args):
+            route = getattr(request, 'matched_route', None)
+            if route is not None:
+                self.observe(route.name, _has_resources(manager))
+            return fn(request, manager, *args)
+
+        return wrapper
+
+    def snapshot(self):
+        """
+        Return a ``dict`` mapping each observed route name to a ``dict``
+        with the number of consecutive ``readonly`` requests, the number of
+        requests which ``writes``, and whether the route is currently
+        considered ``is_readonly``.
+        """
+        with self._lock:
+            routes = {
+                name: list(counts) for name, counts in self._routes.items()
+            }
+        return {
+            name: {
+                'readonly': readonly,
+                'writes': writes,
+                'is_readonly': readonly >= self.window,
+            }
+            for name, (readonly, writes) in routes.items()
+        }
+
+    def dump(self, fp):
+        """Write the learned table as JSON to the file object ``fp``."""
+        json.dump(self.snapshot(), fp, indent=2, sort_keys=True)
+
+    def load(self, fp):
+        """
+        Merge a table written by :meth:`dump` from the file object ``fp``.
+        """
+        table = json.load(fp)
+        with self._lock:
+            for name, counts in table.items():
+                self._routes[name] = [counts['readonly'], counts['writes']]
+
+
+def get_readonly_routes(registry):
+    """
+    Return the table of observed routes recorded by the ``pyramid_tm`` tween
+    for the application using ``registry``, see
+    :meth:`pyramid_tm.readonly.ReadOnlyRoutes.snapshot`. This is an empty
+    ``dict`` unless ``tm.readonly_routes`` is enabled.
+    """
+    routes = registry.get('pyramid_tm.readonly_routes')
+    if routes is None:
+        return {}
+    return routes.snapshot()
+
+
+def dump_readonly_routes(registry, path):
+    """
+    Write the table of observed routes to ``path`` such that it can be
+    loaded at startup via the ``tm.readonly_table`` setting.
+    """
+    routes = registry.get('pyramid_tm.readonly_routes')
+    if routes is None:
+        raise ValueError('The "tm.readonly_routes" setting is not enabled.')
+    with open(path, 'w') as fp:
+        routes.dump(fp)
+
+
+def is_tm_readonly(request):
+    """
+    Return ``True`` if the transaction of the ``request`` was marked as
+    read-only, for example by a view registered with ``tm_readonly=True``.
+
+    The read-only flag is also available to data managers as
+    ``txn.extension['pyramid_tm.readonly']``.
+    """
+    return request.environ.get('tm.readonly', False)
+
+
+def _warn_joined(txn):
+    resources = getattr(txn, '_resources', None)
+    if resources:
+        log.warning(
+            'resources joined the read-only transaction: %s',
+            ', '.join(type(dm).__name__ for dm in resources),
+        )
+
+
+def mark_tm_readonly(request, warn_joins=False):
+    """
+    Mark the transaction of the ``request`` as read-only by dooming it, such
+    that the ``pyramid_tm`` tween aborts it instead of committing it. This
+    does nothing if the request is not managed by ``pyramid_tm``.
+
+    If ``warn_joins`` is ``True`` a warning is logged when the transaction
+    is aborted if any resources joined it. A doomed transaction is never
+    voted or committed, so joining is the only signal available: it does not
+    imply that a resource wrote anything, as some data managers join on any
+    read as well.
+
+    The transaction of a subrequest run in a savepoint of the outer
+    transaction, see ``tm.savepoint_subrequests``, is not doomed. The
+    ``pyramid_tm`` tween rolls back its savepoint instead such that only
+    the changes of the subrequest are discarded.
+    """
+    if not request.environ.get('tm.active', False):
+        return
+    request.environ['tm.readonly'] = True
+    if request.environ.get('tm.nested', False):
+        return
+    txn = request.tm.get()
+    txn.doom()
+    txn.extension['pyramid_tm.readonly'] = True
+    if warn_joins:
+        txn.addBeforeAbortHook(_warn_joined, (txn,))
+
+
+def tm_readonly_view(view, info):
+    """
+    A :term:`view deriver` handling the ``tm_readonly`` view option. See
+    :func:`pyramid_tm.readonly.mark_tm_readonly`.
+    """
+    if not info.options.get('tm_readonly'):
+        return view
+
+    def wrapper(context, request):
+        # the settings are frozen once the views have been registered
+        tm_settings = request.registry['pyramid_tm.settings']
+        mark_tm_readonly(request, tm_settings.readonly_warn_joins)
+        return view(context, request)
+
+    return wrapper
+
+
+tm_readonly_view.options = ('tm_readonly',)
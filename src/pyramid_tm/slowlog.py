@@ -0,0 +1,151 @@
+import logging
+from time import perf_counter
+
+log = logging.getLogger(__name__)
+
+
+def log_slow_transaction(record):
+    """
+    The default sink of the slow transaction log, emitting a warning on the
+    ``pyramid_tm.slowlog`` logger. See :class:`SlowLog` for the contents of
+    ``record``.
+    """
+    log.warning(
+        'slow transaction: %.1fms %s %s route=%s user=%r note=%r '
+        'phases=%s resources=%s',
+        record['duration'] * 1000,
+        record['outcome'],
+        record['path'],
+        record['route'],
+        record['user'],
+        record['note'],
+        ' '.join(
+            '%s=%.1fms' % (name, value * 1000)
+            for name, value in sorted(record['phases'].items())
+        ),
+        ','.join(record['resources']),
+    )
+
+
+def _current(manager):
+    # the current transaction if any, without beginning one implicitly like
+    # manager.get(), see pyramid_tm._current_transaction
+    if getattr(manager, 'pending', False):
+        return None
+    while hasattr(manager, 'manager'):
+        manager = manager.manager
+    return getattr(manager, '_txn', None)
+
+
+def _resource_names(txn):
+    return [type(dm).__name__ for dm in getattr(txn, '_resources', ())]
+
+
+class SlowLog(object):
+    """
+    Report transactions which took longer than ``threshold`` seconds from
+    the moment they were begun until they were committed or aborted, or
+    whose commit alone took that long.
+
+    Every slow transaction is reported by calling ``sink`` with a ``dict``
+    containing:
+
+    - ``path``: the ``request.path_info``, or ``None`` if it cannot be
+      decoded.
+    - ``route``: the name of the matched route, or ``None``.
+    - ``user`` and ``note``: the ``user`` and ``description`` of the
+      transaction, if any.
+    - ``outcome``: one of ``commit``, ``abort``, ``commit_failed`` or
+      ``abort_failed``.
+    - ``duration``: the time in seconds from the beginning of the
+      transaction until it was completed.
+    - ``phases``: a ``dict`` of the time in seconds spent in the
+      ``handler``, and either ``commit`` or ``abort``.
+    - ``resources``: the class names of the resources joined to the
+      transaction.
+    """
+
+    def __init__(self, threshold, sink=log_slow_transaction):
+        self.threshold = threshold
+        self.sink = sink
+
+    def start(self, request):
+        """
+        Start timing the transaction of the ``request``, before it is begun.
+        """
+        request.environ['pyramid_tm.timings'] = {'start': perf_counter()}
+
+    def time_handler(self, handler):
+        def wrapper(request):
+            timings = request.environ.get('pyramid_tm.timings')
+            if timings is None:
+                # the tween is not managing a transaction for the request
+                return handler(request)
+            start = perf_counter()
+            try:
+                return handler(request)
+            finally:
+                timings['handler'] = perf_counter() - start
+
+        return wrapper
+
+    def time_completion(self, fn, phase):
+        def wrapper(request, manager, *args):
+            txn = _current(manager)
+            resources = []
+            if txn is not None:
+                timings = request.environ['pyramid_tm.timings']
+
+                def capture(*status):
+                    # the resources are forgotten once the transaction is
+                    # complete, name them only if it is slow by then
+                    if perf_counter() - timings['start'] >= self.threshold:
+                        resources.extend(_resource_names(txn))
+
+                if phase == 'commit':
+                    txn.addAfterCommitHook(capture)
+                else:
+                    txn.addAfterAbortHook(capture)
+            outcome = phase + '_failed'
+            start = perf_counter()
+            try:
+                result = fn(request, manager, *args)
+                outcome = phase
+                return result
+            finally:
+                end = perf_counter()
+                self._complete(
+                    request, txn, resources, phase, outcome, start, end
+                )
+
+        return wrapper
+
+    def _complete(self, request, txn, resources, phase, outcome, start, end):
+        timings = request.environ['pyramid_tm.timings']
+        timings[phase] = end - start
+        # the commit is a part of the duration so checking the latter is
+        # enough to catch slow commits as well
+        duration = end - timings.pop('start')
+        if duration < self.threshold:
+            return
+
+        if not resources:
+            # the transaction was not completed, or the hook was not slow yet
+            resources = _resource_names(txn)
+        try:
+            path = request.path_info
+        except UnicodeDecodeError:
+            path = None
+        route = getattr(request, 'matched_route', None)
+        self.sink(
+            {
+                'path': path,
+                'route': route.name if route is not None else None,
+                'user': getattr(txn, 'user', None),
+                'note': getattr(txn, 'description', None),
+                'outcome': outcome,
+                'duration': duration,
+                'phases': timings,
+                'resources': resources,
+            }
+        )
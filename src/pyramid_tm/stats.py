@@ -0,0 +1,213 @@
+import bisect
+import collections
+import threading
+import time
+
+#: The default upper bounds, in seconds, of the latency histogram buckets.
+DEFAULT_BUCKETS = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+#: The phases of a request which are timed by the ``pyramid_tm`` tween.
+PHASES = ('begin', 'handler', 'veto', 'commit', 'abort')
+
+#: The outcomes counted by the ``pyramid_tm`` tween.
+OUTCOMES = ('commit', 'abort', 'doom', 'veto', 'exception', 'retryable')
+
+
+class _Shard(object):
+    """The measurements recorded by a single thread."""
+
+    def __init__(self, nbuckets):
+        self.nbuckets = nbuckets
+        self.counts = {}
+        self.sums = collections.defaultdict(float)
+        self.outcomes = collections.defaultdict(int)
+
+    def observe(self, phase, index, seconds):
+        counts = self.counts.get(phase)
+        if counts is None:
+            counts = self.counts[phase] = [0] * self.nbuckets
+        counts[index] += 1
+        self.sums[phase] += seconds
+
+
+class Stats(object):
+    """
+    Latency histograms and outcome counters for the ``pyramid_tm`` tween.
+
+    Every thread records into its own shard so that recording never
+    contends on a lock. The shards are merged when a :meth:`snapshot` is
+    taken, which may therefore be slightly behind the threads still
+    recording.
+
+    ``buckets`` is a sorted sequence of histogram upper bounds in seconds.
+    An implicit ``+Inf`` bucket is always added.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._shards = []
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = _Shard(len(self.buckets) + 1)
+            with self._lock:
+                self._shards.append(shard)
+            return shard
+
+    def observe(self, phase, seconds):
+        """Record that ``phase`` took ``seconds``."""
+        index = bisect.bisect_left(self.buckets, seconds)
+        self._shard().observe(phase, index, seconds)
+
+    def incr(self, outcome):
+        """Count one occurrence of ``outcome``."""
+        self._shard().outcomes[outcome] += 1
+
+    def instrument(
+        self, fn, phase=None, on_success=None, on_true=None, on_error=None
+    ):
+        """
+        Wrap ``fn`` such that its duration is recorded as ``phase``.
+
+        ``on_success`` is counted when ``fn`` returns, ``on_true`` is counted
+        when it returns a true value and ``on_error`` is counted when it
+        raises an exception.
+        """
+        perf_counter = time.perf_counter
+
+        def wrapper(*args):
+            start = perf_counter()
+            try:
+                result = fn(*args)
+            except BaseException:
+                if on_error is not None:
+                    self.incr(on_error)
+                raise
+            finally:
+                if phase is not None:
+                    self.observe(phase, perf_counter() - start)
+            if on_success is not None:
+                self.incr(on_success)
+            if on_true is not None and result:
+                self.incr(on_true)
+            return result
+
+        return wrapper
+
+    def snapshot(self):
+        """
+        Return the merged measurements of every thread as a ``dict`` with
+        the following keys:
+
+        - ``phases``: a ``dict`` mapping each phase name to a ``dict`` with
+          the ``count`` and ``sum`` of the observed durations and the
+          cumulative ``buckets`` as a list of ``(upper_bound, count)``
+          pairs, the last upper bound being ``float('inf')``.
+
+        - ``outcomes``: a ``dict`` mapping each outcome name to its count.
+        """
+        with self._lock:
+            shards = list(self._shards)
+
+        bounds = self.buckets + (float('inf'),)
+        counts = {}
+        sums = collections.defaultdict(float)
+        outcomes = dict.fromkeys(OUTCOMES, 0)
+        for shard in shards:
+            for phase, values in list(shard.counts.items()):
+                merged = counts.setdefault(phase, [0] * len(bounds))
+                for index, value in enumerate(values):
+                    merged[index] += value
+                sums[phase] += shard.sums[phase]
+            for outcome, value in list(shard.outcomes.items()):
+                outcomes[outcome] = outcomes.get(outcome, 0) + value
+
+        phases = {}
+        for phase, values in counts.items():
+            cumulative = []
+            total = 0
+            for bound, value in zip(bounds, values):
+                total += value
+                cumulative.append((bound, total))
+            phases[phase] = {
+                'count': total,
+                'sum': sums[phase],
+                'buckets': cumulative,
+            }
+        return {'phases': phases, 'outcomes': outcomes}
+
+
+def get_stats(registry):
+    """
+    Return a snapshot of the statistics recorded by the ``pyramid_tm`` tween
+    for the application using ``registry``, or ``None`` if the ``tm.stats``
+    setting is not enabled. See :meth:`pyramid_tm.stats.Stats.snapshot` for
+    the format.
+    """
+    stats = registry.get('pyramid_tm.stats')
+    if stats is None:
+        return None
+    return stats.snapshot()
+
+
+def format_stats(registry):
+    """
+    Return the statistics recorded by the ``pyramid_tm`` tween for the
+    application using ``registry`` in the Prometheus text exposition format.
+    An empty string is returned if the ``tm.stats`` setting is not enabled.
+    """
+    snapshot = get_stats(registry)
+    if snapshot is None:
+        return ''
+
+    lines = [
+        '# HELP pyramid_tm_phase_seconds Duration of each tween phase.',
+        '# TYPE pyramid_tm_phase_seconds histogram',
+    ]
+    for phase, hist in sorted(snapshot['phases'].items()):
+        for bound, count in hist['buckets']:
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            lines.append(
+                'pyramid_tm_phase_seconds_bucket{phase="%s",le="%s"} %d'
+                % (phase, le, count)
+            )
+        lines.append(
+            'pyramid_tm_phase_seconds_sum{phase="%s"} %r'
+            % (phase, hist['sum'])
+        )
+        lines.append(
+            'pyramid_tm_phase_seconds_count{phase="%s"} %d'
+            % (phase, hist['count'])
+        )
+    lines.extend(
+        [
+            '# HELP pyramid_tm_outcomes_total Requests by outcome.',
+            '# TYPE pyramid_tm_outcomes_total counter',
+        ]
+    )
+    for outcome, count in sorted(snapshot['outcomes'].items()):
+        lines.append(
+            'pyramid_tm_outcomes_total{outcome="%s"} %d' % (outcome, count)
+        )
+    return '\n'.join(lines) + '\n'
@@ -1,3 +1,6 @@
+from transaction import TransactionManager
+
+
 def veto_true(request, response):
     return True
 
@@ -14,6 +17,10 @@ def activate_false(request):
     return False
 
 
+def annotate_dummy(request, txn):
+    txn.note('dummy')
+
+
 create_manager = None
 
 
@@ -23,3 +30,56 @@ def dummy_tween_factory(handler, registry):
         return dummy_handler(handler, request)
 
     return dummy_tween
+
+
+class DummyRoute(object):
+    def __init__(self, name='home'):
+        self.name = name
+
+
+class DummyRequest(object):
+    path_info = '/'
+
+    def __init__(self, route=None, registry=None, params=None):
+        if registry is None:
+            registry = {}
+        self.matched_route = route
+        self.registry = registry
+        self.params = params or {}
+        self.environ = {}
+        self.tm = TransactionManager(explicit=True)
+
+
+class DummyDataManager(object):
+    def __init__(self, fail=False):
+        self.fail = fail
+
+    def abort(self, txn):
+        pass
+
+    def tpc_begin(self, txn):
+        pass
+
+    def commit(self, txn):
+        pass
+
+    def tpc_vote(self, txn):
+        if self.fail:
+            raise ValueError('vote')
+
+    def tpc_finish(self, txn):
+        pass
+
+    def tpc_abort(self, txn):
+        pass
+
+    def sortKey(self):
+        return 'dummy:%s' % id(self)
+
+
+class DummyClock(object):
+    def __init__(self, now=100.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
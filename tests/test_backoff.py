@@ -0,0 +1,152 @@
+from transaction import TransactionManager
+import unittest
+
+from tests import DummyClock, DummyDataManager, DummyRequest, DummyRoute
+
+
+class DummyRegistry(dict):
+    pass
+
+
+class DummyEvent(object):
+    def __init__(self, request, exception):
+        self.request = request
+        self.exception = exception
+
+
+class Test_resource_types(unittest.TestCase):
+    def _callFUT(self, manager):
+        from pyramid_tm.backoff import resource_types
+
+        return resource_types(manager)
+
+    def test_no_transaction(self):
+        self.assertEqual(self._callFUT(TransactionManager(explicit=True)), ())
+
+    def test_pending(self):
+        from pyramid_tm import LazyTransactionManager
+
+        manager = LazyTransactionManager(TransactionManager(explicit=True))
+        self.assertEqual(self._callFUT(manager), ())
+
+    def test_resources(self):
+        manager = TransactionManager(explicit=True)
+        txn = manager.begin()
+        txn.join(DummyDataManager())
+        txn.join(DummyDataManager())
+        self.assertEqual(self._callFUT(manager), ('DummyDataManager',))
+        manager.abort()
+
+
+class TestContentionBackoff(unittest.TestCase):
+    def setUp(self):
+        self.clock = DummyClock()
+
+    def _makeOne(self, **kw):
+        from pyramid_tm.backoff import ContentionBackoff
+
+        kw.setdefault('random', lambda: 1.0)
+        kw.setdefault('clock', self.clock)
+        return ContentionBackoff(**kw)
+
+    def test_record_window(self):
+        backoff = self._makeOne(window=1.0)
+        self.assertEqual(backoff.record('a'), 1)
+        self.clock.now += 0.5
+        self.assertEqual(backoff.record('a'), 2)
+        self.assertEqual(backoff.record('b'), 1)
+        self.clock.now += 0.75
+        self.assertEqual(backoff.snapshot(), {'a': 1, 'b': 1})
+        self.assertEqual(backoff.record('a'), 2)
+
+    def test_record_maxsize(self):
+        backoff = self._makeOne(maxsize=2)
+        backoff.record('a')
+        backoff.record('b')
+        backoff.record('a')
+        backoff.record('c')
+        # the least recently conflicting key is forgotten
+        self.assertEqual(backoff.snapshot(), {'a': 2, 'c': 1})
+
+    def test_hint(self):
+        backoff = self._makeOne(base=0.01, cap=0.025)
+        request = DummyRequest(DummyRoute('home'))
+        request.tm.begin().join(DummyDataManager())
+        hints = [backoff.hint(request, ValueError()) for _ in range(4)]
+        self.assertEqual(hints, [0.01, 0.02, 0.025, 0.025])
+        # conflicts beyond the cap are not kept
+        self.assertEqual(
+            backoff.snapshot(), {('home', ('DummyDataManager',)): 3}
+        )
+        request.tm.abort()
+
+    def test_hint_jitter(self):
+        backoff = self._makeOne(base=0.01, random=lambda: 0.5)
+        self.assertEqual(backoff.hint(DummyRequest(), ValueError()), 0.005)
+        self.assertEqual(backoff.snapshot(), {(None, ()): 1})
+
+    def test_hint_once(self):
+        from pyramid_tm import get_backoff_hint
+
+        backoff = self._makeOne(base=0.01)
+        exc = ValueError()
+        request = DummyRequest()
+        self.assertEqual(backoff.hint(request, exc), 0.01)
+        self.assertEqual(backoff.hint(request, exc), 0.01)
+        self.assertEqual(get_backoff_hint(exc), 0.01)
+        self.assertEqual(backoff.snapshot(), {(None, ()): 1})
+
+    def test_zero_base(self):
+        backoff = self._makeOne(base=0)
+        self.assertEqual(backoff.hint(DummyRequest(), ValueError()), 0)
+
+
+class Test_get_backoff_hint(unittest.TestCase):
+    def _callFUT(self, exc):
+        from pyramid_tm import get_backoff_hint
+
+        return get_backoff_hint(exc)
+
+    def test_none(self):
+        self.assertIsNone(self._callFUT(ValueError()))
+        self.assertIsNone(self._callFUT(None))
+
+
+class Test_sleep_before_retry(unittest.TestCase):
+    def setUp(self):
+        import pyramid_tm.backoff
+
+        self.sleeps = []
+        orig_sleep = pyramid_tm.backoff.time.sleep
+        pyramid_tm.backoff.time.sleep = self.sleeps.append
+        self.addCleanup(setattr, pyramid_tm.backoff.time, 'sleep', orig_sleep)
+
+    def _callFUT(self, registry, exc):
+        from pyramid_tm import sleep_before_retry
+
+        request = DummyRequest(registry=registry)
+        return sleep_before_retry(DummyEvent(request, exc))
+
+    def _makeRegistry(self, sleep):
+        from pyramid_tm.backoff import ContentionBackoff
+
+        backoff = ContentionBackoff(base=0.01, sleep=sleep, random=lambda: 1)
+        exc = ValueError()
+        backoff.hint(DummyRequest(), exc)
+        return DummyRegistry({'pyramid_tm.backoff': backoff}), exc
+
+    def test_disabled(self):
+        self._callFUT(DummyRegistry(), ValueError())
+        registry, exc = self._makeRegistry(sleep=False)
+        self._callFUT(registry, exc)
+        self.assertEqual(self.sleeps, [])
+
+    def test_sleep(self):
+        registry, exc = self._makeRegistry(sleep=True)
+        self._callFUT(registry, exc)
+        self.assertEqual(self.sleeps, [0.01])
+
+    def test_no_hint(self):
+        registry, exc = self._makeRegistry(sleep=True)
+        self._callFUT(registry, ValueError())
+        self.assertEqual(self.sleeps, [])
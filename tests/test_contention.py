@@ -0,0 +1,127 @@
+import unittest
+
+from tests import DummyClock, DummyDataManager, DummyRequest, DummyRoute
+
+
+class Conflict(Exception):
+    pass
+
+
+class TestContentionTracker(unittest.TestCase):
+    def setUp(self):
+        self.clock = DummyClock(1000.0)
+
+    def _makeOne(self, maxsize=10):
+        from pyramid_tm.contention import ContentionTracker
+
+        return ContentionTracker(maxsize, self.clock)
+
+    def test_record(self):
+        tracker = self._makeOne()
+        request = DummyRequest(DummyRoute('edit'))
+        request.tm.begin().join(DummyDataManager())
+        tracker.record(request, Conflict())
+        self.clock.now += 4
+        tracker.record(request, Conflict())
+        tracker.record(DummyRequest(), ValueError())
+        request.tm.abort()
+        self.assertEqual(
+            tracker.report(),
+            [
+                {
+                    'route': 'edit',
+                    'exception': 'tests.test_contention.Conflict',
+                    'resources': ['DummyDataManager'],
+                    'count': 2,
+                    'rate': 0.5,
+                    'first_seen': 1000.0,
+                    'last_seen': 1004.0,
+                },
+                {
+                    'route': None,
+                    'exception': 'builtins.ValueError',
+                    'resources': [],
+                    'count': 1,
+                    'rate': 1.0,
+                    'first_seen': 1004.0,
+                    'last_seen': 1004.0,
+                },
+            ],
+        )
+
+    def test_record_once(self):
+        tracker = self._makeOne()
+        exc = Conflict()
+        tracker.record(DummyRequest(), exc)
+        tracker.record(DummyRequest(), exc)
+        self.assertEqual(tracker.report()[0]['count'], 1)
+
+    def test_maxsize(self):
+        tracker = self._makeOne(maxsize=2)
+        for name in ('a', 'b', 'a', 'c'):
+            tracker.record(DummyRequest(DummyRoute(name)), Conflict())
+        # the least recently seen combination is forgotten
+        report = tracker.report()
+        self.assertEqual([item['route'] for item in report], ['a', 'c'])
+
+    def test_limit(self):
+        tracker = self._makeOne()
+        for name in ('a', 'b', 'b'):
+            tracker.record(DummyRequest(DummyRoute(name)), Conflict())
+        report = tracker.report(limit=1)
+        self.assertEqual([item['route'] for item in report], ['b'])
+
+    def test_reset(self):
+        tracker = self._makeOne()
+        tracker.record(DummyRequest(), Conflict())
+        tracker.reset()
+        self.assertEqual(tracker.report(), [])
+
+
+class Test_get_contention_report(unittest.TestCase):
+    def _callFUT(self, registry, limit=10):
+        from pyramid_tm import get_contention_report
+
+        return get_contention_report(registry, limit)
+
+    def test_disabled(self):
+        self.assertEqual(self._callFUT({}), [])
+
+    def test_enabled(self):
+        from pyramid_tm.contention import ContentionTracker
+
+        tracker = ContentionTracker()
+        tracker.record(DummyRequest(), Conflict())
+        tracker.record(DummyRequest(DummyRoute('home')), Conflict())
+        result = self._callFUT({'pyramid_tm.contention': tracker}, 1)
+        self.assertEqual(len(result), 1)
+
+
+class Test_contention_report_view(unittest.TestCase):
+    def _callFUT(self, request):
+        from pyramid_tm import contention_report_view
+
+        return contention_report_view(request)
+
+    def _makeRequest(self, params=None):
+        from pyramid_tm.contention import ContentionTracker
+
+        tracker = ContentionTracker()
+        for name in ('a', 'b'):
+            tracker.record(DummyRequest(DummyRoute(name)), Conflict())
+        registry = {'pyramid_tm.contention': tracker}
+        return DummyRequest(registry=registry, params=params)
+
+    def test_it(self):
+        result = self._callFUT(self._makeRequest())
+        self.assertEqual(len(result['hot_spots']), 2)
+
+    def test_limit(self):
+        result = self._callFUT(self._makeRequest({'limit': '1'}))
+        self.assertEqual(len(result['hot_spots']), 1)
+
+    def test_invalid_limit(self):
+        from pyramid.httpexceptions import HTTPBadRequest
+
+        request = self._makeRequest({'limit': 'all'})
+        self.assertRaises(HTTPBadRequest, self._callFUT, request)
@@ -0,0 +1,205 @@
+import threading
+import time
+import unittest
+
+from tests import DummyDataManager, DummyRequest
+
+
+class TestAfterCommitExecutor(unittest.TestCase):
+    def _makeOne(self, workers=1, queue_size=10):
+        from pyramid_tm.hooks import AfterCommitExecutor
+
+        executor = AfterCommitExecutor(workers, queue_size)
+        self.addCleanup(executor.shutdown, 5)
+        return executor
+
+    def _blockWorker(self, executor):
+        started = threading.Event()
+        release = threading.Event()
+
+        def hook():
+            started.set()
+            release.wait(5)
+
+        executor.submit(hook)
+        started.wait(5)
+        return release
+
+    def test_submit(self):
+        executor = self._makeOne()
+        calls = []
+
+        def hook(*args, **kws):
+            calls.append((threading.current_thread().name, args, kws))
+
+        executor.submit(hook, ('a',), {'b': 1})
+        self.assertTrue(executor.shutdown(5))
+        self.assertEqual(
+            calls, [('pyramid_tm-after-commit-0', ('a',), {'b': 1})]
+        )
+        snapshot = executor.snapshot()
+        self.assertEqual(snapshot['queued'], 1)
+        self.assertEqual(snapshot['completed'], 1)
+        self.assertEqual(snapshot['inline'], 0)
+        self.assertEqual(snapshot['failed'], 0)
+        self.assertEqual(snapshot['pending'], 0)
+        self.assertGreaterEqual(snapshot['run']['max'], 0)
+        self.assertGreaterEqual(snapshot['wait']['sum'], 0)
+
+    def test_backpressure(self):
+        executor = self._makeOne(queue_size=1)
+        release = self._blockWorker(executor)
+        calls = []
+        hook = lambda: calls.append(threading.current_thread().name)
+        executor.submit(hook)
+        # the queue is full so the hook runs in the caller
+        executor.submit(hook)
+        self.assertEqual(calls, [threading.current_thread().name])
+        release.set()
+        self.assertTrue(executor.shutdown(5))
+        self.assertEqual(len(calls), 2)
+        snapshot = executor.snapshot()
+        self.assertEqual(snapshot['queued'], 2)
+        self.assertEqual(snapshot['inline'], 1)
+        self.assertEqual(snapshot['completed'], 3)
+
+    def test_failed_hook(self):
+        executor = self._makeOne()
+
+        def hook():
+            raise ValueError
+
+        with self.assertLogs('pyramid_tm.hooks', 'ERROR'):
+            executor.submit(hook)
+            executor.shutdown()
+        self.assertEqual(executor.snapshot()['failed'], 1)
+
+    def test_submit_after_shutdown(self):
+        executor = self._makeOne()
+        self.assertTrue(executor.shutdown())
+        calls = []
+        executor.submit(calls.append, ('a',))
+        self.assertEqual(calls, ['a'])
+        self.assertEqual(executor.snapshot()['inline'], 1)
+
+    def test_shutdown_timeout(self):
+        executor = self._makeOne()
+        release = self._blockWorker(executor)
+        self.addCleanup(release.set)
+        self.assertFalse(executor.shutdown(0.01))
+
+    def test_shutdown_queue_full(self):
+        executor = self._makeOne(queue_size=1)
+        release = self._blockWorker(executor)
+        self.addCleanup(release.set)
+        executor.submit(lambda: None)
+        self.assertFalse(executor.shutdown(0))
+
+    def test_shutdown_runs_leftover_hooks(self):
+        executor = self._makeOne()
+        calls = []
+        # hooks which were queued after the workers stopped
+        executor._queue.put((calls.append, ('a',), {}, time.perf_counter()))
+        executor._queue.put(None)
+        self.assertTrue(executor.shutdown())
+        self.assertEqual(calls, ['a'])
+        self.assertEqual(executor.snapshot()['inline'], 1)
+
+    def test_restart_after_fork(self):
+        executor = self._makeOne()
+        executor.submit(lambda: None)
+        executor._start()
+        threads = list(executor._threads)
+        # pretend the process forked
+        executor._pid = -1
+        calls = []
+        executor.submit(calls.append, ('a',))
+        self.assertNotEqual(executor._threads, threads)
+        # the threads of the parent process only exist there
+        executor._queue.put(None)
+        self.assertTrue(executor.shutdown(5))
+        threads[0].join(5)
+        self.assertEqual(calls, ['a'])
+
+
+class Test_add_async_after_commit_hook(unittest.TestCase):
+    def _callFUT(self, request, hook, args=(), kws=None):
+        from pyramid_tm import add_async_after_commit_hook
+
+        return add_async_after_commit_hook(request, hook, args, kws)
+
+    def test_synchronous(self):
+        request = DummyRequest()
+        calls = []
+        request.tm.begin()
+        self._callFUT(request, calls.append, ['a'])
+        self.assertEqual(calls, [])
+        request.tm.commit()
+        self.assertEqual(calls, ['a'])
+
+    def test_abort(self):
+        request = DummyRequest()
+        calls = []
+        request.tm.begin()
+        self._callFUT(request, calls.append, ('a',))
+        request.tm.abort()
+        self.assertEqual(calls, [])
+
+    def test_failed_commit(self):
+        request = DummyRequest()
+        calls = []
+        request.tm.begin().join(DummyDataManager(fail=True))
+        self._callFUT(request, calls.append, ('a',))
+        self.assertRaises(ValueError, request.tm.commit)
+        request.tm.abort()
+        self.assertEqual(calls, [])
+
+    def test_executor(self):
+        from pyramid_tm.hooks import AfterCommitExecutor
+
+        executor = AfterCommitExecutor(1)
+        request = DummyRequest(
+            registry={'pyramid_tm.after_commit_executor': executor}
+        )
+        calls = []
+        request.tm.begin().join(DummyDataManager())
+        self._callFUT(request, lambda **kws: calls.append(kws), kws={'a': 1})
+        request.tm.commit()
+        self.assertTrue(executor.shutdown(5))
+        self.assertEqual(calls, [{'a': 1}])
+        self.assertEqual(executor.snapshot()['queued'], 1)
+
+
+class Test_get_after_commit_stats(unittest.TestCase):
+    def _callFUT(self, registry):
+        from pyramid_tm import get_after_commit_stats
+
+        return get_after_commit_stats(registry)
+
+    def test_disabled(self):
+        self.assertIsNone(self._callFUT({}))
+
+    def test_enabled(self):
+        from pyramid_tm.hooks import AfterCommitExecutor
+
+        executor = AfterCommitExecutor()
+        result = self._callFUT({'pyramid_tm.after_commit_executor': executor})
+        self.assertEqual(result['queued'], 0)
+
+
+class Test_shutdown_after_commit_hooks(unittest.TestCase):
+    def _callFUT(self, registry):
+        from pyramid_tm import shutdown_after_commit_hooks
+
+        return shutdown_after_commit_hooks(registry)
+
+    def test_disabled(self):
+        self.assertTrue(self._callFUT({}))
+
+    def test_enabled(self):
+        from pyramid_tm.hooks import AfterCommitExecutor
+
+        executor = AfterCommitExecutor()
+        registry = {'pyramid_tm.after_commit_executor': executor}
+        self.assertTrue(self._callFUT(registry))
+        self.assertTrue(executor._closed)
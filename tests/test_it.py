@@ -3,9 +3,48 @@ from pyramid import testing
 import transaction
 from transaction import TransactionManager
 import unittest
+import warnings
 import webtest
 
-from tests import activate_false, create_manager, dummy_tween_factory
+from tests import (
+    DummyClock,
+    activate_false,
+    create_manager,
+    dummy_tween_factory,
+)
+
+
+def skip_if_missing(module):  # pragma: no cover
+    def wrapper(fn):
+        try:
+            __import__(module)
+        except ImportError:
+            return
+
+        @functools.wraps(fn)
+        def wrapped(*args, **kwargs):
+            return fn(*args, **kwargs)
+
+        return wrapped
+
+    return wrapper
+
+
+def skip_if_package_lt(pkg, version):  # pragma: no cover
+    import pkg_resources
+
+    def wrapper(fn):
+        dist = pkg_resources.get_distribution(pkg)
+        if dist.parsed_version < pkg_resources.parse_version(version):
+            return
+
+        @functools.wraps(fn)
+        def wrapped(*args, **kwargs):
+            return fn(*args, **kwargs)
+
+        return wrapped
+
+    return wrapper
 
 
 class TestDefaultCommitVeto(unittest.TestCase):
@@ -59,6 +98,76 @@ class TestDefaultCommitVeto(unittest.TestCase):
         self.assertTrue(self._callFUT(response))
 
 
+class TestStatusCommitVeto(unittest.TestCase):
+    def _makeOne(self, statuses='4xx,5xx', header='x-tm'):
+        from pyramid_tm import StatusCommitVeto
+
+        return StatusCommitVeto(statuses, header)
+
+    def test_it_true_500(self):
+        veto = self._makeOne()
+        self.assertTrue(veto(None, DummyResponse('500 Server Error')))
+
+    def test_it_true_411(self):
+        veto = self._makeOne()
+        self.assertTrue(veto(None, DummyResponse('411 Length Required')))
+
+    def test_it_false_200(self):
+        veto = self._makeOne()
+        self.assertFalse(veto(None, DummyResponse('200 OK')))
+
+    def test_it_false_302(self):
+        veto = self._makeOne()
+        self.assertFalse(veto(None, DummyResponse('302 Found')))
+
+    def test_exclusion(self):
+        veto = self._makeOne('4xx, 5xx, !409')
+        self.assertTrue(veto(None, DummyResponse('410 Gone')))
+        self.assertFalse(veto(None, DummyResponse('409 Conflict')))
+
+    def test_codes_and_ranges(self):
+        veto = self._makeOne('200 300-302 !301')
+        self.assertTrue(veto(None, DummyResponse('200 OK')))
+        self.assertTrue(veto(None, DummyResponse('302 Found')))
+        self.assertFalse(veto(None, DummyResponse('301 Moved Permanently')))
+        self.assertFalse(veto(None, DummyResponse('500 Server Error')))
+        self.assertEqual(veto.codes, frozenset(['200', '300', '302']))
+
+    def test_invalid(self):
+        from pyramid.exceptions import ConfigurationError
+
+        for spec in ('6xx', 'abc', '500-400', '99', '!'):
+            self.assertRaises(ConfigurationError, self._makeOne, spec)
+
+    def test_it_false_x_tm_commit(self):
+        veto = self._makeOne()
+        response = DummyResponse('500 Server Error', {'x-tm': 'commit'})
+        self.assertFalse(veto(None, response))
+
+    def test_it_true_x_tm_abort(self):
+        veto = self._makeOne()
+        self.assertTrue(veto(None, DummyResponse('200 OK', {'x-tm': 'abort'})))
+
+    def test_without_header(self):
+        veto = self._makeOne(header=None)
+        response = DummyResponse('500 Server Error', {'x-tm': 'commit'})
+        self.assertTrue(veto(None, response))
+
+    def test_webob_response(self):
+        from pyramid.response import Response
+
+        veto = self._makeOne(header='X-Tm')
+        response = Response(status=200)
+        self.assertFalse(veto(None, response))
+        response.headers['X-TM'] = 'abort'
+        self.assertTrue(veto(None, response))
+        response = Response(status=500)
+        response.headers['x-tm'] = 'commit'
+        self.assertFalse(veto(None, response))
+        response.headers['x-tm-other'] = 'abort'
+        self.assertFalse(veto(None, response))
+
+
 class Test_tm_tween_factory(unittest.TestCase):
     def setUp(self):
         self.txn = DummyTransaction()
@@ -175,6 +284,37 @@ class Test_tm_tween_factory(unittest.TestCase):
         result = self._callFUT()
         self.assertEqual(self.txn.user, None)
 
+    def test_handler_doomed_skips_annotation(self):
+        self.config.testing_securitypolicy(userid='phred')
+        txn = DummyTransaction(True)
+        self._callFUT(txn=txn)
+        self.assertEqual(txn.user, None)
+        self.assertFalse(hasattr(txn, '_note'))
+
+    def test_custom_annotators_dotted(self):
+        self.config.testing_securitypolicy(userid='phred')
+        self.settings['tm.annotators'] = 'tests.annotate_dummy'
+        self._callFUT()
+        self.assertEqual(self.txn._note, 'dummy')
+        self.assertEqual(self.txn.user, None)
+
+    def test_custom_annotators_list(self):
+        from pyramid_tm import annotate_path, annotate_user
+
+        self.config.testing_securitypolicy(userid='phred')
+        self.settings['tm.annotators'] = [annotate_user, annotate_path]
+        self._callFUT()
+        self.assertEqual(self.txn._note, '/')
+        self.assertEqual(self.txn.user, 'phred')
+
+    def test_no_annotators(self):
+        self.config.testing_securitypolicy(userid='phred')
+        self.settings['tm.annotators'] = ''
+        self._callFUT()
+        self.assertEqual(self.txn.before_commit_hooks, [])
+        self.assertEqual(self.txn.user, None)
+        self.assertTrue(self.txn.committed)
+
     def test_handler_notes(self):
         self._callFUT()
         self.assertEqual(self.txn._note, '/')
@@ -326,6 +466,30 @@ class Test_tm_tween_factory(unittest.TestCase):
         self.assertFalse(self.txn.aborted)
         self.assertTrue(self.txn.committed)
 
+    def test_veto_status(self):
+        self.settings['tm.veto_status'] = '4xx,5xx,!409'
+        for status, committed in (('409 Conflict', 1), ('500 Error', 0)):
+            txn = DummyTransaction()
+            self.response.status = status
+            self._callFUT(txn=txn)
+            self.assertEqual(txn.committed, committed)
+            self.assertEqual(txn.aborted, 1 - committed)
+
+    def test_veto_status_header(self):
+        self.settings['tm.veto_status'] = '5xx'
+        self.settings['tm.veto_header'] = 'x-commit'
+        self.response.status = '500 Error'
+        self.response.headers['x-commit'] = 'commit'
+        self._callFUT()
+        self.assertTrue(self.txn.committed)
+
+    def test_veto_status_with_commit_veto(self):
+        from pyramid.exceptions import ConfigurationError
+
+        self.settings['tm.veto_status'] = '5xx'
+        self.settings['tm.commit_veto'] = 'tests.veto_true'
+        self.assertRaises(ConfigurationError, self._callFUT)
+
     def test_commitonly(self):
         result = self._callFUT()
         self.assertEqual(result, self.response)
@@ -341,269 +505,2350 @@ class Test_tm_tween_factory(unittest.TestCase):
         self.assertTrue(self.txn.aborted)
         self.assertFalse(self.txn.committed)
 
+    def test_lazy_begin_without_join(self):
+        self.config.testing_securitypolicy(userid='phred')
+        self.settings['tm.lazy_begin'] = 'true'
+        result = self._callFUT()
+        self.assertEqual(result, self.response)
+        self.assertFalse(self.txn.began)
+        self.assertFalse(self.txn.committed)
+        self.assertFalse(self.txn.aborted)
+        self.assertEqual(self.txn.user, None)
+        self.assertTrue(self.request.tm is self.txn)
 
-class Test_create_tm(unittest.TestCase):
-    def setUp(self):
-        self.request = DummyRequest()
-        self.request.registry = Dummy(settings={})
-        # Get rid of the request.tm attribute since it shouldn't be here yet.
-        del self.request.tm
+    def test_lazy_begin_with_join(self):
+        from pyramid_tm import LazyTransactionManager
 
-    def tearDown(self):
-        testing.tearDown()
+        self.config.testing_securitypolicy(userid='phred')
+        self.settings['tm.lazy_begin'] = 'true'
+        managers = []
 
-    def _callFUT(self, request=None):
-        if request is None:
-            request = self.request
-        from pyramid_tm import create_tm
+        def handler(request):
+            managers.append(request.tm)
+            request.tm.get()
+            return self.response
 
-        return create_tm(request)
+        result = self._callFUT(handler=handler)
+        self.assertEqual(result, self.response)
+        self.assertTrue(isinstance(managers[0], LazyTransactionManager))
+        self.assertEqual(self.txn.began, 1)
+        self.assertEqual(self.txn.committed, 1)
+        self.assertFalse(self.txn.aborted)
+        self.assertEqual(self.txn.user, 'phred')
+        self.assertEqual(self.txn._note, '/')
+        self.assertTrue(self.request.tm is self.txn)
 
-    def test_default_threadlocal(self):
-        self.assertTrue(self._callFUT() is transaction.manager)
+    def test_lazy_begin_doomed(self):
+        self.settings['tm.lazy_begin'] = 'true'
+
+        def handler(request):
+            request.tm.doom()
+            return self.response
 
-    def test_overridden_manager_hook(self):
         txn = DummyTransaction()
-        self.request.registry.settings["tm.manager_hook"] = lambda r: txn
-        self.assertTrue(self._callFUT() is txn)
+        txn.doom = lambda: setattr(txn, 'doomed', True)
+        self._callFUT(handler=handler, txn=txn)
+        self.assertEqual(txn.began, 1)
+        self.assertEqual(txn.aborted, 1)
+        self.assertFalse(txn.committed)
 
-    def test_overridden_manager_environ(self):
-        tm = transaction.TransactionManager(explicit=True)
-        self.request.environ['tm.manager'] = tm
-        self.assertTrue(self._callFUT() is tm)
+    def test_lazy_begin_handler_exception(self):
+        self.settings['tm.lazy_begin'] = 'true'
 
+        def handler(request):
+            raise NotImplementedError
 
-class Test_includeme(unittest.TestCase):
-    def test_it(self):
-        from pyramid.tweens import EXCVIEW
+        self.txn.retryable = True
+        self.assertRaises(NotImplementedError, self._callFUT, handler=handler)
+        self.assertFalse(self.txn.began)
+        self.assertFalse(self.txn.aborted)
+        self.assertTrue('tm.active' not in self.request.environ)
 
-        from pyramid_tm import TMActivePredicate, create_tm, includeme
+    def test_lazy_begin_handler_exception_after_join(self):
+        self.settings['tm.lazy_begin'] = 'true'
 
-        config = DummyConfig()
-        includeme(config)
-        self.assertEqual(
-            config.tweens, [('pyramid_tm.tm_tween_factory', None, EXCVIEW)]
-        )
-        self.assertEqual(config.request_methods, [(create_tm, 'tm', True)])
-        self.assertEqual(
-            config.view_predicates, [('tm_active', TMActivePredicate)]
-        )
-        self.assertEqual(len(config.actions), 1)
-        self.assertEqual(config.actions[0][0], None)
-        self.assertEqual(config.actions[0][2], 10)
+        def handler(request):
+            request.tm.get()
+            raise NotImplementedError
 
-    def test_invalid_dotted(self):
-        from pyramid_tm import includeme
+        self.assertRaises(NotImplementedError, self._callFUT, handler=handler)
+        self.assertEqual(self.txn.began, 1)
+        self.assertEqual(self.txn.aborted, 1)
+        self.assertFalse(self.txn.committed)
 
-        config = DummyConfig()
-        config.registry.settings["tm.manager_hook"] = "an.invalid.import"
-        includeme(config)
-        self.assertRaises(ImportError, config.actions[0][1])
+    def _getOutcomes(self):
+        from pyramid_tm import get_stats
 
-    def test_valid_dotted(self):
-        from pyramid_tm import includeme
+        outcomes = get_stats(self.registry)['outcomes']
+        return {k: v for k, v in outcomes.items() if v}
 
-        config = DummyConfig()
-        config.registry.settings["tm.manager_hook"] = "tests.create_manager"
-        includeme(config)
-        config.actions[0][1]()
-        self.assertTrue(
-            config.registry.settings["tm.manager_hook"] is create_manager
+    def test_stats_disabled(self):
+        from pyramid_tm import get_stats
+
+        self._callFUT()
+        self.assertEqual(get_stats(self.registry), None)
+
+    def test_stats_commit(self):
+        from pyramid_tm import get_stats
+
+        self.settings['tm.stats'] = 'true'
+        self._callFUT()
+        stats = get_stats(self.registry)
+        self.assertEqual(
+            sorted(stats['phases']), ['begin', 'commit', 'handler']
         )
+        self.assertEqual(self._getOutcomes(), {'commit': 1})
 
-    def test_it_config(self):
-        config = testing.setUp()
-        try:
-            config.include('pyramid_tm')
-        finally:
-            testing.tearDown()
+    def test_stats_unmanaged(self):
+        from pyramid_tm import get_stats
 
+        self.settings['tm.stats'] = 'true'
+        request = DummyRequest()
+        request.environ['repoze.tm.active'] = True
+        self._callFUT(request=request)
+        self.settings['tm.activate_hook'] = 'tests.activate_false'
+        self._callFUT()
+        stats = get_stats(self.registry)
+        self.assertNotIn('handler', stats['phases'])
+        self.assertEqual(self._getOutcomes(), {})
 
-def skip_if_missing(module):  # pragma: no cover
-    def wrapper(fn):
-        try:
-            __import__(module)
-        except ImportError:
-            return
+    def test_stats_doomed(self):
+        self.settings['tm.stats'] = 'true'
+        self._callFUT(txn=DummyTransaction(doomed=True))
+        self.assertEqual(self._getOutcomes(), {'abort': 1, 'doom': 1})
 
-        @functools.wraps(fn)
-        def wrapped(*args, **kwargs):
-            return fn(*args, **kwargs)
+    def test_stats_veto(self):
+        from pyramid_tm import get_stats
 
-        return wrapped
+        self.settings['tm.stats'] = 'true'
+        self.settings['tm.commit_veto'] = 'tests.veto_true'
+        self._callFUT()
+        self.assertEqual(self._getOutcomes(), {'abort': 1, 'veto': 1})
+        self.assertEqual(
+            get_stats(self.registry)['phases']['veto']['count'], 1
+        )
 
-    return wrapper
+    def test_stats_exception(self):
+        self.settings['tm.stats'] = 'true'
 
+        def handler(request):
+            raise NotImplementedError
 
-def skip_if_package_lt(pkg, version):  # pragma: no cover
-    import pkg_resources
+        self.assertRaises(NotImplementedError, self._callFUT, handler=handler)
+        self.assertEqual(self._getOutcomes(), {'abort': 1, 'exception': 1})
 
-    def wrapper(fn):
-        dist = pkg_resources.get_distribution(pkg)
-        if dist.parsed_version < pkg_resources.parse_version(version):
-            return
+    @skip_if_missing('pyramid_retry')
+    def test_stats_retryable_exception(self):
+        self.settings['tm.stats'] = 'true'
 
-        @functools.wraps(fn)
-        def wrapped(*args, **kwargs):
-            return fn(*args, **kwargs)
+        def handler(request):
+            raise NotImplementedError
 
-        return wrapped
+        self.txn.retryable = True
+        self.assertRaises(NotImplementedError, self._callFUT, handler=handler)
+        self.assertEqual(
+            self._getOutcomes(), {'abort': 1, 'exception': 1, 'retryable': 1}
+        )
 
-    return wrapper
+
+class Test_tm_tween_factory_generic(Test_tm_tween_factory):
+    # run every test against the generic variant of the tween
+    def setUp(self):
+        super(Test_tm_tween_factory_generic, self).setUp()
+        self.settings['tm.specialize'] = False
 
 
-class TestIntegration(unittest.TestCase):
+class Test_tm_tween_factory_variants(unittest.TestCase):
     def setUp(self):
-        self.config = testing.setUp(autocommit=False)
-        self.config.include('pyramid_tm')
+        self.config = testing.setUp()
+        self.registry = self.config.registry
 
     def tearDown(self):
         testing.tearDown()
 
-    def _makeApp(self):
-        app = self.config.make_wsgi_app()
-        return webtest.TestApp(app)
+    def _callFUT(self, **settings):
+        from pyramid_tm import tm_tween_factory
 
-    def test_it(self):
-        config = self.config
-        dm = DummyDataManager()
+        self.registry.settings.update(settings)
+        return tm_tween_factory(None, self.registry).__name__
 
-        def view(request):
-            dm.bind(request.tm)
-            return 'ok'
+    def test_simple(self):
+        self.assertEqual(self._callFUT(), 'simple_tm_tween')
 
-        config.add_view(view, name='', renderer='string')
-        app = self._makeApp()
-        resp = app.get('/')
-        self.assertEqual(resp.body, b'ok')
-        self.assertEqual(dm.action, 'commit')
+    def test_simple_with_veto_and_hook(self):
+        self.assertEqual(
+            self._callFUT(
+                **{
+                    'tm.commit_veto': 'pyramid_tm.default_commit_veto',
+                    'tm.activate_hook': 'tests.activate_true',
+                }
+            ),
+            'simple_tm_tween',
+        )
 
-    @skip_if_missing('pyramid_retry')
-    def test_transient_error_is_retried(self):
-        from transaction.interfaces import TransientError
+    def test_disabled(self):
+        self.assertEqual(
+            self._callFUT(**{'tm.specialize': 'false'}), 'tm_tween'
+        )
 
-        config = self.config
-        config.add_settings({'retry.attempts': 2})
-        config.include('pyramid_retry')
+    def test_lazy_begin(self):
+        self.assertEqual(self._callFUT(**{'tm.lazy_begin': True}), 'tm_tween')
 
-        class Conflict(TransientError):
-            pass
+    def test_stream(self):
+        self.assertEqual(self._callFUT(**{'tm.stream': True}), 'tm_tween')
 
-        calls = []
+    def test_route_policies(self):
+        self.registry['pyramid_tm.policies'] = {'home': {'stream': True}}
+        self.assertEqual(self._callFUT(), 'tm_tween')
 
-        def view(request):
-            dm = DummyDataManager()
-            dm.bind(request.tm)
-            if len(calls) < 1:
-                calls.append('fail')
-                raise Conflict
-            calls.append('ok')
-            return 'ok'
+    def test_savepoint_subrequests(self):
+        settings = {'tm.savepoint_subrequests': True}
+        self.assertEqual(self._callFUT(**settings), 'tm_tween')
 
-        config.add_view(view, renderer='string')
-        app = self._makeApp()
-        result = app.get('/')
-        self.assertEqual(calls, ['fail', 'ok'])
-        self.assertEqual(result.body, b'ok')
+    def test_timeout(self):
+        self.assertEqual(self._callFUT(**{'tm.timeout': '1'}), 'tm_tween')
+
+
+class TestLazyTransactionManager(unittest.TestCase):
+    def _makeOne(self, manager=None):
+        from pyramid_tm import LazyTransactionManager
+
+        if manager is None:
+            manager = TransactionManager(explicit=True)
+        return LazyTransactionManager(manager)
+
+    def test_get_begins_once(self):
+        tm = self._makeOne()
+        self.assertTrue(tm.pending)
+        txn = tm.get()
+        self.assertFalse(tm.pending)
+        self.assertTrue(tm.get() is txn)
+
+    def test_commit_pending_is_noop(self):
+        from transaction.interfaces import NoTransaction
+
+        tm = self._makeOne()
+        self.assertEqual(tm.commit(), None)
+        self.assertFalse(tm.pending)
+        self.assertRaises(NoTransaction, tm.get)
+
+    def test_abort_pending_is_noop(self):
+        from transaction.interfaces import NoTransaction
+
+        tm = self._makeOne()
+        self.assertEqual(tm.abort(), None)
+        self.assertFalse(tm.pending)
+        self.assertRaises(NoTransaction, tm.get)
+
+    def test_commit_and_abort_after_begin(self):
+        dm = DummyDataManager()
+        tm = self._makeOne()
+        dm.bind(tm)
+        tm.commit()
+        self.assertEqual(dm.action, 'commit')
+
+        dm = DummyDataManager()
+        tm = self._makeOne()
+        dm.bind(tm)
+        tm.abort()
+        self.assertEqual(dm.action, 'abort')
+
+    def test_isDoomed(self):
+        tm = self._makeOne()
+        self.assertFalse(tm.isDoomed())
+        self.assertTrue(tm.pending)
+        tm.doom()
+        self.assertFalse(tm.pending)
+        self.assertTrue(tm.isDoomed())
+
+    def test_savepoint_begins(self):
+        tm = self._makeOne()
+        tm.savepoint()
+        self.assertFalse(tm.pending)
+
+    def test_adopts_current_transaction(self):
+        manager = TransactionManager()
+        tm = self._makeOne(manager)
+        self.assertTrue(tm.pending)
+        txn = manager.get()
+        self.assertFalse(tm.pending)
+        self.assertTrue(tm.get() is txn)
+        self.assertTrue(tm.begin() is not txn)
+        manager.abort()
+
+    def test_aborts_stale_transaction(self):
+        manager = TransactionManager()
+        dm = DummyDataManager()
+        dm.bind(manager)
+        tm = self._makeOne(manager)
+        self.assertEqual(dm.action, 'abort')
+        self.assertTrue(tm.pending)
+        tm.commit()
+        self.assertEqual(dm.action, 'abort')
+
+    def test_does_not_adopt_stale_transaction_explicit(self):
+        from transaction.interfaces import AlreadyInTransaction
+
+        manager = TransactionManager(explicit=True)
+        self.addCleanup(manager.abort)
+        manager.begin()
+        tm = self._makeOne(manager)
+        self.assertTrue(tm.pending)
+        self.assertRaises(AlreadyInTransaction, tm.get)
+
+    def test_begin_adopts_current_transaction(self):
+        manager = TransactionManager(explicit=True)
+        tm = self._makeOne(manager)
+        txn = manager.begin()
+        self.assertTrue(tm.begin() is txn)
+        manager.abort()
+
+    def test_commit_and_abort_adopted_transaction(self):
+        for action in ('commit', 'abort'):
+            manager = TransactionManager()
+            tm = self._makeOne(manager)
+            dm = DummyDataManager()
+            dm.bind(manager)
+            getattr(tm, action)()
+            self.assertEqual(dm.action, action)
+            self.assertFalse(tm.pending)
+
+    def test_adopts_threadlocal_transaction(self):
+        manager = transaction.manager
+        self.addCleanup(manager.abort)
+        tm = self._makeOne(manager)
+        txn = manager.get()
+        self.assertTrue(tm.get() is txn)
+
+    def test_delegates_other_attributes(self):
+        manager = TransactionManager(explicit=True)
+        tm = self._makeOne(manager)
+        self.assertTrue(tm.explicit)
+        self.assertFalse(tm.registeredSynchs())
+
+
+class Test_TransactionAppIter(unittest.TestCase):
+    def _makeOne(self, app_iter):
+        from pyramid_tm import _TransactionAppIter
+
+        self.calls = []
+        return _TransactionAppIter(app_iter, self.calls.append)
+
+    def test_exhausted(self):
+        app_iter = self._makeOne([b'a', b'b'])
+        self.assertEqual(list(app_iter), [b'a', b'b'])
+        app_iter.close()
+        self.assertEqual(self.calls, [False])
+
+    def test_error(self):
+        def body():
+            yield b'a'
+            raise ValueError
+
+        app_iter = self._makeOne(body())
+        self.assertRaises(ValueError, list, app_iter)
+        app_iter.close()
+        self.assertEqual(self.calls, [True])
+
+    def test_closed_early(self):
+        closed = []
+
+        class Body(object):
+            def __iter__(self):
+                yield b'a'
+                yield b'b'  # pragma: no cover
+
+            def close(self):
+                closed.append(True)
+
+        app_iter = self._makeOne(Body())
+        self.assertEqual(next(iter(app_iter)), b'a')
+        app_iter.close()
+        self.assertEqual(self.calls, [True])
+        self.assertEqual(closed, [True])
+
+
+class Test_fast_commit(unittest.TestCase):
+    def setUp(self):
+        self.tm = TransactionManager(explicit=True)
+
+    def _callFUT(self, txn):
+        from pyramid_tm import _fast_commit
+
+        return _fast_commit(txn)
+
+    def test_empty_transaction(self):
+        from transaction.interfaces import NoTransaction
+
+        txn = self.tm.begin()
+        self.assertTrue(self._callFUT(txn))
+        self.assertEqual(txn.status, 'Committed')
+        self.assertRaises(NoTransaction, self.tm.get)
+
+    def test_hooks_are_invoked(self):
+        calls = []
+        txn = self.tm.begin()
+        txn.addBeforeCommitHook(lambda: calls.append('before'))
+        txn.addAfterCommitHook(lambda status: calls.append(status))
+        self.assertTrue(self._callFUT(txn))
+        self.assertEqual(calls, ['before', True])
+
+    def test_before_commit_hook_joins_resource(self):
+        dm = DummyDataManager()
+        txn = self.tm.begin()
+        txn.addBeforeCommitHook(dm.bind, (self.tm,))
+        self.assertFalse(self._callFUT(txn))
+        self.tm.commit()
+        self.assertEqual(dm.action, 'commit')
+
+    def test_with_resources(self):
+        dm = DummyDataManager()
+        txn = self.tm.begin()
+        dm.bind(self.tm)
+        self.assertFalse(self._callFUT(txn))
+        self.assertEqual(txn.status, 'Active')
+
+    def test_with_synchronizers(self):
+        synch = DummySynch()
+        self.tm.registerSynch(synch)
+        txn = self.tm.begin()
+        self.assertFalse(self._callFUT(txn))
+
+    def test_doomed(self):
+        txn = self.tm.begin()
+        txn.doom()
+        self.assertFalse(self._callFUT(txn))
+
+    def test_unknown_transaction_type(self):
+        self.assertFalse(self._callFUT(DummyTransaction()))
+
+    def test_unsupported_transaction_version(self):
+        import pyramid_tm
+
+        self.addCleanup(
+            setattr,
+            pyramid_tm,
+            '_fast_commit_supported',
+            pyramid_tm._fast_commit_supported,
+        )
+        pyramid_tm._fast_commit_supported = False
+        txn = self.tm.begin()
+        self.assertFalse(self._callFUT(txn))
+        self.assertEqual(txn.status, 'Active')
+
+    def test_missing_internals(self):
+        txn = self.tm.begin()
+        del txn._synchronizers
+        self.assertFalse(self._callFUT(txn))
+
+
+class Test_get_counters(unittest.TestCase):
+    def _callFUT(self, registry):
+        from pyramid_tm import get_counters
+
+        return get_counters(registry)
+
+    def test_no_counters(self):
+        self.assertEqual(self._callFUT({}), {})
+
+    def test_snapshot(self):
+        from pyramid_tm import Counters
+
+        counters = Counters()
+        counters.incr('fast_commit')
+        counters.incr('fast_commit')
+        result = self._callFUT({'pyramid_tm.counters': counters})
+        self.assertEqual(result, {'fast_commit': 2})
+
+    def test_snapshot_threads(self):
+        import threading
+
+        from pyramid_tm import Counters
+
+        counters = Counters()
+        counters.incr('fast_commit')
+        thread = threading.Thread(
+            target=lambda: [counters.incr('fast_commit'), counters.incr('x')]
+        )
+        thread.start()
+        thread.join()
+        result = self._callFUT({'pyramid_tm.counters': counters})
+        self.assertEqual(result, {'fast_commit': 2, 'x': 1})
+
+
+class TestRetryableCache(unittest.TestCase):
+    def setUp(self):
+        self.tm = TransactionManager(explicit=True)
+        self.txn = self.tm.begin()
+
+    def tearDown(self):
+        self.tm.abort()
+
+    def _makeOne(self, maxsize=256):
+        from pyramid_tm import RetryableCache
+
+        return RetryableCache(maxsize)
+
+    def test_cacheable_resources(self):
+        dm = DummyRetryDataManager(cacheable=True)
+        dm.bind(self.tm)
+        cache = self._makeOne()
+        self.assertTrue(cache.classify(self.txn, ValueError()))
+        self.assertTrue(cache.classify(self.txn, ValueError()))
+        self.assertFalse(cache.classify(self.txn, TypeError()))
+        self.assertFalse(cache.classify(self.txn, TypeError()))
+        self.assertEqual(dm.calls, 2)
+
+    def test_without_resources(self):
+        from transaction.interfaces import TransientError
+
+        cache = self._makeOne()
+        self.assertTrue(cache.classify(self.txn, TransientError()))
+        self.assertFalse(cache.classify(self.txn, ValueError()))
+        self.assertEqual(len(cache._values), 2)
+
+    def test_uncacheable_resources(self):
+        dm = DummyRetryDataManager()
+        dm.bind(self.tm)
+        cache = self._makeOne()
+        self.assertTrue(cache.classify(self.txn, ValueError()))
+        self.assertTrue(cache.classify(self.txn, ValueError()))
+        self.assertEqual(dm.calls, 2)
+        self.assertEqual(cache._values, {})
+
+    def test_resources_without_should_retry(self):
+        DummyDataManager().bind(self.tm)
+        cache = self._makeOne()
+        self.assertFalse(cache.classify(self.txn, ValueError()))
+        self.assertEqual(len(cache._values), 1)
+
+    def test_eviction(self):
+        cache = self._makeOne(maxsize=2)
+        cache.classify(self.txn, ValueError())
+        cache.classify(self.txn, TypeError())
+        cache.classify(self.txn, KeyError())
+        self.assertEqual(
+            [key[0] for key in cache._values], [TypeError, KeyError]
+        )
+
+
+class Test_tag_error_retryable(unittest.TestCase):
+    def _callFUT(self, exc):
+        from pyramid_tm import tag_error_retryable
+
+        return tag_error_retryable(exc)
 
     @skip_if_missing('pyramid_retry')
-    def test_error_is_retried_with_commit_veto_and_error_view_and_retry_data_manager(
-        self,
-    ):
+    def test_it(self):
+        from pyramid_retry import IRetryableError
+
         class Conflict(Exception):
-            """This is not a Transient error."""
+            pass
 
-        class RetryDataManager(DummyDataManager):
-            """The datamanager wants the Conflict to be retried."""
+        first, second = Conflict(), Conflict()
+        self._callFUT(first)
+        self._callFUT(second)
+        self.assertTrue(IRetryableError.providedBy(first))
+        self.assertTrue(IRetryableError.providedBy(second))
+        self.assertFalse(IRetryableError.providedBy(Conflict()))
+        self.assertIs(first.__provides__, second.__provides__)
+
+    @skip_if_missing('pyramid_retry')
+    def test_builtin_exception(self):
+        from pyramid_retry import IRetryableError
+
+        exc = ValueError()
+        self._callFUT(exc)
+        self.assertTrue(IRetryableError.providedBy(exc))
+        self.assertFalse(IRetryableError.providedBy(ValueError()))
+
+    @skip_if_missing('pyramid_retry')
+    def test_already_provides(self):
+        from pyramid_retry import IRetryableError
+        import zope.interface
+
+        class IOther(zope.interface.Interface):
+            pass
+
+        exc = ValueError()
+        zope.interface.alsoProvides(exc, IOther)
+        self._callFUT(exc)
+        self.assertTrue(IRetryableError.providedBy(exc))
+        self.assertTrue(IOther.providedBy(exc))
+
+    @skip_if_missing('pyramid_retry')
+    def test_specs_are_bounded(self):
+        from pyramid_retry import IRetryableError
+
+        import pyramid_tm
+
+        class Conflict(Exception):
+            pass
+
+        specs = pyramid_tm._retryable_specs
+        orig_size = pyramid_tm._retryable_specs_size
+        pyramid_tm._retryable_specs_size = len(specs)
+        try:
+            exc = Conflict()
+            self._callFUT(exc)
+        finally:
+            pyramid_tm._retryable_specs_size = orig_size
+        self.assertTrue(IRetryableError.providedBy(exc))
+        self.assertNotIn(Conflict, specs)
+
+
+class Test_maybe_tag_retryable(unittest.TestCase):
+    def setUp(self):
+        self.request = DummyRequest()
+        self.request.tm = TransactionManager(explicit=True)
+        self.request.tm.begin()
+
+    def tearDown(self):
+        self.request.tm.abort()
+
+    def _callFUT(self, exc, cache=None):
+        from pyramid_tm import maybe_tag_retryable
+
+        return maybe_tag_retryable(self.request, (type(exc), exc, None), cache)
+
+    @skip_if_missing('pyramid_retry')
+    def test_with_cache(self):
+        from pyramid_retry import IRetryableError
+
+        from pyramid_tm import RetryableCache
+
+        dm = DummyRetryDataManager(cacheable=True)
+        dm.bind(self.request.tm)
+        cache = RetryableCache()
+        exc = ValueError()
+        self._callFUT(exc, cache)
+        self.assertTrue(IRetryableError.providedBy(exc))
+        self._callFUT(ValueError(), cache)
+        self.assertEqual(dm.calls, 1)
+
+    @skip_if_missing('pyramid_retry')
+    def test_already_tagged(self):
+        from pyramid_retry import IRetryableError
+
+        dm = DummyRetryDataManager()
+        dm.bind(self.request.tm)
+        exc = ValueError()
+        self._callFUT(exc)
+        self._callFUT(exc)
+        self.assertTrue(IRetryableError.providedBy(exc))
+        self.assertEqual(dm.calls, 1)
+
+
+class Test_create_tm(unittest.TestCase):
+    def setUp(self):
+        self.request = DummyRequest()
+        self.request.registry = DummyRegistry(settings={})
+        # Get rid of the request.tm attribute since it shouldn't be here yet.
+        del self.request.tm
+
+    def tearDown(self):
+        testing.tearDown()
+
+    def _callFUT(self, request=None):
+        if request is None:
+            request = self.request
+        from pyramid_tm import create_tm
+
+        return create_tm(request)
+
+    def test_default_threadlocal(self):
+        self.assertTrue(self._callFUT() is transaction.manager)
+
+    def test_overridden_manager_hook(self):
+        txn = DummyTransaction()
+        self.request.registry.settings["tm.manager_hook"] = lambda r: txn
+        self.assertTrue(self._callFUT() is txn)
+
+    def test_overridden_manager_environ(self):
+        tm = transaction.TransactionManager(explicit=True)
+        self.request.environ['tm.manager'] = tm
+        self.assertTrue(self._callFUT() is tm)
+
+    def test_frozen_settings(self):
+        from pyramid_tm import _parse_settings
+
+        txn = DummyTransaction()
+        registry = self.request.registry
+        registry['pyramid_tm.settings'] = _parse_settings(
+            {'tm.manager_hook': lambda r: txn}
+        )
+        # the frozen settings are used instead of the raw ones
+        registry.settings['tm.manager_hook'] = 'an.invalid.import'
+        self.assertTrue(self._callFUT() is txn)
+
+
+class Test_thread_manager(unittest.TestCase):
+    def _callFUT(self, request=None):
+        from pyramid_tm import thread_manager
+
+        return thread_manager(request)
+
+    def test_it(self):
+        manager = self._callFUT()
+        self.assertIs(manager, transaction.manager.manager)
+        txn = manager.begin()
+        try:
+            self.assertIs(transaction.get(), txn)
+        finally:
+            manager.abort()
+
+    def test_per_thread(self):
+        import threading
+
+        managers = []
+        thread = threading.Thread(
+            target=lambda: managers.append(self._callFUT())
+        )
+        thread.start()
+        thread.join()
+        self.assertIsNot(managers[0], self._callFUT())
+
+
+class Test_includeme(unittest.TestCase):
+    def test_it(self):
+        from pyramid.tweens import EXCVIEW
+
+        from pyramid_tm import (
+            TMActivePredicate,
+            create_tm,
+            includeme,
+            set_tm_policy,
+            tm_readonly_view,
+        )
+
+        config = DummyConfig()
+        includeme(config)
+        self.assertEqual(
+            config.tweens, [('pyramid_tm.tm_tween_factory', None, EXCVIEW)]
+        )
+        self.assertEqual(config.request_methods, [(create_tm, 'tm', True)])
+        self.assertEqual(
+            config.view_predicates, [('tm_active', TMActivePredicate)]
+        )
+        self.assertEqual(config.directives, [('set_tm_policy', set_tm_policy)])
+        self.assertEqual(config.view_derivers, [tm_readonly_view])
+        self.assertEqual(len(config.actions), 1)
+        self.assertEqual(config.actions[0][0], None)
+        self.assertEqual(config.actions[0][2], 10)
+
+    @skip_if_missing('pyramid_retry')
+    def test_before_retry_subscriber(self):
+        from pyramid_retry import IBeforeRetry
+
+        from pyramid_tm import includeme, sleep_before_retry
+
+        config = DummyConfig()
+        includeme(config)
+        self.assertEqual(
+            config.subscribers, [(sleep_before_retry, IBeforeRetry)]
+        )
+
+    def test_invalid_dotted(self):
+        from pyramid_tm import includeme
+
+        config = DummyConfig()
+        config.registry.settings["tm.manager_hook"] = "an.invalid.import"
+        includeme(config)
+        self.assertRaises(ImportError, config.actions[0][1])
+
+    def test_invalid_setting(self):
+        from pyramid.exceptions import ConfigurationError
+
+        from pyramid_tm import includeme
+
+        config = DummyConfig()
+        config.registry.settings['tm.pool_size'] = 'many'
+        includeme(config)
+        self.assertRaises(ConfigurationError, config.actions[0][1])
+
+    def test_invalid_boolean_setting(self):
+        from pyramid.exceptions import ConfigurationError
+
+        from pyramid_tm import includeme
+
+        config = DummyConfig()
+        config.registry.settings['tm.lazy_begin'] = 'ture'
+        includeme(config)
+        self.assertRaises(ConfigurationError, config.actions[0][1])
+
+    def test_boolean_settings(self):
+        from pyramid_tm import includeme
+
+        config = DummyConfig()
+        config.registry.settings.update(
+            {
+                'tm.lazy_begin': ' Yes ',
+                'tm.stream': False,
+                'tm.stats': 'off',
+                'tm.readonly_warn_joins': 'true',
+            }
+        )
+        includeme(config)
+        config.actions[0][1]()
+        tm_settings = config.registry['pyramid_tm.settings']
+        self.assertTrue(tm_settings.lazy_begin)
+        self.assertFalse(tm_settings.stream)
+        self.assertFalse(tm_settings.stats)
+        self.assertTrue(tm_settings.readonly_warn_joins)
+
+    def test_frozen_settings(self):
+        from pyramid_tm import includeme
+
+        config = DummyConfig()
+        config.registry.settings['tm.timeout'] = '5'
+        includeme(config)
+        config.actions[0][1]()
+        tm_settings = config.registry['pyramid_tm.settings']
+        self.assertEqual(tm_settings.timeout, 5.0)
+        self.assertRaises(AttributeError, setattr, tm_settings, 'timeout', 1)
+
+    def test_valid_dotted(self):
+        from pyramid_tm import includeme
+
+        config = DummyConfig()
+        config.registry.settings["tm.manager_hook"] = "tests.create_manager"
+        includeme(config)
+        config.actions[0][1]()
+        self.assertTrue(
+            config.registry.settings["tm.manager_hook"] is create_manager
+        )
+
+    def test_it_config(self):
+        config = testing.setUp()
+        try:
+            config.include('pyramid_tm')
+        finally:
+            testing.tearDown()
+
+
+class TestIntegration(unittest.TestCase):
+    def setUp(self):
+        self.config = testing.setUp(autocommit=False)
+        self.config.include('pyramid_tm')
+
+    def tearDown(self):
+        testing.tearDown()
+
+    def _makeApp(self):
+        app = self.config.make_wsgi_app()
+        return webtest.TestApp(app)
+
+    def test_it(self):
+        config = self.config
+        dm = DummyDataManager()
+
+        def view(request):
+            dm.bind(request.tm)
+            return 'ok'
+
+        config.add_view(view, name='', renderer='string')
+        app = self._makeApp()
+        resp = app.get('/')
+        self.assertEqual(resp.body, b'ok')
+        self.assertEqual(dm.action, 'commit')
+
+    @skip_if_missing('pyramid_retry')
+    def test_transient_error_is_retried(self):
+        from transaction.interfaces import TransientError
+
+        config = self.config
+        config.add_settings({'retry.attempts': 2})
+        config.include('pyramid_retry')
+
+        class Conflict(TransientError):
+            pass
+
+        calls = []
+
+        def view(request):
+            dm = DummyDataManager()
+            dm.bind(request.tm)
+            if len(calls) < 1:
+                calls.append('fail')
+                raise Conflict
+            calls.append('ok')
+            return 'ok'
+
+        config.add_view(view, renderer='string')
+        app = self._makeApp()
+        result = app.get('/')
+        self.assertEqual(calls, ['fail', 'ok'])
+        self.assertEqual(result.body, b'ok')
+
+    @skip_if_missing('pyramid_retry')
+    def test_backoff(self):
+        from transaction.interfaces import TransientError
+
+        from pyramid_tm import get_backoff_hint
+
+        config = self.config
+        config.add_settings(
+            {
+                'retry.attempts': 3,
+                'tm.backoff': True,
+                'tm.backoff_base': '0.001',
+                'tm.backoff_sleep': True,
+            }
+        )
+        config.include('pyramid_retry')
+        errors = []
+
+        def view(request):
+            DummyDataManager().bind(request.tm)
+            if len(errors) < 2:
+                errors.append(TransientError())
+                raise errors[-1]
+            return 'ok'
+
+        config.add_route('home', '/')
+        config.add_view(view, route_name='home', renderer='string')
+        app = self._makeApp()
+        resp = app.get('/')
+        self.assertEqual(resp.body, b'ok')
+        hints = [get_backoff_hint(exc) for exc in errors]
+        self.assertTrue(0 <= hints[0] <= 0.001)
+        self.assertTrue(0 <= hints[1] <= 0.002)
+        backoff = app.app.registry['pyramid_tm.backoff']
+        self.assertEqual(
+            backoff.snapshot(), {('home', ('DummyDataManager',)): 2}
+        )
+
+    @skip_if_missing('pyramid_retry')
+    def test_backoff_commit_failure(self):
+        from transaction.interfaces import TransientError
+
+        from pyramid_tm import get_backoff_hint
+
+        exc = TransientError()
+        self.config.add_settings({'tm.backoff': True})
+        self._addFailingCommitView(exc, [1])
+        app = self._makeApp()
+        resp = app.get('/')
+        self.assertEqual(resp.body, b'ok')
+        self.assertIsNotNone(get_backoff_hint(exc))
+
+    @skip_if_missing('pyramid_retry')
+    def test_contention(self):
+        from transaction.interfaces import TransientError
+
+        from pyramid_tm import contention_report_view
+
+        config = self.config
+        config.add_settings({'retry.attempts': 2, 'tm.contention': True})
+        config.include('pyramid_retry')
+
+        def view(request):
+            DummyDataManager().bind(request.tm)
+            raise TransientError
+
+        config.add_route('edit', '/edit')
+        config.add_view(view, route_name='edit', renderer='string')
+        config.add_route('contention', '/contention')
+        config.add_view(
+            contention_report_view, route_name='contention', renderer='json'
+        )
+        app = self._makeApp()
+        self.assertRaises(TransientError, app.get, '/edit')
+        report = app.get('/contention').json['hot_spots']
+        self.assertEqual(len(report), 1)
+        self.assertEqual(report[0]['route'], 'edit')
+        self.assertEqual(
+            report[0]['exception'], 'transaction.interfaces.TransientError'
+        )
+        self.assertEqual(report[0]['resources'], ['DummyDataManager'])
+        # both attempts are recorded
+        self.assertEqual(report[0]['count'], 2)
+
+    @skip_if_missing('pyramid_retry')
+    def test_contention_commit_failure(self):
+        from pyramid.httpexceptions import HTTPConflict
+        from transaction.interfaces import TransientError
+
+        from pyramid_tm import get_contention_report
+
+        config = self.config
+        config.add_settings({'retry.attempts': 1, 'tm.contention': True})
+        config.include('pyramid_retry')
+
+        class FailingDataManager(DummyDataManager):
+            def tpc_vote(self, transaction):
+                raise TransientError
+
+        def view(request):
+            FailingDataManager().bind(request.tm)
+            return 'ok'
+
+        config.add_view(view, renderer='string')
+        config.add_view(lambda request: HTTPConflict(), context=TransientError)
+        app = self._makeApp()
+        # the failure of the last attempt is rendered and recorded too
+        app.get('/', status=409)
+        report = get_contention_report(app.app.registry)
+        self.assertEqual(report[0]['count'], 1)
+        self.assertEqual(report[0]['resources'], ['FailingDataManager'])
+
+    @skip_if_missing('pyramid_retry')
+    def test_contention_commit_failure_retried(self):
+        from transaction.interfaces import TransientError
+
+        from pyramid_tm import get_contention_report
+
+        self.config.add_settings({'tm.contention': True})
+        self._addFailingCommitView(TransientError(), [1])
+        app = self._makeApp()
+        resp = app.get('/')
+        self.assertEqual(resp.body, b'ok')
+        report = get_contention_report(app.app.registry)
+        self.assertEqual(report[0]['count'], 1)
+
+    def _addFailingCommitView(self, exc, failures):
+        from pyramid.httpexceptions import HTTPConflict
+
+        config = self.config
+        config.add_settings({'retry.attempts': 2})
+        config.include('pyramid_retry')
+        rendered = []
+
+        class FailingDataManager(DummyDataManager):
+            def tpc_vote(self, transaction):
+                if failures:
+                    failures.pop()
+                    raise exc
+
+        def view(request):
+            FailingDataManager().bind(request.tm)
+            return 'ok'
+
+        def exc_view(request):
+            rendered.append(request.exception)
+            return HTTPConflict()
+
+        config.add_view(view, renderer='string')
+        config.add_view(exc_view, context=type(exc))
+        return rendered
+
+    def test_commit_failure_explicit_manager_without_exception_view(self):
+        config = self.config
+        config.add_settings({'tm.manager_hook': 'pyramid_tm.explicit_manager'})
+
+        class FailingDataManager(DummyDataManager):
+            def tpc_vote(self, transaction):
+                raise ValueError('vote')
+
+        def view(request):
+            FailingDataManager().bind(request.tm)
+            return 'ok'
+
+        config.add_view(view, renderer='string')
+        app = self._makeApp()
+        # the original error, not one raised by aborting the transaction
+        # again once it was already aborted
+        with self.assertRaises(ValueError) as cm:
+            app.get('/')
+        self.assertEqual(str(cm.exception), 'vote')
+
+    @skip_if_missing('pyramid_retry')
+    def test_retryable_commit_failure_is_not_rendered(self):
+        from transaction.interfaces import TransientError
+
+        rendered = self._addFailingCommitView(TransientError(), [1])
+        app = self._makeApp()
+        resp = app.get('/')
+        self.assertEqual(resp.body, b'ok')
+        self.assertEqual(rendered, [])
+
+    @skip_if_missing('pyramid_retry')
+    def test_retryable_commit_failure_is_rendered_on_last_attempt(self):
+        from transaction.interfaces import TransientError
+
+        exc = TransientError()
+        rendered = self._addFailingCommitView(exc, [1, 1])
+        app = self._makeApp()
+        app.get('/', status=409)
+        self.assertEqual(rendered, [exc])
+
+    @skip_if_missing('pyramid_retry')
+    def test_commit_failure_is_rendered_if_not_retryable(self):
+        exc = ValueError()
+        rendered = self._addFailingCommitView(exc, [1])
+        app = self._makeApp()
+        app.get('/', status=409)
+        self.assertEqual(rendered, [exc])
+
+    @skip_if_missing('pyramid_retry')
+    def test_retryable_cache(self):
+        config = self.config
+        config.add_settings(
+            {'retry.attempts': 3, 'tm.retryable_cache_size': '16'}
+        )
+        config.include('pyramid_retry')
+        dms = []
+
+        def view(request):
+            dm = DummyRetryDataManager(cacheable=True)
+            dm.bind(request.tm)
+            dms.append(dm)
+            if len(dms) < 3:
+                raise ValueError
+            return 'ok'
+
+        config.add_view(view, renderer='string')
+        app = self._makeApp()
+        self.assertEqual(app.get('/').body, b'ok')
+        # the second failure is classified by the cache
+        self.assertEqual([dm.calls for dm in dms], [1, 0, 0])
+
+    @skip_if_missing('pyramid_retry')
+    def test_error_is_retried_with_commit_veto_and_error_view_and_retry_data_manager(
+        self,
+    ):
+        class Conflict(Exception):
+            """This is not a Transient error."""
+
+        class RetryDataManager(DummyDataManager):
+            """The datamanager wants the Conflict to be retried."""
+
+            def should_retry(self, exception):
+                return isinstance(exception, Conflict)
+
+        def exc_view(request):
+            return 'failure'
+
+        config = self.config
+        config.add_settings(
+            {
+                'retry.attempts': 2,
+                'tm.commit_veto': lambda request, response: False,
+            }
+        )
+        config.include('pyramid_retry')
+        config.add_view(exc_view, context=Exception, renderer='string')
+
+        calls = []
+
+        def view(request):
+            print(calls)
+            dm = RetryDataManager()
+            dm.bind(request.tm)
+            if len(calls) < 1:
+                calls.append('fail')
+                raise Conflict
+            calls.append('ok')
+            return 'ok'
+
+        config.add_view(view, renderer='string')
+        app = self._makeApp()
+        result = app.get('/')
+        self.assertEqual(calls, ['fail', 'ok'])
+        self.assertEqual(result.body, b'ok')
+
+    def test_unhandled_error_aborts(self):
+        config = self.config
+        dm = DummyDataManager()
+
+        def view(request):
+            dm.bind(request.tm)
+            raise ValueError
+
+        config.add_view(view)
+        app = self._makeApp()
+        self.assertRaises(ValueError, app.get, '/')
+        self.assertEqual(dm.action, 'abort')
+
+    def test_handled_error_aborts(self):
+        config = self.config
+        dm = DummyDataManager()
+
+        def view(request):
+            dm.bind(request.tm)
+            raise ValueError
+
+        config.add_view(view)
+
+        def exc_view(request):
+            return 'failure'
+
+        config.add_view(exc_view, context=ValueError, renderer='string')
+        app = self._makeApp()
+        resp = app.get('/')
+        self.assertEqual(resp.body, b'failure')
+        self.assertEqual(dm.action, 'abort')
+
+    def test_handled_error_commits_with_veto(self):
+        config = self.config
+        dm = DummyDataManager()
+
+        def view(request):
+            dm.bind(request.tm)
+            raise ValueError
+
+        config.add_view(view)
+
+        def exc_view(request):
+            return 'failure'
+
+        def commit_veto(request, response):
+            return request.exception is None
+
+        config.add_settings({'tm.commit_veto': commit_veto})
+        config.add_view(exc_view, context=ValueError, renderer='string')
+        app = self._makeApp()
+        resp = app.get('/')
+        self.assertEqual(resp.body, b'failure')
+        self.assertEqual(dm.action, 'commit')
+
+    def test_lazy_begin_commits_joined_resources(self):
+        config = self.config
+        config.add_settings(
+            {
+                'tm.lazy_begin': True,
+                'tm.manager_hook': 'pyramid_tm.explicit_manager',
+            }
+        )
+        dm = DummyDataManager()
+
+        def view(request):
+            dm.bind(request.tm)
+            return 'ok'
+
+        config.add_view(view, renderer='string')
+        app = self._makeApp()
+        resp = app.get('/')
+        self.assertEqual(resp.body, b'ok')
+        self.assertEqual(dm.action, 'commit')
+
+    def test_lazy_begin_threadlocal_manager(self):
+        # resources joining through the global transaction API and through
+        # request.tm are committed together
+        config = self.config
+        config.add_settings({'tm.lazy_begin': True})
+        self.addCleanup(transaction.manager.abort)
+        dms = []
+
+        def view(request):
+            global_dm = DummyDataManager()
+            global_dm.bind(transaction.manager)
+            dm = DummyDataManager()
+            dm.bind(request.tm)
+            dms.extend([global_dm, dm])
+            if 'fail' in request.params:
+                raise ValueError
+            return 'ok'
+
+        config.add_view(view, renderer='string')
+        app = self._makeApp()
+        app.get('/')
+        self.assertEqual([dm.action for dm in dms], ['commit', 'commit'])
+        self.assertIsNone(transaction.manager.manager._txn)
+        del dms[:]
+        self.assertRaises(ValueError, app.get, '/?fail=1')
+        self.assertEqual([dm.action for dm in dms], ['abort', 'abort'])
+
+    def test_lazy_begin_threadlocal_manager_global_join(self):
+        config = self.config
+        config.add_settings({'tm.lazy_begin': True})
+        self.addCleanup(transaction.manager.abort)
+        dm = DummyDataManager()
+
+        def view(request):
+            dm.bind(transaction.manager)
+            return 'ok'
+
+        config.add_view(view, renderer='string')
+        app = self._makeApp()
+        app.get('/')
+        self.assertEqual(dm.action, 'commit')
+        self.assertIsNone(transaction.manager.manager._txn)
+
+    def test_lazy_begin_aborts_leftover_threadlocal_transaction(self):
+        config = self.config
+        config.add_settings(
+            {'tm.lazy_begin': True, 'tm.activate_hook': self._activate}
+        )
+        self.addCleanup(transaction.manager.abort)
+        dm = DummyDataManager()
+
+        def view(request):
+            if request.params.get('write'):
+                # an unmanaged request leaving a transaction behind
+                dm.bind(transaction.manager)
+            return 'ok'
+
+        config.add_view(view, renderer='string')
+        app = self._makeApp()
+        app.get('/?write=1&unmanaged=1')
+        self.assertIsNone(dm.action)
+        app.get('/')
+        self.assertEqual(dm.action, 'abort')
+        self.assertIsNone(transaction.manager.manager._txn)
+
+    @staticmethod
+    def _activate(request):
+        return not request.params.get('unmanaged')
+
+    def test_lazy_begin_without_resources(self):
+        from pyramid_tm import is_tm_active
+
+        config = self.config
+        config.add_settings(
+            {
+                'tm.lazy_begin': True,
+                'tm.manager_hook': 'pyramid_tm.explicit_manager',
+            }
+        )
+
+        def view(request):
+            return str(is_tm_active(request))
+
+        config.add_view(view, renderer='string')
+        app = self._makeApp()
+        resp = app.get('/')
+        self.assertEqual(resp.body, b'True')
+
+    def test_slow_log(self):
+        config = self.config
+        records = []
+        config.add_settings(
+            {
+                'tm.manager_hook': 'pyramid_tm.explicit_manager',
+                'tm.slow_threshold_ms': '0',
+                'tm.slow_sink': records.append,
+            }
+        )
+
+        def view(request):
+            DummyDataManager().bind(request.tm)
+            return 'ok'
+
+        config.add_route('home', '/')
+        config.add_view(view, route_name='home', renderer='string')
+        app = self._makeApp()
+        app.get('/')
+        self.assertEqual(len(records), 1)
+        record = records[0]
+        self.assertEqual(record['route'], 'home')
+        self.assertEqual(record['outcome'], 'commit')
+        self.assertEqual(record['note'], '/')
+        self.assertEqual(record['resources'], ['DummyDataManager'])
+        self.assertEqual(sorted(record['phases']), ['commit', 'handler'])
+
+    def test_slow_log_default_sink(self):
+        config = self.config
+        config.add_settings({'tm.slow_threshold_ms': 0})
+        config.add_view(lambda r: 'ok', renderer='string')
+        app = self._makeApp()
+        with self.assertLogs('pyramid_tm.slowlog', 'WARNING') as cm:
+            app.get('/', headers={'x-tm': 'abort'})
+        self.assertEqual(len(cm.records), 1)
+
+    def test_async_after_commit_hook(self):
+        from pyramid_tm import (
+            add_async_after_commit_hook,
+            get_after_commit_stats,
+            shutdown_after_commit_hooks,
+        )
+
+        config = self.config
+        config.add_settings(
+            {
+                'tm.manager_hook': 'pyramid_tm.explicit_manager',
+                'tm.after_commit_workers': '2',
+            }
+        )
+        calls = []
+
+        def view(request):
+            add_async_after_commit_hook(
+                request, calls.append, (request.params['n'],)
+            )
+            if request.params['n'] == 'b':
+                request.tm.doom()
+            return 'ok'
+
+        config.add_view(view, renderer='string')
+        app = self._makeApp()
+        registry = app.app.registry
+        app.get('/?n=a')
+        app.get('/?n=b')
+        self.assertTrue(shutdown_after_commit_hooks(registry, 5))
+        self.assertEqual(calls, ['a'])
+        stats = get_after_commit_stats(registry)
+        self.assertEqual(stats['queued'], 1)
+        self.assertEqual(stats['completed'], 1)
+
+    def _fakeClock(self):
+        import pyramid_tm
+
+        clock = DummyClock()
+        self.addCleanup(setattr, pyramid_tm, 'monotonic', pyramid_tm.monotonic)
+        pyramid_tm.monotonic = clock
+        return clock
+
+    @skip_if_missing('pyramid_retry')
+    def test_timeout_threadlocal_manager(self):
+        from pyramid_tm import TransactionTimeout
+
+        config = self.config
+        config.add_settings({'retry.attempts': 2, 'tm.timeout': '1'})
+        config.include('pyramid_retry')
+        self.addCleanup(transaction.manager.abort)
+        clock = self._fakeClock()
+        dm = DummyDataManager()
+
+        def view(request):
+            dm.bind(request.tm)
+            clock.now += 2
+            return 'ok'
+
+        config.add_view(view, renderer='string')
+        app = self._makeApp()
+        self.assertRaises(TransactionTimeout, app.get, '/')
+        self.assertEqual(dm.action, 'abort')
+        # classifying the error did not begin a new transaction
+        self.assertIsNone(transaction.manager.manager._txn)
+
+    def _addSlowView(self, dms, delays):
+        clock = self._fakeClock()
+
+        def view(request):
+            dm = DummyDataManager()
+            dm.bind(request.tm)
+            dms.append(dm)
+            clock.now += delays.pop(0)
+            return 'ok'
+
+        self.config.add_view(view, renderer='string')
+
+    def test_timeout(self):
+        from pyramid_tm import TransactionTimeout, get_counters
+
+        config = self.config
+        config.add_settings(
+            {
+                'tm.manager_hook': 'pyramid_tm.explicit_manager',
+                'tm.timeout': '1',
+            }
+        )
+        dms = []
+        self._addSlowView(dms, [2])
+        app = self._makeApp()
+        with self.assertRaises(TransactionTimeout) as cm:
+            app.get('/')
+        self.assertEqual(cm.exception.timeout, 1.0)
+        self.assertEqual(dms[0].action, 'abort')
+        self.assertEqual(get_counters(app.app.registry)['timeout'], 1)
+
+    def test_timeout_exception_view(self):
+        from pyramid.response import Response
+
+        from pyramid_tm import TransactionTimeout
+
+        config = self.config
+        config.add_settings({'tm.timeout': '1'})
+        config.add_exception_view(
+            lambda exc, request: Response('timeout', status=503),
+            context=TransactionTimeout,
+        )
+        dms = []
+        self._addSlowView(dms, [2])
+        app = self._makeApp()
+        resp = app.get('/', status=503)
+        self.assertEqual(resp.body, b'timeout')
+        self.assertEqual(dms[0].action, 'abort')
+
+    def test_timeout_not_exceeded(self):
+        from pyramid_tm import tm_time_remaining
+
+        config = self.config
+        config.add_settings({'tm.timeout': '60'})
+        dms = []
+
+        def view(request):
+            dm = DummyDataManager()
+            dm.bind(request.tm)
+            dms.append(dm)
+            deadline = request.tm.get().extension['pyramid_tm.deadline']
+            self.assertEqual(deadline, request.environ['tm.deadline'])
+            self.assertGreater(tm_time_remaining(request), 50)
+            return 'ok'
+
+        config.add_view(view, renderer='string')
+        app = self._makeApp()
+        app.get('/')
+        self.assertEqual(dms[0].action, 'commit')
+
+    def test_timeout_lazy(self):
+        from pyramid_tm import TransactionTimeout, tm_time_remaining
+
+        config = self.config
+        config.add_settings({'tm.timeout': '1', 'tm.lazy_begin': True})
+        clock = self._fakeClock()
+        remaining = []
+
+        def view(request):
+            remaining.append(tm_time_remaining(request))
+            clock.now += 2
+            return 'ok'
+
+        config.add_view(view, renderer='string')
+        app = self._makeApp()
+        self.assertRaises(TransactionTimeout, app.get, '/')
+        self.assertEqual(remaining, [1.0])
+
+    @skip_if_missing('pyramid_retry')
+    def test_timeout_retryable(self):
+        config = self.config
+        config.add_settings(
+            {
+                'retry.attempts': 2,
+                'tm.timeout': '1',
+                'tm.timeout_retryable': True,
+            }
+        )
+        config.include('pyramid_retry')
+        dms = []
+        self._addSlowView(dms, [2, 0])
+        app = self._makeApp()
+        resp = app.get('/')
+        self.assertEqual(resp.body, b'ok')
+        self.assertEqual([dm.action for dm in dms], ['abort', 'commit'])
+
+    def test_invalid_timeout(self):
+        from pyramid.exceptions import ConfigurationError
+
+        self.config.add_settings({'tm.timeout': 'soon'})
+        self.assertRaises(ConfigurationError, self._makeApp)
+
+    def test_invalid_dotted_name_fails_at_startup(self):
+        from pyramid.exceptions import ConfigurationExecutionError
+
+        self.config.add_settings({'tm.commit_veto': 'an.invalid.import'})
+        self.assertRaises(ConfigurationExecutionError, self.config.commit)
+
+    def test_settings_are_frozen(self):
+        config = self.config
+        config.add_settings({'tm.commit_veto': 'tests.veto_true'})
+        dm = DummyDataManager()
+
+        def view(request):
+            dm.bind(request.tm)
+            return 'ok'
+
+        config.add_view(view, renderer='string')
+        config.commit()
+        # changing the settings after the configuration was committed has no
+        # effect
+        config.registry.settings['tm.commit_veto'] = 'an.invalid.import'
+        app = self._makeApp()
+        app.get('/')
+        self.assertEqual(dm.action, 'abort')
+
+    def test_profile_routes(self):
+        import os
+        import shutil
+        import tempfile
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        config = self.config
+        config.add_settings(
+            {
+                'tm.profile_dir': directory,
+                'tm.profile_routes': 'profiled',
+            }
+        )
+        config.add_route('profiled', '/profiled')
+        config.add_route('other', '/other')
+        config.add_view(
+            lambda r: 'ok', route_name='profiled', renderer='string'
+        )
+        config.add_view(lambda r: 'ok', route_name='other', renderer='string')
+        app = self._makeApp()
+        app.get('/profiled')
+        app.get('/other')
+        files = os.listdir(directory)
+        self.assertEqual(len(files), 1)
+        self.assertTrue(files[0].startswith('profiled.commit.'))
+
+    def _addReadOnlyRoutes(self, settings):
+        from pyramid_tm import LazyTransactionManager
+
+        config = self.config
+        config.add_settings(settings)
+        config.add_settings({'tm.manager_hook': 'pyramid_tm.explicit_manager'})
+        dms = []
+
+        def view(request):
+            if request.params.get('write'):
+                dm = DummyDataManager()
+                dm.bind(request.tm)
+                dms.append(dm)
+            return str(isinstance(request.tm, LazyTransactionManager))
+
+        config.add_route('home', '/')
+        config.add_view(view, route_name='home', renderer='string')
+        return dms
+
+    def test_readonly_routes_observe(self):
+        from pyramid_tm import get_readonly_routes
+
+        self._addReadOnlyRoutes(
+            {'tm.readonly_routes': 'observe', 'tm.readonly_window': '2'}
+        )
+        app = self._makeApp()
+        for _ in range(3):
+            self.assertEqual(app.get('/').body, b'False')
+        self.assertEqual(
+            get_readonly_routes(self.config.registry),
+            {'home': {'readonly': 3, 'writes': 0, 'is_readonly': True}},
+        )
+
+    def test_readonly_routes_adaptive(self):
+        from pyramid_tm import get_readonly_routes
+
+        dms = self._addReadOnlyRoutes(
+            {'tm.readonly_routes': 'adaptive', 'tm.readonly_window': '2'}
+        )
+        app = self._makeApp()
+        self.assertEqual(app.get('/').body, b'False')
+        self.assertEqual(app.get('/').body, b'False')
+        self.assertEqual(app.get('/').body, b'True')
+        self.assertEqual(app.get('/').body, b'True')
+        # a write falls back to a regular transaction and resets the route
+        self.assertEqual(app.get('/?write=1').body, b'True')
+        self.assertEqual(dms[0].action, 'commit')
+        self.assertEqual(app.get('/').body, b'False')
+        routes = get_readonly_routes(self.config.registry)
+        self.assertEqual(routes['home']['writes'], 1)
+
+    def test_readonly_routes_adaptive_threadlocal_manager(self):
+        from pyramid_tm import get_readonly_routes
+
+        config = self.config
+        config.add_settings(
+            {'tm.readonly_routes': 'adaptive', 'tm.readonly_window': '2'}
+        )
+        self.addCleanup(transaction.manager.abort)
+        dms = []
+
+        def view(request):
+            if request.params.get('write'):
+                dm = DummyDataManager()
+                # joined via the threadlocal manager behind the lazy proxy
+                dm.bind(transaction.manager)
+                dms.append(dm)
+            return 'ok'
+
+        config.add_route('home', '/')
+        config.add_view(view, route_name='home', renderer='string')
+        app = self._makeApp()
+        app.get('/')
+        app.get('/')
+        app.get('/?write=1')
+        self.assertEqual(dms[0].action, 'commit')
+        self.assertIsNone(transaction.manager.manager._txn)
+        self.assertEqual(
+            get_readonly_routes(self.config.registry)['home'],
+            {'readonly': 0, 'writes': 1, 'is_readonly': False},
+        )
+
+    def test_readonly_routes_table(self):
+        import os
+        import shutil
+        import tempfile
+
+        from pyramid_tm import dump_readonly_routes
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'routes.json')
+        self._addReadOnlyRoutes(
+            {
+                'tm.readonly_routes': 'adaptive',
+                'tm.readonly_window': '1',
+                'tm.readonly_table': path,
+            }
+        )
+        app = self._makeApp()
+        app.get('/')
+        dump_readonly_routes(self.config.registry, path)
+
+        self.config = testing.setUp(autocommit=False)
+        self.config.include('pyramid_tm')
+        self._addReadOnlyRoutes(
+            {
+                'tm.readonly_routes': 'adaptive',
+                'tm.readonly_window': '1',
+                'tm.readonly_table': path,
+            }
+        )
+        app = self._makeApp()
+        self.assertEqual(app.get('/').body, b'True')
+
+    def test_readonly_routes_invalid(self):
+        from pyramid.exceptions import ConfigurationError
+
+        self.config.add_settings({'tm.readonly_routes': 'always'})
+        self.assertRaises(ConfigurationError, self._makeApp)
+
+    def test_tm_readonly_view(self):
+        from pyramid_tm import is_tm_readonly
+
+        config = self.config
+        config.add_settings({'tm.manager_hook': 'pyramid_tm.explicit_manager'})
+        dm = DummyDataManager()
+        seen = []
+
+        def view(request):
+            dm.bind(request.tm)
+            txn = request.tm.get()
+            seen.append(is_tm_readonly(request))
+            seen.append(txn.extension['pyramid_tm.readonly'])
+            return 'ok'
+
+        config.add_view(view, renderer='string', tm_readonly=True)
+        config.add_view(
+            lambda r: str(is_tm_readonly(r)), name='other', renderer='string'
+        )
+        app = self._makeApp()
+        resp = app.get('/')
+        self.assertEqual(resp.body, b'ok')
+        self.assertEqual(seen, [True, True])
+        self.assertEqual(dm.action, 'abort')
+        self.assertEqual(app.get('/other').body, b'False')
+
+    def test_tm_readonly_view_warn_joins(self):
+        config = self.config
+        config.add_settings({'tm.readonly_warn_joins': 'true'})
+
+        def view(request):
+            if request.params.get('write'):
+                DummyDataManager().bind(request.tm)
+            return 'ok'
+
+        config.add_view(view, renderer='string', tm_readonly=True)
+        app = self._makeApp()
+        with self.assertLogs('pyramid_tm.readonly', 'WARNING') as cm:
+            app.get('/?write=1')
+            # nothing is logged if no resources joined
+            app.get('/')
+        self.assertEqual(
+            [r.getMessage() for r in cm.records],
+            ['resources joined the read-only transaction: DummyDataManager'],
+        )
+
+    def test_tm_readonly_view_inactive(self):
+        from pyramid_tm import is_tm_readonly
+
+        config = self.config
+        config.add_settings({'tm.activate_hook': activate_false})
+        config.add_view(
+            lambda r: str(is_tm_readonly(r)),
+            renderer='string',
+            tm_readonly=True,
+        )
+        app = self._makeApp()
+        self.assertEqual(app.get('/').body, b'False')
+
+    def test_thread_manager_shares_global_transaction(self):
+        config = self.config
+        config.add_settings({'tm.manager_hook': 'pyramid_tm.thread_manager'})
+        dm = DummyDataManager()
+
+        def view(request):
+            dm.bind(transaction.manager)
+            return str(request.tm.get() is transaction.get())
+
+        config.add_view(view, renderer='string')
+        app = self._makeApp()
+        resp = app.get('/')
+        self.assertEqual(resp.body, b'True')
+        self.assertEqual(dm.action, 'commit')
+
+    def test_pooled_manager_is_reused(self):
+        config = self.config
+        config.add_settings(
+            {'tm.manager_hook': 'pyramid_tm.pooled_explicit_manager'}
+        )
+        managers = []
+
+        def view(request):
+            DummyDataManager().bind(request.tm)
+            managers.append(request.tm)
+            return 'ok'
+
+        config.add_view(view, renderer='string')
+        app = self._makeApp()
+        app.get('/')
+        app.get('/')
+        self.assertTrue(managers[0].explicit)
+        self.assertIs(managers[0], managers[1])
 
-            def should_retry(self, exception):
-                return isinstance(exception, Conflict)
+    def test_pooled_manager_with_leaked_synch_is_discarded(self):
+        config = self.config
+        config.add_settings(
+            {
+                'tm.manager_hook': 'pyramid_tm.pooled_explicit_manager',
+                'tm.pool_size': '2',
+                'tm.pool_debug': 'true',
+            }
+        )
+        managers = []
+        synchs = []
 
-        def exc_view(request):
-            return 'failure'
+        def view(request):
+            synch = DummySynch()
+            request.tm.registerSynch(synch)
+            synchs.append(synch)
+            managers.append(request.tm)
+            return 'ok'
 
+        config.add_view(view, renderer='string')
+        app = self._makeApp()
+        pool = config.registry['pyramid_tm.manager_pool']
+        self.assertEqual(pool.size, 2)
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter('always')
+            app.get('/')
+            app.get('/')
+        self.assertEqual(len(w), 2)
+        self.assertIsNot(managers[0], managers[1])
+
+    def test_pooled_manager_with_stream(self):
         config = self.config
         config.add_settings(
             {
-                'retry.attempts': 2,
-                'tm.commit_veto': lambda request, response: False,
+                'tm.manager_hook': 'pyramid_tm.pooled_explicit_manager',
+                'tm.stream': True,
             }
         )
-        config.include('pyramid_retry')
-        config.add_view(exc_view, context=Exception, renderer='string')
+        managers = []
+        dm = DummyDataManager()
+
+        def body(request):
+            managers.append(request.tm)
+            dm.bind(request.tm)
+            yield b'a'
+
+        self._addStreamingView(body)
+        app = self._makeApp()
+        app.get('/')
+        app.get('/')
+        self.assertEqual(dm.action, 'commit')
+        self.assertIs(managers[0], managers[1])
+
+    def test_empty_transaction_fast_commit(self):
+        from pyramid_tm import get_counters
 
+        config = self.config
+        config.add_settings({'tm.manager_hook': 'pyramid_tm.explicit_manager'})
         calls = []
 
         def view(request):
-            print(calls)
-            dm = RetryDataManager()
-            dm.bind(request.tm)
-            if len(calls) < 1:
-                calls.append('fail')
-                raise Conflict
-            calls.append('ok')
+            txn = request.tm.get()
+            txn.addAfterCommitHook(lambda status: calls.append(status))
             return 'ok'
 
         config.add_view(view, renderer='string')
         app = self._makeApp()
-        result = app.get('/')
-        self.assertEqual(calls, ['fail', 'ok'])
-        self.assertEqual(result.body, b'ok')
+        resp = app.get('/')
+        self.assertEqual(resp.body, b'ok')
+        self.assertEqual(calls, [True])
+        self.assertEqual(get_counters(config.registry), {'fast_commit': 1})
 
-    def test_unhandled_error_aborts(self):
+    def test_annotators_run_with_resources(self):
+        config = self.config
+        calls = []
+
+        def annotator(request, txn):
+            calls.append((request.path_info, txn))
+
+        config.add_settings(
+            {
+                'tm.manager_hook': 'pyramid_tm.explicit_manager',
+                'tm.annotators': [annotator],
+            }
+        )
+        txns = []
+
+        def view(request):
+            if request.path_info == '/write':
+                DummyDataManager().bind(request.tm)
+            else:
+                request.tm.registerSynch(synch)
+            txns.append(request.tm.get())
+            return 'ok'
+
+        synch = DummySynch()
+        config.add_view(view, renderer='string')
+        config.add_view(view, name='write', renderer='string')
+        app = self._makeApp()
+        app.get('/')
+        self.assertEqual(calls, [])
+        app.get('/write')
+        self.assertEqual(calls, [('/write', txns[1])])
+
+    def _addSubrequestViews(self, dm):
+        from pyramid.request import Request
+        from pyramid.response import Response
+
+        config = self.config
+
+        def outer(request):
+            dm.bind(request.tm)
+            dm.data.append('outer')
+            for path in request.params.getall('sub'):
+                subrequest = Request.blank(path)
+                try:
+                    request.invoke_subrequest(subrequest, use_tweens=True)
+                except ValueError:
+                    dm.data.append('caught')
+            return 'ok'
+
+        def write(request):
+            dm.data.append(request.path_info)
+            if request.path_info == '/veto':
+                return Response('vetoed', status=500)
+            if request.path_info == '/fail':
+                raise ValueError
+            if request.path_info == '/nested':
+                try:
+                    request.invoke_subrequest(Request.blank('/fail'), True)
+                except ValueError:
+                    pass
+            return 'ok'
+
+        config.add_route('outer', '/')
+        config.add_view(outer, route_name='outer', renderer='string')
+        for name in ('ok', 'fail', 'veto', 'nested'):
+            config.add_route(name, '/' + name)
+            config.add_view(write, route_name=name, renderer='string')
+
+    def test_savepoint_subrequests(self):
+        from pyramid_tm import get_counters
+
+        config = self.config
+        config.add_settings(
+            {
+                'tm.commit_veto': 'pyramid_tm.default_commit_veto',
+                'tm.manager_hook': 'pyramid_tm.explicit_manager',
+                'tm.savepoint_subrequests': True,
+            }
+        )
+        dm = DummySavepointDataManager()
+        self._addSubrequestViews(dm)
+        app = self._makeApp()
+        app.get('/?sub=/ok&sub=/fail&sub=/veto&sub=/nested')
+        self.assertEqual(dm.action, 'commit')
+        self.assertEqual(dm.data, ['outer', '/ok', 'caught', '/nested'])
+        counters = get_counters(app.app.registry)
+        self.assertEqual(counters['subrequest_rollback'], 3)
+
+    def test_savepoint_subrequests_policy(self):
+        config = self.config
+        config.add_settings({'tm.savepoint_subrequests': True})
+        config.set_tm_policy('ok', commit_veto='tests.veto_true')
+        dm = DummySavepointDataManager()
+        self._addSubrequestViews(dm)
+        app = self._makeApp()
+        app.get('/?sub=/ok')
+        self.assertEqual(dm.action, 'commit')
+        self.assertEqual(dm.data, ['outer'])
+
+    def test_savepoint_subrequests_stats(self):
+        from pyramid_tm import get_stats
+
+        config = self.config
+        config.add_settings(
+            {'tm.savepoint_subrequests': True, 'tm.stats': True}
+        )
+        dm = DummySavepointDataManager()
+        self._addSubrequestViews(dm)
+        app = self._makeApp()
+        app.get('/?sub=/ok&sub=/fail')
+        # the subrequests are a part of the outer managed request
+        stats = get_stats(app.app.registry)
+        self.assertEqual(stats['phases']['handler']['count'], 1)
+        self.assertEqual(stats['outcomes']['exception'], 0)
+
+    def test_savepoint_subrequests_profile(self):
+        import os
+        import shutil
+        import tempfile
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.config.add_settings(
+            {
+                'tm.profile_dir': directory,
+                'tm.profile_routes': 'outer probe',
+                'tm.savepoint_subrequests': True,
+            }
+        )
+        dm = DummySavepointDataManager()
+        self._addSubrequestViews(dm)
+        environs = []
+
+        def probe(request):
+            environs.append(dict(request.environ))
+            return 'ok'
+
+        self.config.add_route('probe', '/probe')
+        self.config.add_view(probe, route_name='probe', renderer='string')
+        app = self._makeApp()
+        app.get('/?sub=/probe')
+        # the subrequests are profiled as a part of the outer request
+        self.assertNotIn('pyramid_tm.profile', environs[0])
+        files = os.listdir(directory)
+        self.assertEqual(len(files), 1)
+        self.assertTrue(files[0].startswith('outer.commit.'))
+
+    def test_savepoint_subrequests_unsupported(self):
+        from pyramid_tm import get_counters
+
+        class NoSavepointDataManager(DummyDataManager):
+            def __init__(self):
+                self.data = []
+
+        config = self.config
+        config.add_settings(
+            {
+                'tm.manager_hook': 'pyramid_tm.explicit_manager',
+                'tm.savepoint_subrequests': True,
+            }
+        )
+        dm = NoSavepointDataManager()
+        self._addSubrequestViews(dm)
+        app = self._makeApp()
+        app.get('/?sub=/fail')
+        # the subrequest shared the transaction without failing it
+        self.assertEqual(dm.action, 'commit')
+        self.assertEqual(dm.data, ['outer', '/fail', 'caught'])
+        counters = get_counters(app.app.registry)
+        self.assertEqual(counters['subrequest_shared'], 1)
+        self.assertNotIn('subrequest_rollback', counters)
+
+    def test_savepoint_subrequests_readonly(self):
+        from pyramid_tm import is_tm_readonly
+
+        config = self.config
+        config.add_settings(
+            {
+                'tm.manager_hook': 'pyramid_tm.explicit_manager',
+                'tm.savepoint_subrequests': True,
+            }
+        )
+        dm = DummySavepointDataManager()
+        self._addSubrequestViews(dm)
+        readonly = []
+
+        def view(request):
+            dm.data.append(request.path_info)
+            readonly.append(is_tm_readonly(request))
+            return 'ok'
+
+        config.add_route('readonly', '/readonly')
+        config.add_view(
+            view, route_name='readonly', renderer='string', tm_readonly=True
+        )
+        app = self._makeApp()
+        app.get('/?sub=/readonly&sub=/ok')
+        # only the savepoint of the read-only subrequest was rolled back
+        self.assertEqual(readonly, [True])
+        self.assertEqual(dm.action, 'commit')
+        self.assertEqual(dm.data, ['outer', '/ok'])
+
+    def test_subrequests_share_transaction(self):
+        config = self.config
+        config.add_settings({'tm.manager_hook': 'pyramid_tm.explicit_manager'})
+        dm = DummySavepointDataManager()
+        self._addSubrequestViews(dm)
+        app = self._makeApp()
+        app.get('/?sub=/fail')
+        # the failed subrequest was managed on its own
+        self.assertEqual(dm.data, ['outer', '/fail', 'caught'])
+
+    def _addRoutes(self, view):
         config = self.config
+        for name in ('default', 'custom'):
+            config.add_route(name, '/' + name)
+            config.add_view(view, route_name=name, renderer='string')
+
+    def test_policy_activate(self):
+        from pyramid.httpexceptions import HTTPNotFound
+
+        from pyramid_tm import is_tm_active
+
+        self.config.set_tm_policy('custom', activate=False)
+        self._addRoutes(lambda r: str(is_tm_active(r)))
+        app = self._makeApp()
+        self.assertEqual(app.get('/default').body, b'True')
+        self.assertEqual(app.get('/custom').body, b'False')
+        self.assertRaises(HTTPNotFound, app.get, '/missing')
+
+    def test_policy_activate_overrides_hook(self):
+        from pyramid_tm import is_tm_active
+
+        self.config.add_settings({'tm.activate_hook': activate_false})
+        self.config.set_tm_policy('custom', activate=True)
+        self._addRoutes(lambda r: str(is_tm_active(r)))
+        app = self._makeApp()
+        self.assertEqual(app.get('/default').body, b'False')
+        self.assertEqual(app.get('/custom').body, b'True')
+
+    def test_policy_commit_veto(self):
+        dms = []
+
+        def view(request):
+            dm = DummyDataManager()
+            dm.bind(request.tm)
+            dms.append(dm)
+            return 'ok'
+
+        self.config.set_tm_policy('custom', commit_veto='tests.veto_true')
+        self._addRoutes(view)
+        app = self._makeApp()
+        app.get('/default')
+        app.get('/custom')
+        self.assertEqual([dm.action for dm in dms], ['commit', 'abort'])
+
+    def test_policy_annotators(self):
+        txns = []
+
+        def view(request):
+            DummyDataManager().bind(request.tm)
+            txns.append(request.tm.get())
+            return 'ok'
+
+        self.config.set_tm_policy('custom', annotators='tests.annotate_dummy')
+        self._addRoutes(view)
+        app = self._makeApp()
+        app.get('/default')
+        app.get('/custom')
+        self.assertEqual(txns[0].description, '/default')
+        self.assertEqual(txns[1].description, 'dummy')
+
+    def test_policy_invalid_activate(self):
+        from pyramid.exceptions import ConfigurationError
+
+        self.assertRaises(
+            ConfigurationError,
+            self.config.set_tm_policy,
+            'custom',
+            activate='yes',
+        )
+
+    def test_policy_invalid_timeout(self):
+        from pyramid.exceptions import ConfigurationError
+
+        for timeout in (True, -1, 'soon'):
+            self.assertRaises(
+                ConfigurationError,
+                self.config.set_tm_policy,
+                'custom',
+                timeout=timeout,
+            )
+
+    def test_policy_timeout(self):
+        from pyramid_tm import TransactionTimeout, tm_time_remaining
+
+        clock = self._fakeClock()
+        remaining = []
+
+        def view(request):
+            remaining.append(tm_time_remaining(request))
+            clock.now += 2
+            return 'ok'
+
+        self.config.add_settings({'tm.timeout': '1'})
+        self.config.set_tm_policy('default', timeout=0)
+        self.config.set_tm_policy('custom', timeout='60')
+        self._addRoutes(view)
+        self.config.add_route('global', '/global')
+        self.config.add_view(view, route_name='global', renderer='string')
+        app = self._makeApp()
+        app.get('/default')
+        app.get('/custom')
+        self.assertRaises(TransactionTimeout, app.get, '/global')
+        self.assertIsNone(remaining[0])
+        self.assertEqual(remaining[1], 60.0)
+
+    def test_policy_conflict(self):
+        from pyramid.exceptions import ConfigurationConflictError
+
+        self.config.set_tm_policy('custom', activate=False)
+        self.config.set_tm_policy('custom', activate=True)
+        self.assertRaises(ConfigurationConflictError, self.config.commit)
+
+    def _addStreamingView(self, body, **kw):
+        from pyramid.response import Response
+
+        def view(request):
+            return Response(app_iter=body(request))
+
+        self.config.add_view(view, **kw)
+
+    def test_stream_commits_after_body(self):
+        from pyramid_tm import is_tm_active
+
+        self.config.add_settings({'tm.stream': True})
         dm = DummyDataManager()
+        seen = []
+
+        def body(request):
+            yield b'a'
+            dm.bind(request.tm)
+            seen.append(is_tm_active(request))
+            yield b'b'
+            seen.append(dm.action)
+
+        self._addStreamingView(body)
+        app = self._makeApp()
+        resp = app.get('/')
+        self.assertEqual(resp.body, b'ab')
+        self.assertEqual(seen, [True, None])
+        self.assertEqual(dm.action, 'commit')
+
+    def test_stream_commits_after_finished_callbacks(self):
+        # pyramid runs the finished callbacks before the server iterates the
+        # body, so the transaction is completed after their cleanup
+        self.config.add_settings({'tm.stream': True})
+        events = []
+
+        class ClosingDataManager(DummyDataManager):
+            def commit(self, transaction):
+                events.append('commit')
+                DummyDataManager.commit(self, transaction)
+
+        dm = ClosingDataManager()
+
+        def body(request):
+            events.append('body')
+            yield b'a'
 
         def view(request):
+            from pyramid.response import Response
+
+            dm.bind(request.tm)
+            request.add_finished_callback(lambda r: events.append('closed'))
+            return Response(app_iter=body(request))
+
+        self.config.add_view(view)
+        app = self._makeApp()
+        resp = app.get('/')
+        self.assertEqual(resp.body, b'a')
+        self.assertEqual(events, ['closed', 'body', 'commit'])
+        self.assertEqual(dm.action, 'commit')
+
+    def test_stream_error_aborts(self):
+        self.config.add_settings({'tm.stream': True})
+        dm = DummyDataManager()
+
+        def body(request):
             dm.bind(request.tm)
+            yield b'a'
             raise ValueError
 
-        config.add_view(view)
+        self._addStreamingView(body)
         app = self._makeApp()
         self.assertRaises(ValueError, app.get, '/')
         self.assertEqual(dm.action, 'abort')
 
-    def test_handled_error_aborts(self):
-        config = self.config
+    def test_stream_veto_evaluated_after_body(self):
+        vetoes = []
+
+        def veto(request, response):
+            vetoes.append(dm.action)
+            return True
+
+        self.config.add_settings({'tm.stream': True, 'tm.commit_veto': veto})
         dm = DummyDataManager()
 
-        def view(request):
+        def body(request):
             dm.bind(request.tm)
-            raise ValueError
+            yield b'a'
 
-        config.add_view(view)
+        self._addStreamingView(body)
+        app = self._makeApp()
+        self.assertEqual(app.get('/').body, b'a')
+        self.assertEqual(vetoes, [None])
+        self.assertEqual(dm.action, 'abort')
 
-        def exc_view(request):
-            return 'failure'
+    def test_stream_veto_error_aborts(self):
+        def veto(request, response):
+            raise RuntimeError
 
-        config.add_view(exc_view, context=ValueError, renderer='string')
+        self.config.add_settings({'tm.stream': True, 'tm.commit_veto': veto})
+        dm = DummyDataManager()
+
+        def body(request):
+            dm.bind(request.tm)
+            yield b'a'
+
+        self._addStreamingView(body)
         app = self._makeApp()
-        resp = app.get('/')
-        self.assertEqual(resp.body, b'failure')
+        self.assertRaises(RuntimeError, app.get, '/')
         self.assertEqual(dm.action, 'abort')
 
-    def test_handled_error_commits_with_veto(self):
-        config = self.config
+    def test_stream_commit_failure_propagates(self):
+        tm = DummyTransaction(finish_with_exc=ValueError)
+        self.config.add_settings(
+            {'tm.stream': True, 'tm.manager_hook': lambda r: tm}
+        )
+
+        def body(request):
+            yield b'a'
+
+        self._addStreamingView(body)
+        app = self._makeApp()
+        self.assertRaises(ValueError, app.get, '/')
+        self.assertEqual(tm.committed, 1)
+
+    def test_stream_buffered_body_finishes_immediately(self):
+        self.config.add_settings({'tm.stream': True})
         dm = DummyDataManager()
 
         def view(request):
             dm.bind(request.tm)
-            raise ValueError
+            return 'ok'
 
-        config.add_view(view)
+        self.config.add_view(view, renderer='string')
+        app = self._makeApp()
+        self.assertEqual(app.get('/').body, b'ok')
+        self.assertEqual(dm.action, 'commit')
 
-        def exc_view(request):
-            return 'failure'
+    def test_stream_policy(self):
+        from pyramid_tm import is_tm_active
 
-        def commit_veto(request, response):
-            return request.exception is None
+        seen = []
 
-        config.add_settings({'tm.commit_veto': commit_veto})
-        config.add_view(exc_view, context=ValueError, renderer='string')
+        def body(request):
+            seen.append(is_tm_active(request))
+            yield b'a'
+
+        self.config.set_tm_policy('custom', stream=True)
+        for name in ('default', 'custom'):
+            self.config.add_route(name, '/' + name)
+            self._addStreamingView(body, route_name=name)
         app = self._makeApp()
-        resp = app.get('/')
-        self.assertEqual(resp.body, b'failure')
-        self.assertEqual(dm.action, 'commit')
+        app.get('/default')
+        app.get('/custom')
+        self.assertEqual(seen, [False, True])
+
+    def test_policy_invalid_stream(self):
+        from pyramid.exceptions import ConfigurationError
+
+        self.assertRaises(
+            ConfigurationError,
+            self.config.set_tm_policy,
+            'custom',
+            stream='yes',
+        )
 
     def test_explicit_manager_fails_before_tm(self):
         from transaction.interfaces import NoTransaction
@@ -771,17 +3016,30 @@ class TestIntegration(unittest.TestCase):
         self.assertRaises(ValueError, lambda: app.get('/'))
 
 
+class TestIntegrationGeneric(TestIntegration):
+    # run every test against the generic variant of the tween
+    def setUp(self):
+        super(TestIntegrationGeneric, self).setUp()
+        self.config.add_settings({'tm.specialize': False})
+
+
 class Dummy(object):
     def __init__(self, **kwargs):
         self.__dict__.update(kwargs)
 
 
+class DummyRegistry(dict):
+    def __init__(self, settings):
+        self.settings = settings
+
+
 class DummyTransaction(TransactionManager):
     began = False
     committed = False
     aborted = False
     _resources = []
     user = None
+    status = None
 
     def __init__(self, doomed=False, retryable=False, finish_with_exc=None):
         self.doomed = doomed
@@ -791,6 +3049,10 @@ class DummyTransaction(TransactionManager):
         self.retryable = retryable
         self.active = False
         self.finish_with_exc = finish_with_exc
+        self.before_commit_hooks = []
+
+    def addBeforeCommitHook(self, hook, args=(), kws=None):
+        self.before_commit_hooks.append((hook, args, kws or {}))
 
     def isRetryableError(self, exc):
         return self._retryable(type(exc), exc)
@@ -802,6 +3064,11 @@ class DummyTransaction(TransactionManager):
     def get(self):  # pragma: no cover
         return self
 
+    @property
+    def _txn(self):
+        # the current transaction, see pyramid_tm._current_transaction
+        return self if self.active else None
+
     def isDoomed(self):
         return self.doomed
 
@@ -811,6 +3078,8 @@ class DummyTransaction(TransactionManager):
         return self
 
     def commit(self):
+        for hook, args, kws in self.before_commit_hooks:
+            hook(*args, **kws)
         self.committed += 1
         if self.finish_with_exc:
             raise self.finish_with_exc
@@ -854,6 +3123,44 @@ class DummyDataManager(object):
         return 'dummy:%s' % id(self)
 
 
+class DummySavepointDataManager(DummyDataManager):
+    def __init__(self):
+        self.data = []
+
+    def savepoint(self):
+        return DummySavepoint(self, list(self.data))
+
+
+class DummySavepoint(object):
+    def __init__(self, dm, data):
+        self.dm = dm
+        self.data = data
+
+    def rollback(self):
+        self.dm.data[:] = self.data
+
+
+class DummyRetryDataManager(DummyDataManager):
+    def __init__(self, cacheable=False):
+        self.should_retry_cacheable = cacheable
+        self.calls = 0
+
+    def should_retry(self, exc):
+        self.calls += 1
+        return isinstance(exc, ValueError)
+
+
+class DummySynch(object):
+    def newTransaction(self, txn):
+        pass
+
+    def beforeCompletion(self, txn):
+        pass
+
+    def afterCompletion(self, txn):
+        pass
+
+
 class DummyRequest(testing.DummyRequest):
     def __init__(self, *args, **kwargs):
         self.tm = TransactionManager()
@@ -873,12 +3180,24 @@ class DummyResponse(object):
 
 class DummyConfig(object):
     def __init__(self):
-        self.registry = Dummy(settings={})
+        self.registry = DummyRegistry(settings={})
         self.tweens = []
         self.request_methods = []
         self.view_predicates = []
+        self.view_derivers = []
+        self.directives = []
+        self.subscribers = []
         self.actions = []
 
+    def add_subscriber(self, subscriber, iface=None):
+        self.subscribers.append((subscriber, iface))
+
+    def add_view_deriver(self, deriver):
+        self.view_derivers.append(deriver)
+
+    def add_directive(self, name, fn):
+        self.directives.append((name, fn))
+
     def add_tween(self, x, under=None, over=None):
         self.tweens.append((x, under, over))
 
@@ -0,0 +1,252 @@
+import gc
+import os
+from pyramid.httpexceptions import HTTPNotFound
+from pyramid.registry import Registry
+import tracemalloc
+import transaction
+from transaction import TransactionManager
+import unittest
+import weakref
+
+import pyramid_tm
+import tests
+
+# the number of requests run before measuring
+WARMUP = 10
+
+# the number of requests whose allocations are compared after the warmup
+REQUESTS = 100
+
+# the net growth in bytes tolerated over ``REQUESTS`` requests, any garbage
+# or unbounded cache left behind by each request exceeds it by far
+MAX_GROWTH = 4096
+
+
+class HandlerError(Exception):
+    # unlike the builtin exceptions, instances of a subclass can be weakly
+    # referenced
+    pass
+
+
+class DummyRequest(object):
+    exc_info = None
+    matched_route = None
+    path_info = '/'
+    authenticated_userid = None
+
+    def __init__(self, registry, exception_view):
+        self.environ = {}
+        self.registry = registry
+        self.tm = TransactionManager(explicit=True)
+        self.exception_view = exception_view
+
+    def invoke_exception_view(self, exc_info):
+        if self.exception_view:
+            return DummyResponse('500 Internal Server Error')
+        raise HTTPNotFound
+
+
+class DummyResponse(object):
+    def __init__(self, status='200 OK'):
+        self.status = status
+        self.headers = {}
+
+
+class DummyDataManager(object):
+    def __init__(self, fail_vote=False, fail_abort=False):
+        self.fail_vote = fail_vote
+        self.fail_abort = fail_abort
+
+    def abort(self, txn):
+        if self.fail_abort:
+            raise ValueError('abort')
+
+    def tpc_begin(self, txn):
+        pass
+
+    def commit(self, txn):
+        pass
+
+    def tpc_vote(self, txn):
+        if self.fail_vote:
+            raise ValueError('vote')
+
+    def tpc_finish(self, txn):
+        pass
+
+    def tpc_abort(self, txn):
+        pass
+
+    def sortKey(self):
+        return 'dummy:%s' % id(self)
+
+
+class LeakTests(object):
+    """
+    Drive the tween through every outcome path with the cyclic gc disabled
+    and assert that each request leaves nothing behind, such that long-lived
+    workers do not depend on the gc to release the transaction, response and
+    exception of every request.
+    """
+
+    settings = {}
+
+    def setUp(self):
+        self.gc_enabled = gc.isenabled()
+        gc.collect()
+        gc.disable()
+
+    def tearDown(self):
+        if self.gc_enabled:
+            gc.enable()
+
+    def _makeTween(self, handler, **settings):
+        from pyramid_tm import tm_tween_factory
+
+        registry = Registry()
+        registry.settings = dict(self.settings, **settings)
+        return tm_tween_factory(handler, registry), registry
+
+    def _makeHandler(self, path):
+        def handler(request):
+            txn = request.tm.get()
+            request.refs['txn'] = weakref.ref(txn)
+            request.refs['manager'] = weakref.ref(request.tm)
+            if path == 'commit':
+                txn.join(DummyDataManager())
+            elif path == 'doom':
+                txn.doom()
+            elif path == 'exception':
+                exc = HandlerError('handler')
+                request.refs['exception'] = weakref.ref(exc)
+                try:
+                    raise exc
+                finally:
+                    # the frame in the traceback must not reference it
+                    del exc
+            elif path.startswith('commit_failure'):
+                txn.join(DummyDataManager(fail_vote=True))
+            elif path == 'abort_failure':
+                txn.join(DummyDataManager(fail_vote=True, fail_abort=True))
+            status = '500 Internal Server Error' if path == 'veto' else None
+            response = DummyResponse(status or '200 OK')
+            request.refs['response'] = weakref.ref(response)
+            return response
+
+        return handler
+
+    def _run(self, tween, registry, exception_view=True, raises=None):
+        request = DummyRequest(registry, exception_view)
+        request.refs = refs = {'request': weakref.ref(request)}
+        try:
+            tween(request)
+        except Exception as exc:
+            # not assertRaises, whose context would keep the exception alive
+            if raises is None or not isinstance(exc, raises):
+                raise
+        else:
+            if raises is not None:
+                self.fail('%s not raised' % raises.__name__)
+        del request
+        return refs
+
+    def _raises(self, path):
+        # the exception expected to propagate from the tween for ``path``
+        if path == 'exception':
+            return HandlerError
+        if path in ('commit_failure_raised', 'abort_failure'):
+            return ValueError
+        return None
+
+    def _runPath(self, path, exception_view=True, **settings):
+        handler = self._makeHandler(path)
+        tween, registry = self._makeTween(handler, **settings)
+        return self._run(tween, registry, exception_view, self._raises(path))
+
+    def _assertDead(self, refs):
+        alive = sorted(name for name, ref in refs.items() if ref() is not None)
+        self.assertEqual(alive, [])
+
+    def _assertFreed(self, path, exception_view=True, **settings):
+        self._assertDead(self._runPath(path, exception_view, **settings))
+
+    def _assertBounded(self, path, exception_view=True, **settings):
+        handler = self._makeHandler(path)
+        tween, registry = self._makeTween(handler, **settings)
+        raises = self._raises(path)
+        for _ in range(WARMUP):
+            self._run(tween, registry, exception_view, raises)
+        tracemalloc.start()
+        try:
+            # a full collection also clears the free lists of the
+            # interpreter such that the memory they retain is not mistaken
+            # for growth
+            gc.collect()
+            before = tracemalloc.take_snapshot()
+            for _ in range(REQUESTS):
+                self._run(tween, registry, exception_view, raises)
+            # nothing may be left for the cyclic gc to release
+            self.assertEqual(gc.collect(), 0)
+            after = tracemalloc.take_snapshot()
+        finally:
+            tracemalloc.stop()
+        # only count the memory allocated by the tween, the transaction and
+        # the views, allocations of the interpreter such as the caches of the
+        # traceback formatting performed by a failed commit are bounded
+        filters = [
+            tracemalloc.Filter(True, os.path.dirname(module.__file__) + '/*')
+            for module in (pyramid_tm, transaction, tests)
+        ]
+        before = before.filter_traces(filters)
+        after = after.filter_traces(filters)
+        growth = sum(
+            stat.size_diff for stat in after.compare_to(before, 'filename')
+        )
+        self.assertLess(growth, MAX_GROWTH)
+
+    def test_commit(self):
+        self._assertFreed('commit')
+        self._assertBounded('commit')
+
+    def test_empty_commit(self):
+        self._assertFreed('empty')
+        self._assertBounded('empty')
+
+    def test_veto(self):
+        settings = {'tm.commit_veto': 'pyramid_tm.default_commit_veto'}
+        self._assertFreed('veto', **settings)
+        self._assertBounded('veto', **settings)
+
+    def test_doom(self):
+        self._assertFreed('doom')
+        self._assertBounded('doom')
+
+    def test_exception(self):
+        self._assertFreed('exception')
+        self._assertBounded('exception')
+
+    def test_commit_failure_rendered(self):
+        self._assertFreed('commit_failure_rendered')
+        self._assertBounded('commit_failure_rendered')
+
+    def test_commit_failure_raised(self):
+        self._assertFreed('commit_failure_raised', exception_view=False)
+        self._assertBounded('commit_failure_raised', exception_view=False)
+
+    def test_abort_failure_after_commit_failure(self):
+        with self.assertLogs('txn', 'ERROR'):
+            refs = self._runPath('abort_failure', exception_view=False)
+        # the captured records reference the traceback until released
+        self._assertDead(refs)
+
+    def test_stats(self):
+        self._assertFreed('commit', **{'tm.stats': True})
+        self._assertBounded('commit', **{'tm.stats': True})
+
+
+class TestLeaks(LeakTests, unittest.TestCase):
+    pass
+
+
+class TestLeaksGeneric(LeakTests, unittest.TestCase):
+    settings = {'tm.specialize': False}
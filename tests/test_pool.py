@@ -0,0 +1,152 @@
+import threading
+from transaction import TransactionManager
+import unittest
+import warnings
+
+
+class DummySynch(object):
+    def newTransaction(self, txn):
+        pass
+
+    def beforeCompletion(self, txn):
+        pass
+
+    def afterCompletion(self, txn):
+        pass
+
+
+class TestManagerPool(unittest.TestCase):
+    def _makeOne(self, size=8, debug=False):
+        from pyramid_tm.pool import ManagerPool
+
+        return ManagerPool(size, debug)
+
+    def test_acquire_creates_explicit_manager(self):
+        pool = self._makeOne()
+        manager = pool.acquire()
+        self.assertIsInstance(manager, TransactionManager)
+        self.assertTrue(manager.explicit)
+
+    def test_release_and_reuse(self):
+        pool = self._makeOne()
+        manager = pool.acquire()
+        manager.begin()
+        manager.commit()
+        self.assertTrue(pool.release(manager))
+        self.assertIs(pool.acquire(), manager)
+        self.assertIsNot(pool.acquire(), manager)
+
+    def test_release_is_bounded(self):
+        pool = self._makeOne(size=1)
+        first = pool.acquire()
+        second = pool.acquire()
+        self.assertTrue(pool.release(first))
+        self.assertTrue(pool.release(second))
+        self.assertEqual(pool._free_list(), [first])
+
+    def test_release_with_open_transaction(self):
+        pool = self._makeOne()
+        manager = pool.acquire()
+        manager.begin()
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter('always')
+            self.assertFalse(pool.release(manager))
+        self.assertEqual(w, [])
+        self.assertEqual(pool._free_list(), [])
+
+    def test_release_with_synchronizer_debug(self):
+        from pyramid_tm.pool import TransactionManagerLeak
+
+        pool = self._makeOne(debug=True)
+        manager = pool.acquire()
+        synch = DummySynch()
+        manager.registerSynch(synch)
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter('always')
+            self.assertFalse(pool.release(manager))
+        self.assertEqual(len(w), 1)
+        self.assertIs(w[0].category, TransactionManagerLeak)
+        self.assertIn('1 registered synchronizer', str(w[0].message))
+        self.assertEqual(pool._free_list(), [])
+
+    def test_release_with_open_transaction_debug(self):
+        from pyramid_tm.pool import TransactionManagerLeak
+
+        pool = self._makeOne(debug=True)
+        manager = pool.acquire()
+        manager.begin()
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter('always')
+            self.assertFalse(pool.release(manager))
+        self.assertEqual(len(w), 1)
+        self.assertIs(w[0].category, TransactionManagerLeak)
+        self.assertIn('an open transaction', str(w[0].message))
+
+    def test_acquire_verifies_released_managers_debug(self):
+        from pyramid_tm.pool import TransactionManagerLeak
+
+        pool = self._makeOne(debug=True)
+        manager = pool.acquire()
+        pool.release(manager)
+        # used after being released
+        manager.begin()
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter('always')
+            result = pool.acquire()
+        self.assertIsNot(result, manager)
+        self.assertEqual(len(w), 1)
+        self.assertIs(w[0].category, TransactionManagerLeak)
+
+    def test_acquire_verifies_released_managers(self):
+        pool = self._makeOne()
+        manager = pool.acquire()
+        pool.release(manager)
+        # used after being released
+        manager.begin()
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter('always')
+            result = pool.acquire()
+        self.assertIsNot(result, manager)
+        self.assertIsNone(result._txn)
+        self.assertEqual(w, [])
+
+    def test_free_lists_are_per_thread(self):
+        pool = self._makeOne()
+        manager = pool.acquire()
+        pool.release(manager)
+        result = []
+        thread = threading.Thread(target=lambda: result.append(pool.acquire()))
+        thread.start()
+        thread.join()
+        self.assertIsNot(result[0], manager)
+        self.assertIs(pool.acquire(), manager)
+
+
+class Test_pooled_explicit_manager(unittest.TestCase):
+    def _callFUT(self, request):
+        from pyramid_tm import pooled_explicit_manager
+
+        return pooled_explicit_manager(request)
+
+    def _makeRequest(self, registry):
+        request = DummyRequest()
+        request.registry = registry
+        return request
+
+    def test_without_pool(self):
+        manager = self._callFUT(self._makeRequest({}))
+        self.assertIsInstance(manager, TransactionManager)
+        self.assertTrue(manager.explicit)
+
+    def test_with_pool(self):
+        from pyramid_tm.pool import ManagerPool
+
+        pool = ManagerPool()
+        manager = TransactionManager(explicit=True)
+        pool.release(manager)
+        request = self._makeRequest({'pyramid_tm.manager_pool': pool})
+        self.assertIs(self._callFUT(request), manager)
+
+
+class DummyRequest(object):
+    registry = None
@@ -0,0 +1,109 @@
+import os
+import pstats
+import shutil
+import tempfile
+import unittest
+
+from tests import DummyRequest, DummyRoute
+
+
+class TestProfiler(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _makeOne(self, rate=1.0, routes=(), keep=100, routes_mapper=None):
+        from pyramid_tm.profile import Profiler
+
+        return Profiler(self.directory, rate, routes, keep, routes_mapper)
+
+    def _run(self, profiler, finisher=None, phase='commit', request=None):
+        if request is None:
+            request = DummyRequest()
+        if finisher is None:
+            finisher = lambda request, manager: None
+        handler = profiler.profile_handler(lambda request: 'response')
+        complete = profiler.profile_completion(finisher, phase)
+        self.assertEqual(handler(request), 'response')
+        return complete(request, None)
+
+    def _files(self):
+        return sorted(os.listdir(self.directory))
+
+    def test_sampled(self):
+        profiler = self._makeOne()
+        request = DummyRequest()
+        request.matched_route = DummyRoute('a/b')
+        self._run(profiler, request=request)
+        files = self._files()
+        self.assertEqual(len(files), 1)
+        self.assertTrue(files[0].startswith('a_b.commit.'))
+        self.assertTrue(files[0].endswith('.pstats'))
+        pstats.Stats(os.path.join(self.directory, files[0]))
+        self.assertNotIn('pyramid_tm.profile', request.environ)
+
+    def test_not_sampled(self):
+        profiler = self._makeOne(rate=0.0)
+        self._run(profiler)
+        self.assertEqual(self._files(), [])
+
+    def test_failed_abort(self):
+        def abort(request, manager):
+            raise ValueError
+
+        profiler = self._makeOne()
+        self.assertRaises(ValueError, self._run, profiler, abort, 'abort')
+        files = self._files()
+        self.assertEqual(len(files), 1)
+        self.assertTrue(files[0].startswith('_.abort_failed.'))
+
+    def test_routes(self):
+        routes = {'/': DummyRoute('home'), '/other': DummyRoute('other')}
+
+        def routes_mapper(request):
+            return {'route': routes.get(request.path_info)}
+
+        profiler = self._makeOne(
+            rate=0.0, routes=['home'], routes_mapper=routes_mapper
+        )
+        for path in ('/', '/other', '/missing'):
+            request = DummyRequest()
+            request.path_info = path
+            self._run(profiler, request=request)
+        self.assertEqual(len(self._files()), 1)
+
+    def test_ring_eviction(self):
+        profiler = self._makeOne(keep=2)
+        for _ in range(3):
+            self._run(profiler)
+        files = self._files()
+        self.assertEqual(len(files), 2)
+        self.assertEqual(
+            [os.path.basename(path) for path in profiler._files], files
+        )
+
+    def test_evicted_file_already_removed(self):
+        profiler = self._makeOne(keep=1)
+        self._run(profiler)
+        os.remove(profiler._files[0])
+        self._run(profiler)
+        self.assertEqual(len(self._files()), 1)
+
+    def test_another_profiler_active(self):
+        import cProfile
+
+        profiler = self._makeOne()
+
+        class DummyProfile(object):
+            def enable(self):
+                raise ValueError
+
+        orig = cProfile.Profile
+        cProfile.Profile = DummyProfile
+        try:
+            self._run(profiler)
+        finally:
+            cProfile.Profile = orig
+        self.assertEqual(self._files(), [])
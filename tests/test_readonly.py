@@ -0,0 +1,127 @@
+import io
+import os
+import shutil
+import tempfile
+from transaction import TransactionManager
+import unittest
+
+from tests import DummyDataManager, DummyRequest, DummyRoute
+
+
+class TestReadOnlyRoutes(unittest.TestCase):
+    def _makeOne(self, window=2, adaptive=False):
+        from pyramid_tm.readonly import ReadOnlyRoutes
+
+        return ReadOnlyRoutes(window, adaptive)
+
+    def test_observe(self):
+        routes = self._makeOne()
+        self.assertFalse(routes.is_readonly('home'))
+        routes.observe('home', False)
+        self.assertFalse(routes.is_readonly('home'))
+        routes.observe('home', False)
+        self.assertTrue(routes.is_readonly('home'))
+        routes.observe('home', True)
+        self.assertFalse(routes.is_readonly('home'))
+        self.assertEqual(
+            routes.snapshot(),
+            {'home': {'readonly': 0, 'writes': 1, 'is_readonly': False}},
+        )
+
+    def test_dump_and_load(self):
+        routes = self._makeOne()
+        routes.observe('home', False)
+        routes.observe('home', False)
+        routes.observe('edit', True)
+        fp = io.StringIO()
+        routes.dump(fp)
+        fp.seek(0)
+        other = self._makeOne()
+        other.load(fp)
+        self.assertTrue(other.is_readonly('home'))
+        self.assertFalse(other.is_readonly('edit'))
+        self.assertEqual(other.snapshot(), routes.snapshot())
+
+    def test_observe_completion(self):
+        routes = self._makeOne(window=1)
+        manager = TransactionManager(explicit=True)
+        calls = []
+
+        def finisher(request, manager, *args):
+            calls.append(args)
+            manager.abort()
+
+        wrapper = routes.observe_completion(finisher)
+        manager.begin()
+        wrapper(DummyRequest(DummyRoute('home')), manager, 'arg')
+        manager.begin().join(DummyDataManager())
+        wrapper(DummyRequest(DummyRoute('edit')), manager)
+        # unmatched requests are ignored
+        manager.begin()
+        wrapper(DummyRequest(), manager)
+        # a manager without a transaction has no resources
+        noop = routes.observe_completion(lambda request, manager: None)
+        noop(DummyRequest(DummyRoute('empty')), manager)
+        self.assertEqual(calls, [('arg',), (), ()])
+        self.assertTrue(routes.is_readonly('home'))
+        self.assertFalse(routes.is_readonly('edit'))
+        self.assertTrue(routes.is_readonly('empty'))
+
+    def test_observe_completion_pending(self):
+        from pyramid_tm import LazyTransactionManager
+
+        routes = self._makeOne(window=1)
+        manager = LazyTransactionManager(TransactionManager(explicit=True))
+        wrapper = routes.observe_completion(lambda request, manager: None)
+        wrapper(DummyRequest(DummyRoute('home')), manager)
+        self.assertTrue(manager.pending)
+        self.assertTrue(routes.is_readonly('home'))
+
+
+class Test_get_readonly_routes(unittest.TestCase):
+    def _callFUT(self, registry):
+        from pyramid_tm import get_readonly_routes
+
+        return get_readonly_routes(registry)
+
+    def test_disabled(self):
+        self.assertEqual(self._callFUT({}), {})
+
+    def test_enabled(self):
+        from pyramid_tm.readonly import ReadOnlyRoutes
+
+        routes = ReadOnlyRoutes(1)
+        routes.observe('home', False)
+        result = self._callFUT({'pyramid_tm.readonly_routes': routes})
+        self.assertEqual(
+            result,
+            {'home': {'readonly': 1, 'writes': 0, 'is_readonly': True}},
+        )
+
+
+class Test_dump_readonly_routes(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'routes.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _callFUT(self, registry):
+        from pyramid_tm import dump_readonly_routes
+
+        return dump_readonly_routes(registry, self.path)
+
+    def test_disabled(self):
+        self.assertRaises(ValueError, self._callFUT, {})
+
+    def test_enabled(self):
+        from pyramid_tm.readonly import ReadOnlyRoutes
+
+        routes = ReadOnlyRoutes(1)
+        routes.observe('home', False)
+        self._callFUT({'pyramid_tm.readonly_routes': routes})
+        other = ReadOnlyRoutes(1)
+        with open(self.path) as fp:
+            other.load(fp)
+        self.assertTrue(other.is_readonly('home'))
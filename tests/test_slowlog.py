@@ -0,0 +1,176 @@
+from transaction import TransactionManager
+import unittest
+
+from tests import DummyDataManager, DummyRequest, DummyRoute
+
+
+class TestSlowLog(unittest.TestCase):
+    def setUp(self):
+        self.records = []
+        self.request = DummyRequest()
+        self.manager = TransactionManager(explicit=True)
+
+    def _makeOne(self, threshold=0):
+        from pyramid_tm.slowlog import SlowLog
+
+        return SlowLog(threshold, self.records.append)
+
+    def _run(self, slow_log, finisher, phase='abort'):
+        slow_log.start(self.request)
+        self.manager.begin()
+        handler = slow_log.time_handler(lambda request: 'response')
+        complete = slow_log.time_completion(finisher, phase)
+        self.assertEqual(handler(self.request), 'response')
+        return complete(self.request, self.manager)
+
+    def test_below_threshold(self):
+        slow_log = self._makeOne(threshold=60)
+        self._run(slow_log, lambda request, manager: manager.abort())
+        self.assertEqual(self.records, [])
+
+    def test_slow_abort(self):
+        def abort(request, manager):
+            txn = manager.get()
+            txn.note('note')
+            txn.user = 'phred'
+            txn.join(DummyDataManager())
+            manager.abort()
+
+        self.request.matched_route = DummyRoute('home')
+        slow_log = self._makeOne()
+        # resources are named before the transaction forgets them
+        slow_log.start(self.request)
+        self.manager.begin().join(DummyDataManager())
+        handler = slow_log.time_handler(lambda request: None)
+        handler(self.request)
+        slow_log.time_completion(abort, 'abort')(self.request, self.manager)
+        self.assertEqual(len(self.records), 1)
+        record = self.records[0]
+        self.assertEqual(record['path'], '/')
+        self.assertEqual(record['route'], 'home')
+        self.assertEqual(record['user'], 'phred')
+        self.assertEqual(record['note'], 'note')
+        self.assertEqual(record['outcome'], 'abort')
+        self.assertEqual(
+            record['resources'], ['DummyDataManager', 'DummyDataManager']
+        )
+        self.assertEqual(sorted(record['phases']), ['abort', 'handler'])
+        self.assertGreaterEqual(record['duration'], record['phases']['abort'])
+
+    def test_slow_commit(self):
+        def commit(request, manager):
+            manager.get().join(DummyDataManager())
+            manager.commit()
+
+        slow_log = self._makeOne()
+        self._run(slow_log, commit, 'commit')
+        record = self.records[0]
+        self.assertEqual(record['outcome'], 'commit')
+        self.assertEqual(record['resources'], ['DummyDataManager'])
+
+    def test_resources_not_named_below_threshold(self):
+        from pyramid_tm import slowlog
+
+        names = []
+        resource_names = slowlog._resource_names
+        slowlog._resource_names = lambda txn: names.append(txn)
+        try:
+            self.test_below_threshold()
+        finally:
+            slowlog._resource_names = resource_names
+        self.assertEqual(names, [])
+
+    def test_undecodable_path(self):
+        class Request(DummyRequest):
+            @property
+            def path_info(self):
+                raise UnicodeDecodeError('utf-8', b'\xff', 0, 1, 'invalid')
+
+        self.request = Request()
+        self._run(self._makeOne(), lambda request, manager: manager.abort())
+        self.assertEqual(self.records[0]['path'], None)
+        self.assertEqual(self.records[0]['outcome'], 'abort')
+
+    def test_failed_commit(self):
+        def commit(request, manager, *args):
+            manager.abort()
+            raise ValueError
+
+        slow_log = self._makeOne()
+        self.assertRaises(ValueError, self._run, slow_log, commit, 'commit')
+        record = self.records[0]
+        self.assertEqual(record['outcome'], 'commit_failed')
+        self.assertEqual(record['route'], None)
+        self.assertEqual(record['resources'], [])
+
+    def test_duration_starts_before_begin(self):
+        from pyramid_tm import slowlog
+
+        # start, handler, completion
+        times = iter([1.0, 3.0, 4.0, 5.0, 7.0])
+        perf_counter = slowlog.perf_counter
+        slowlog.perf_counter = lambda: next(times)
+        try:
+            self._run(self._makeOne(), lambda request, manager: None)
+        finally:
+            slowlog.perf_counter = perf_counter
+        record = self.records[0]
+        self.assertEqual(record['duration'], 6.0)
+        self.assertEqual(record['phases'], {'handler': 1.0, 'abort': 2.0})
+
+    def test_handler_without_transaction(self):
+        slow_log = self._makeOne()
+        handler = slow_log.time_handler(lambda request: 'response')
+        self.assertEqual(handler(self.request), 'response')
+        self.assertNotIn('pyramid_tm.timings', self.request.environ)
+
+    def test_without_transaction(self):
+        slow_log = self._makeOne()
+        slow_log.start(self.request)
+        handler = slow_log.time_handler(lambda request: None)
+        handler(self.request)
+        complete = slow_log.time_completion(lambda *args: None, 'commit')
+        complete(self.request, self.manager)
+        record = self.records[0]
+        self.assertEqual(record['user'], None)
+        self.assertEqual(record['resources'], [])
+
+    def test_pending_lazy_manager(self):
+        from pyramid_tm import LazyTransactionManager
+
+        manager = LazyTransactionManager(self.manager)
+        slow_log = self._makeOne()
+        slow_log.start(self.request)
+        handler = slow_log.time_handler(lambda request: None)
+        handler(self.request)
+        complete = slow_log.time_completion(lambda *args: None, 'commit')
+        complete(self.request, manager)
+        self.assertTrue(manager.pending)
+        self.assertEqual(self.records[0]['outcome'], 'commit')
+
+
+class Test_log_slow_transaction(unittest.TestCase):
+    def _callFUT(self, record):
+        from pyramid_tm.slowlog import log_slow_transaction
+
+        return log_slow_transaction(record)
+
+    def test_it(self):
+        record = {
+            'path': '/',
+            'route': 'home',
+            'user': 'phred',
+            'note': '/',
+            'outcome': 'commit',
+            'duration': 1.5,
+            'phases': {'handler': 1.0, 'commit': 0.5},
+            'resources': ['Connection', 'SessionDataManager'],
+        }
+        with self.assertLogs('pyramid_tm.slowlog', 'WARNING') as cm:
+            self._callFUT(record)
+        self.assertEqual(
+            cm.records[0].getMessage(),
+            "slow transaction: 1500.0ms commit / route=home user='phred' "
+            "note='/' phases=commit=500.0ms handler=1000.0ms "
+            "resources=Connection,SessionDataManager",
+        )
@@ -0,0 +1,152 @@
+import threading
+import unittest
+
+
+class TestStats(unittest.TestCase):
+    def _makeOne(self, buckets=(0.1, 1.0)):
+        from pyramid_tm.stats import Stats
+
+        return Stats(buckets)
+
+    def test_empty_snapshot(self):
+        from pyramid_tm.stats import OUTCOMES
+
+        stats = self._makeOne()
+        snapshot = stats.snapshot()
+        self.assertEqual(snapshot['phases'], {})
+        self.assertEqual(snapshot['outcomes'], dict.fromkeys(OUTCOMES, 0))
+
+    def test_observe(self):
+        stats = self._makeOne()
+        stats.observe('commit', 0.05)
+        stats.observe('commit', 0.5)
+        stats.observe('commit', 5.0)
+        stats.observe('abort', 0.1)
+        phases = stats.snapshot()['phases']
+        self.assertEqual(phases['commit']['count'], 3)
+        self.assertAlmostEqual(phases['commit']['sum'], 5.55)
+        self.assertEqual(
+            phases['commit']['buckets'],
+            [(0.1, 1), (1.0, 2), (float('inf'), 3)],
+        )
+        self.assertEqual(
+            phases['abort']['buckets'],
+            [(0.1, 1), (1.0, 1), (float('inf'), 1)],
+        )
+
+    def test_incr(self):
+        stats = self._makeOne()
+        stats.incr('commit')
+        stats.incr('commit')
+        stats.incr('custom')
+        outcomes = stats.snapshot()['outcomes']
+        self.assertEqual(outcomes['commit'], 2)
+        self.assertEqual(outcomes['abort'], 0)
+        self.assertEqual(outcomes['custom'], 1)
+
+    def test_threads_are_merged(self):
+        stats = self._makeOne()
+        stats.observe('handler', 0.01)
+        stats.incr('commit')
+
+        def work():
+            stats.observe('handler', 0.01)
+            stats.incr('commit')
+
+        thread = threading.Thread(target=work)
+        thread.start()
+        thread.join()
+        snapshot = stats.snapshot()
+        self.assertEqual(len(stats._shards), 2)
+        self.assertEqual(snapshot['phases']['handler']['count'], 2)
+        self.assertEqual(snapshot['outcomes']['commit'], 2)
+
+    def test_instrument_success(self):
+        stats = self._makeOne()
+        fn = stats.instrument(
+            lambda x: x, 'veto', on_success='called', on_true='veto'
+        )
+        self.assertEqual(fn(False), False)
+        self.assertEqual(fn(True), True)
+        snapshot = stats.snapshot()
+        self.assertEqual(snapshot['phases']['veto']['count'], 2)
+        self.assertEqual(snapshot['outcomes']['called'], 2)
+        self.assertEqual(snapshot['outcomes']['veto'], 1)
+
+    def test_instrument_error(self):
+        stats = self._makeOne()
+
+        def fn():
+            raise ValueError
+
+        wrapper = stats.instrument(
+            fn, 'handler', on_success='commit', on_error='exception'
+        )
+        self.assertRaises(ValueError, wrapper)
+        snapshot = stats.snapshot()
+        self.assertEqual(snapshot['phases']['handler']['count'], 1)
+        self.assertEqual(snapshot['outcomes']['exception'], 1)
+        self.assertEqual(snapshot['outcomes']['commit'], 0)
+
+    def test_instrument_without_phase(self):
+        stats = self._makeOne()
+        wrapper = stats.instrument(lambda: 1, on_true='doom')
+        wrapper()
+        snapshot = stats.snapshot()
+        self.assertEqual(snapshot['phases'], {})
+        self.assertEqual(snapshot['outcomes']['doom'], 1)
+
+
+class Test_get_stats(unittest.TestCase):
+    def _callFUT(self, registry):
+        from pyramid_tm import get_stats
+
+        return get_stats(registry)
+
+    def test_disabled(self):
+        self.assertEqual(self._callFUT({}), None)
+
+    def test_enabled(self):
+        from pyramid_tm.stats import Stats
+
+        stats = Stats()
+        stats.incr('commit')
+        result = self._callFUT({'pyramid_tm.stats': stats})
+        self.assertEqual(result['outcomes']['commit'], 1)
+
+
+class Test_format_stats(unittest.TestCase):
+    def _callFUT(self, registry):
+        from pyramid_tm import format_stats
+
+        return format_stats(registry)
+
+    def test_disabled(self):
+        self.assertEqual(self._callFUT({}), '')
+
+    def test_enabled(self):
+        from pyramid_tm.stats import Stats
+
+        stats = Stats((0.5,))
+        stats.observe('commit', 0.25)
+        stats.incr('commit')
+        result = self._callFUT({'pyramid_tm.stats': stats})
+        lines = result.splitlines()
+        self.assertTrue(result.endswith('\n'))
+        self.assertIn('# TYPE pyramid_tm_phase_seconds histogram', lines)
+        self.assertIn(
+            'pyramid_tm_phase_seconds_bucket{phase="commit",le="0.5"} 1',
+            lines,
+        )
+        self.assertIn(
+            'pyramid_tm_phase_seconds_bucket{phase="commit",le="+Inf"} 1',
+            lines,
+        )
+        self.assertIn(
+            'pyramid_tm_phase_seconds_sum{phase="commit"} 0.25', lines
+        )
+        self.assertIn(
+            'pyramid_tm_phase_seconds_count{phase="commit"} 1', lines
+        )
+        self.assertIn('pyramid_tm_outcomes_total{outcome="commit"} 1', lines)
+        self.assertIn('pyramid_tm_outcomes_total{outcome="abort"} 0', lines)